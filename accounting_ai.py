@@ -2,14 +2,26 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import re
-import io
+import os
 import time
+import tempfile
 from datetime import datetime
 from PIL import Image
-import plotly.express as px
 import plotly.graph_objects as go
 
+from accounting_core import (
+    SHEET_COLUMNS, STORAGE_MODE, GRANULARITIES, CHART_GRANULARITIES, GRANULARITY_LABELS, CHART_POINT_BUDGET, CHART_WEBGL_MIN_POINTS,
+    BASE_CURRENCY, CURRENCY_NAMES, TRANSACTION_SHEETS, REPORT_PAGE_SIZES, EXPORT_FORMATS,
+    REGISTRY_SHEETS, AGING_LABELS, AUDIT_MODES, RECONCILE_WINDOW_DAYS, RECONCILE_AMOUNT_TOLERANCE, SETTLED_STATUS,
+    Ledger, RollupIndex, ChartIndex, AuditEngine, SqliteAuditEngine, ReconciliationEngine,
+    ledger_cache, ledger_journal, sqlite_ledger, sheet_writer, ocr_service, parse_cache, metrics, METRICS_PATH,
+    as_amounts, storage_frame, currency_rates, convert_to_base, totals_in_base, balance_index, registry_with_balances,
+    read_bank_statement, settle_matches, decimate, chart_granularity, LEDGER_IMPORT_SHEETS, import_ledger_file,
+    JOURNAL_SHEET, POSTING_RULES, FinancialStatements, journal_lines, journal_daily, closed_through, check_open_period,
+    close_period, rebuild_journal,
+    extract_amount, parse_transaction_text, parse_invoice_text, import_transaction_lines, report_source,
+)
+
 # إعداد صفحة Streamlit
 st.set_page_config(
     page_title="نظام المحاسبة الذكي",
@@ -25,61 +37,153 @@ accent_color = "#1a73e8"
 background_color = "#f0f0f0"
 
 
+# أوراق المعاملات التي تحمل مبالغ وعملات
+PARTY_SHEETS = [sheet_name for sheet_name, _, _ in TRANSACTION_SHEETS.values()] + ["المصروفات"]
+
+
 class AccountingAIApp:
     def __init__(self):
         # تهيئة بيانات الجلسة إذا لم تكن موجودة
         if 'data' not in st.session_state:
-            st.session_state.data = {
-                "المبيعات": pd.DataFrame(columns=["التاريخ", "العميل", "المبلغ", "الوصف", "الحالة"]),
-                "المشتريات": pd.DataFrame(columns=["التاريخ", "المورد", "المبلغ", "الوصف", "الحالة"]),
-                "المصروفات": pd.DataFrame(columns=["التاريخ", "النوع", "المبلغ", "الوصف", "الحالة"]),
-                "العملاء": pd.DataFrame(columns=["الاسم", "البريد", "الهاتف", "الرصيد"]),
-                "الموردين": pd.DataFrame(columns=["الاسم", "البريد", "الهاتف", "الرصيد"])
-            }
+            # عرض خفيف للدفتر المشترك؛ لا تحمل الجلسة نسخة خاصة من الأوراق
+            st.session_state.data = Ledger(ledger_cache)
 
         # مفاتيح الحالة الافتراضية
         st.session_state.setdefault('show_manual_input', False)
         st.session_state.setdefault('show_camera_input', False)
         st.session_state.setdefault('show_text_input', False)
         st.session_state.setdefault('input_text', "")
+        st.session_state.setdefault('pending_transaction', None)
+        st.session_state.setdefault('ocr_jobs', {})
+        st.session_state.setdefault('reconciliation', None)
 
         # تحميل أي ملفات CSV موجودة
         self.load_data()
 
+    @metrics.instrument()
     def load_data(self):
-        """تحميل البيانات من ملفات CSV إن وجدت"""
+        """تحميل البيانات من ملفات CSV إن وجدت (مع إعادة تشغيل السجل الإلحاقي في نمط journal)"""
+        if STORAGE_MODE == "sqlite":
+            # لا تُحمّل الأوراق كاملة؛ التقارير والرسوم تستعلم القاعدة مباشرة
+            try:
+                sqlite_ledger.ensure_schema()
+            except Exception as e:
+                st.error(f"خطأ في فتح قاعدة البيانات: {e}")
+            return
+        rows = 0
         try:
             for sheet_name in list(st.session_state.data.keys()):
                 try:
-                    df = pd.read_csv(f"{sheet_name}.csv", encoding='utf-8-sig')
-                    # تحويل عمود المبلغ إلى رقمي إن وجد
-                    if "المبلغ" in df.columns:
-                        df['المبلغ'] = pd.to_numeric(df['المبلغ'], errors='coerce')
-                    st.session_state.data[sheet_name] = df
-                except FileNotFoundError:
-                    # لا يوجد ملف بعد — نتجاهل
-                    pass
+                    # إلى المخزن المشترك؛ تُقرأ الورقة من القرص فقط إذا تغيّرت ملفاتها
+                    rows += len(ledger_cache.get(sheet_name))
                 except Exception as e:
                     st.warning(f"مشكلة بقراءة {sheet_name}.csv: {e}")
         except Exception as e:
             st.error(f"خطأ في تحميل البيانات: {e}")
+        metrics.note_rows(rows)
 
+    @metrics.instrument()
     def save_data(self):
         """حفظ البيانات إلى ملفات CSV"""
+        ledger = st.session_state.data
+        if STORAGE_MODE == "journal":
+            try:
+                # التعديلات المحلية للجلسة (إن وجدت) تُعتمد كلقطة كاملة
+                for sheet_name in ledger.dirty():
+                    ledger.commit(sheet_name, write=lambda df, sheet_name=sheet_name: ledger_journal.replace(sheet_name, df))
+            except Exception as e:
+                st.error(f"خطأ في حفظ البيانات: {e}")
+                return
+            # القيود محفوظة أصلًا في السجل؛ الحفظ هنا يطوي السجل في ملفات CSV بالخلفية
+            for sheet_name in ledger.keys():
+                ledger_journal.compact_async(sheet_name)
+            st.success("✅ البيانات محفوظة في السجل، وجارٍ دمجها في ملفات CSV بالخلفية")
+            return
+        if STORAGE_MODE == "sqlite":
+            try:
+                for sheet_name in ledger.dirty():
+                    ledger.commit(sheet_name, write=lambda df, sheet_name=sheet_name: sqlite_ledger.replace(sheet_name, df))
+                st.success("✅ البيانات محفوظة في قاعدة البيانات")
+            except Exception as e:
+                st.error(f"خطأ في حفظ البيانات: {e}")
+            return
         try:
-            for sheet_name, df in st.session_state.data.items():
-                # احفظ مع ترميز utf-8-sig لتفادي مشاكل Excel مع العربية
-                df.to_csv(f"{sheet_name}.csv", index=False, encoding='utf-8-sig')
-            st.success("✅ تم حفظ البيانات محليًا (CSV)")
+            for sheet_name in ledger.dirty():
+                # التعديل المحلي يُنشر في المخزن المشترك فورًا، وكتابة الورقة (ذريًا) تجري في الخيط الخلفي
+                ledger.commit(sheet_name, write=lambda df: None)
+                sheet_writer.schedule(sheet_name)
+            st.success("✅ تم حفظ البيانات، وتُكتب الأوراق المعدلة إلى ملفات CSV بالخلفية")
         except Exception as e:
             st.error(f"خطأ في حفظ البيانات: {e}")
 
+    @metrics.instrument()
+    def add_record(self, sheet_name, record, journal=None):
+        """إضافة قيد إلى ورقة وحفظه (سطر واحد في السجل، أو إعادة كتابة CSV في النمط القديم)،
+        مع أسطر اليومية المزدوجة المقابلة (journal، افتراضيًا من قواعد الترحيل). يعيد False إن رُفض القيد"""
+        try:
+            check_open_period([record.get("التاريخ")])
+        except ValueError as e:
+            st.error(str(e))
+            return False
+        if journal is None and sheet_name in POSTING_RULES:
+            journal = journal_lines(sheet_name, pd.DataFrame([record]))
+        if STORAGE_MODE in ("journal", "sqlite"):
+            frames = {sheet_name: pd.DataFrame([record])}
+            if journal is not None:
+                frames[JOURNAL_SHEET] = journal
+            try:
+                # القيد وأسطر يوميته كتابة دائمة واحدة (كلاهما أو لا شيء)، ثم الإلحاق بالمخزن المشترك دون نسخ الورقة
+                self.write_frames(frames)
+            except Exception as e:
+                st.error(f"خطأ في حفظ القيد: {e}")
+                return False
+        else:
+            # الكتابة مؤجلة: زمن الإدخال لا يتبع حجم الورقة، وتعديلات الدفعة المتتالية تُكتب مرة واحدة
+            ledger_cache.append(sheet_name, record, write=lambda: None, durable=False)
+            sheet_writer.schedule(sheet_name)
+            if journal is not None:
+                ledger_cache.extend(JOURNAL_SHEET, journal, write=lambda: None, durable=False)
+                sheet_writer.schedule(JOURNAL_SHEET)
+        return True
+
+    @metrics.instrument()
+    def add_records(self, frames):
+        """إضافة دفعات صفوف لعدة أوراق (مع أسطر يوميتها) معًا. يعيد False إن رُفضت الدفعة أو تعذر حفظها"""
+        metrics.note_rows(sum(len(df) for df in frames.values()))
+        try:
+            for sheet_name in POSTING_RULES:
+                if sheet_name in frames:
+                    check_open_period(frames[sheet_name]["التاريخ"])
+        except ValueError as e:
+            st.error(str(e))
+            return False
+        try:
+            self.write_frames(frames)
+        except Exception as e:
+            st.error(f"خطأ في حفظ الدفعة: {e}")
+            return False
+        return True
+
+    def write_frames(self, frames):
+        """كتابة دفعات عدة أوراق: في نمطي journal وsqlite كتابة دائمة واحدة (كلها أو لا شيء) ثم الإلحاق
+        بالمخزن المشترك، وفي نمط csv إلحاق بالمخزن وجدولة كتابة الأوراق بالخلفية"""
+        frames = {sheet_name: df for sheet_name, df in frames.items() if not df.empty}
+        if not frames:
+            return
+        if STORAGE_MODE in ("journal", "sqlite"):
+            store = ledger_journal if STORAGE_MODE == "journal" else sqlite_ledger
+            ledger_cache.extend_many(frames, write=lambda: store.append_frames(frames))
+            return
+        for sheet_name, df in frames.items():
+            ledger_cache.extend(sheet_name, df, write=lambda: None, durable=False)
+            sheet_writer.schedule(sheet_name)
+
     def run(self):
         """الواجهة الأساسية وتشغيل التطبيق"""
         st.sidebar.title("نظام المحاسبة الذكي")
         app_mode = st.sidebar.selectbox(
             "اختر الصفحة",
-            ["الإدخال الرئيسي", "التقارير المحاسبية", "التحليل التفاعلي", "الإعدادات والربط", "التدقيق والمطابقة"]
+            ["الإدخال الرئيسي", "التقارير المحاسبية", "التحليل التفاعلي", "الإعدادات والربط", "التشخيص والأداء", "التدقيق والمطابقة"]
         )
 
         if app_mode == "الإدخال الرئيسي":
@@ -90,12 +194,33 @@ class AccountingAIApp:
             self.show_analysis_page()
         elif app_mode == "الإعدادات والربط":
             self.show_settings_page()
+        elif app_mode == "التشخيص والأداء":
+            self.show_diagnostics_page()
         elif app_mode == "التدقيق والمطابقة":
             self.show_audit_page()
+        self.show_pending_writes()
+
+    def show_pending_writes(self):
+        """مؤشر الكتابات المؤجلة في الشريط الجانبي (نمط csv)"""
+        if STORAGE_MODE != "csv":
+            return
+        pending = sheet_writer.pending()
+        for sheet_name, error in list(sheet_writer.errors.items()):
+            st.sidebar.error(f"تعذرت كتابة {sheet_name}.csv: {error}")
+        if pending:
+            st.sidebar.caption(f"⏳ كتابات معلقة: {'، '.join(pending)}")
+            if st.sidebar.button("💾 اكتب الآن", key="flush_writes_btn"):
+                if sheet_writer.flush(timeout=30):
+                    st.sidebar.success("✅ كُتبت كل الأوراق")
+                else:
+                    st.sidebar.error("لم تكتمل كتابة كل الأوراق بعد")
+        else:
+            st.sidebar.caption("✅ كل التعديلات مكتوبة على القرص")
 
     # -------------------------
     # صفحة الإدخال
     # -------------------------
+    @metrics.instrument()
     def show_input_page(self):
         st.title("إدخال المعاملات المحاسبية")
         # أزرار الاختيار
@@ -170,30 +295,98 @@ class AccountingAIApp:
                 st.session_state.input_text = ""
                 st.experimental_rerun()
 
+        with st.expander("📂 استيراد دفعة من ملف نصي (سطر لكل معاملة)"):
+            batch_file = st.file_uploader("اختر ملف الأسطر", type=['txt', 'csv'], key="batch_text_uploader")
+            if batch_file and st.button("استيراد الدفعة", key="batch_import_btn"):
+                self.batch_text_import(batch_file)
+
+    @metrics.instrument()
+    def batch_text_import(self, uploaded_file):
+        """استيراد ملف أسطر معاملات على دفعات مع تحليل متجه، ثم كتابة النتائج في الأوراق دفعة واحدة"""
+        start = time.perf_counter()
+        status = st.empty()
+        try:
+            frames, stats = import_transaction_lines(uploaded_file, progress=lambda total: status.text(f"تمت معالجة {total:,} سطر..."))
+            if not self.add_records(frames):
+                return
+        except Exception as e:
+            st.error(f"فشل الاستيراد: {e}")
+            return
+
+        elapsed = time.perf_counter() - start
+        total, unclassified, vat_total = stats["total"], stats["unclassified"], stats["vat_total"]
+        imported = total - unclassified
+        status.empty()
+        st.success(f"✅ تم استيراد {imported:,} معاملة في {elapsed:.2f} ث ({total / elapsed if elapsed else 0:,.0f} سطر/ثانية)")
+        c1, c2, c3 = st.columns(3)
+        with c1:
+            st.metric("مبيعات", f"{len(frames.get('المبيعات', [])):,}")
+        with c2:
+            st.metric("مشتريات", f"{len(frames.get('المشتريات', [])):,}")
+        with c3:
+            st.metric("ضريبة القيمة المضافة", f"{vat_total:,.2f} ريال")
+        if unclassified:
+            st.info(f"{unclassified:,} سطر غير محدد النوع — لم يتم إضافة قيد تلقائي")
+
     # -------------------------
     # الإدخال بالكاميرا / صورة (محاكاة OCR)
     # -------------------------
     def camera_input(self):
         st.subheader("رفع صورة الفاتورة/المستند")
-        uploaded_file = st.file_uploader("اختر صورة (PNG, JPG, JPEG)", type=['png', 'jpg', 'jpeg'], key="file_uploader")
-        if uploaded_file:
-            try:
-                image = Image.open(uploaded_file)
-                st.image(image, caption="الصورة المرفوعة", use_column_width=True)
-            except Exception:
-                st.warning("تعذر فتح الصورة، تحقق من الملف.")
-
-            if st.button("استخراج النص من الصورة", key="extract_text_btn"):
-                extracted_text = self.simulate_ocr_extraction()
-                st.session_state.input_text = f"{extracted_text}\n"
-                invoice_data = self.parse_invoice_with_chatgpt(extracted_text)
-                self.display_accounting_data(invoice_data)
-                st.success("تم استخراج وتحليل نص الصورة (محاكاة)")
+        uploaded_files = st.file_uploader(
+            "اختر صورة أو أكثر (PNG, JPG, JPEG)", type=['png', 'jpg', 'jpeg'], accept_multiple_files=True, key="file_uploader"
+        )
+        if uploaded_files:
+            columns = st.columns(min(len(uploaded_files), 4))
+            for i, uploaded_file in enumerate(uploaded_files):
+                with columns[i % len(columns)]:
+                    try:
+                        st.image(Image.open(uploaded_file), caption=uploaded_file.name, use_column_width=True)
+                    except Exception:
+                        st.warning(f"تعذر فتح الصورة {uploaded_file.name}، تحقق من الملف.")
+
+            if st.button("استخراج النص من الصور", key="extract_text_btn"):
+                # الإرسال إلى العمليات العاملة دون انتظار؛ النتائج تظهر عند جاهزيتها
+                st.session_state.ocr_jobs = {f.name: ocr_service.submit(f.getvalue()) for f in uploaded_files}
+
+        if st.session_state.get('ocr_jobs'):
+            self.show_ocr_results(st.session_state.ocr_jobs)
+
         if st.button("رجوع", key="back_camera_btn"):
             st.session_state.show_camera_input = False
             st.session_state.input_text = ""
+            st.session_state.ocr_jobs = {}
             st.experimental_rerun()
 
+    def show_ocr_results(self, jobs):
+        """عرض حالة مهام OCR دون انتظارها، وتحليل نص أي صورة جاهزة"""
+        pending = 0
+        for i, (name, future) in enumerate(jobs.items()):
+            if not future.done():
+                pending += 1
+                st.info(f"⏳ جاري التعرف على نص {name}...")
+                continue
+            try:
+                extracted_text = future.result()
+                simulated = False
+            except (ImportError, OSError):
+                # محرك Tesseract غير متوفر في هذه البيئة — نعود إلى المحاكاة (نص ثابت لكل صورة عبر إعادة التشغيل)
+                extracted_text = st.session_state.setdefault('ocr_simulated', {}).setdefault(name, self.simulate_ocr_extraction())
+                simulated = True
+            except Exception as e:
+                st.error(f"تعذر التعرف على نص {name}: {e}")
+                continue
+
+            with st.expander(f"📄 {name}" + (" (محاكاة)" if simulated else ""), expanded=len(jobs) == 1):
+                st.text_area("النص المستخرج", value=extracted_text, height=150, disabled=True, key=f"ocr_text_{i}")
+                if st.button("تحليل الفاتورة", key=f"parse_ocr_{i}"):
+                    invoice_data = self.parse_invoice_with_chatgpt(extracted_text)
+                    self.display_accounting_data(invoice_data)
+                    st.success("تم استخراج وتحليل نص الصورة" + (" (محاكاة)" if simulated else ""))
+
+        if pending:
+            st.button(f"🔄 تحديث الحالة ({pending} قيد المعالجة)", key="refresh_ocr_btn")
+
     def simulate_ocr_extraction(self):
         # نصوص عينة لاستخراجها عشوائياً كمحاكاة
         sample_texts = [
@@ -207,152 +400,45 @@ class AccountingAIApp:
     # تحليل النص (محاكاة ChatGPT)
     # -------------------------
     def parse_with_chatgpt(self, text):
-        amount = self.extract_amount(text)
-        if "بيع" in text or "مبيعات" in text:
-            return {
-                "transaction_type": "بيع",
-                "amount": amount,
-                "currency": "ريال سعودي",
-                "date": datetime.now().strftime("%Y-%m-%d"),
-                "description": text,
-                "account_debit": "حساب المدينين",
-                "account_credit": "إيرادات المبيعات",
-                "vat_amount": round(amount * 0.15, 2)
-            }
-        if "شراء" in text or "مشتريات" in text:
-            return {
-                "transaction_type": "شراء",
-                "amount": amount,
-                "currency": "ريال سعودي",
-                "date": datetime.now().strftime("%Y-%m-%d"),
-                "description": text,
-                "account_debit": "المشتريات",
-                "account_credit": "حساب الدائنين",
-                "vat_amount": round(amount * 0.15, 2)
-            }
-        # افتراضي
-        return {
-            "transaction_type": "عام",
-            "amount": amount,
-            "currency": "ريال سعودي",
-            "date": datetime.now().strftime("%Y-%m-%d"),
-            "description": text,
-            "account_debit": "مصروفات عامة",
-            "account_credit": "البنك",
-            "vat_amount": 0.0
-        }
+        # النص المكرر (بعد توحيد المسافات والأرقام) يُجاب من ذاكرة التحليل بمبلغه هو
+        return parse_cache.parse("transaction", text, parse_transaction_text)
 
     def extract_amount(self, text):
         """استخراج أول رقم يظهر في النص كعدد"""
-        try:
-            nums = re.findall(r'\d+\.\d+|\d+', str(text))
-            if nums:
-                return float(nums[0])
-        except Exception:
-            pass
-        return 0.0
+        return extract_amount(text)
 
     def parse_invoice_with_chatgpt(self, text):
-        amount = self.extract_amount(text)
-        return {
-            "invoice_number": f"INV-{datetime.now().strftime('%Y%m%d')}-001",
-            "supplier": "شركة المعدات المتحدة",
-            "date": datetime.now().strftime("%Y-%m-%d"),
-            "due_date": (datetime.now() + pd.DateOffset(days=30)).strftime("%Y-%m-%d"),
-            "total_amount": amount,
-            "items": [
-                {"description": "طابعة ليزر", "quantity": 2, "unit_price": 1200.00, "total": 2400.00},
-                {"description": "حبر طابعة", "quantity": 5, "unit_price": 170.00, "total": 850.00}
-            ],
-            "vat_amount": round(amount * 0.15, 2)
-        }
-
-    def display_accounting_data(self, data):
-        """تحضير نص المعاينة من استجابة التحليل (محاكاة)"""
-        lines = []
-        if data.get("transaction_type") == "بيع":
-            lines.append("=== معاملة بيع ===")
-        elif data.get("transaction_type") == "شراء":
-            lines.append("=== معاملة شراء ===")
-        else:
-            lines.append("=== معاملة محاسبية ===")
-
-        for k, v in data.items():
-            if k == "items" and isinstance(v, list):
-                lines.append(f"{k}:")
-                for item in v:
-                    for ik, iv in item.items():
-                        lines.append(f"  {ik}: {iv}")
-                    lines.append("")
-            else:
-                lines.append(f"{k}: {v}")
-        st.session_state.input_text = "\n".join(lines)
+        return parse_cache.parse("invoice", text, parse_invoice_text)
+
+    def display_accounting_data(self, transaction):
+        """حفظ القيد المحلل في الجلسة وتحضير نص المعاينة منه للعرض فقط"""
+        st.session_state.pending_transaction = transaction
+        st.session_state.input_text = transaction.preview()
 
     # -------------------------
-    # معالجة النص وتحويله إلى قيد
+    # معالجة القيد المحلل وإضافته إلى الدفتر
     # -------------------------
+    @metrics.instrument()
     def process_data(self):
-        if not st.session_state.get('input_text'):
+        transaction = st.session_state.get('pending_transaction')
+        if not st.session_state.get('input_text') or transaction is None:
             st.warning("لا توجد بيانات لمعالجتها")
             return
 
-        current_text = st.session_state.input_text
-        if "=== معاملة" not in current_text:
-            st.warning("نص المعاينة غير صالح")
+        row = transaction.sheet_row()
+        if row is None:
+            st.info("نوع المعاملة غير محدد تفصيليًا — لم يتم إضافة قيد تلقائي")
             return
 
-        # تحويل النص إلى مفتاح:قيمة
-        transaction_data = {}
-        for line in current_text.splitlines():
-            if ':' in line and not line.strip().startswith('==='):
-                key, val = line.split(':', 1)
-                transaction_data[key.strip()] = val.strip()
-
-        # أولاً: حالة الفاتورة (invoice) إذا وُجدت مفاتيح invoice/total_amount/supplier
-        if 'invoice_number' in transaction_data or 'total_amount' in transaction_data or 'supplier' in transaction_data:
-            amt = self.extract_amount(transaction_data.get('total_amount', transaction_data.get('المبلغ', 0)))
-            date = transaction_data.get('date', datetime.now().strftime("%Y-%m-%d"))
-            supplier = transaction_data.get('supplier', 'مورد')
-            new_record = {
-                "التاريخ": date,
-                "المورد": supplier,
-                "المبلغ": amt,
-                "الوصف": transaction_data.get('description', ''),
-                "الحالة": "معلقة"
-            }
-            st.session_state.data["المشتريات"] = pd.concat([st.session_state.data["المشتريات"], pd.DataFrame([new_record])], ignore_index=True)
-            st.success("تمت إضافة فاتورة كمشتريات (محاكاة).")
-            self.save_data()
+        sheet_name, new_record = row
+        if not self.add_record(sheet_name, new_record, journal=transaction.journal_lines()):
             return
-
-        ttype = transaction_data.get('transaction_type', '')
-        # التعامل بحسب نوع المعاملة
-        if 'بيع' in ttype:
-            amt = self.extract_amount(transaction_data.get('amount', transaction_data.get('المبلغ', 0)))
-            new_record = {
-                "التاريخ": transaction_data.get('date', datetime.now().strftime("%Y-%m-%d")),
-                "العميل": transaction_data.get('client', 'عميل'),
-                "المبلغ": amt,
-                "الوصف": transaction_data.get('description', ''),
-                "الحالة": "معلقة"
-            }
-            st.session_state.data["المبيعات"] = pd.concat([st.session_state.data["المبيعات"], pd.DataFrame([new_record])], ignore_index=True)
+        if transaction.invoice_number:
+            st.success("تمت إضافة فاتورة كمشتريات (محاكاة).")
+        elif sheet_name == "المبيعات":
             st.success("تمت إضافة معاملة بيع")
-        elif 'شراء' in ttype:
-            amt = self.extract_amount(transaction_data.get('amount', transaction_data.get('المبلغ', 0)))
-            new_record = {
-                "التاريخ": transaction_data.get('date', datetime.now().strftime("%Y-%m-%d")),
-                "المورد": transaction_data.get('supplier', 'مورد'),
-                "المبلغ": amt,
-                "الوصف": transaction_data.get('description', ''),
-                "الحالة": "معلقة"
-            }
-            st.session_state.data["المشتريات"] = pd.concat([st.session_state.data["المشتريات"], pd.DataFrame([new_record])], ignore_index=True)
-            st.success("تمت إضافة معاملة شراء")
         else:
-            st.info("نوع المعاملة غير محدد تفصيليًا — لم يتم إضافة قيد تلقائي")
-
-        self.save_data()
+            st.success("تمت إضافة معاملة شراء")
 
     # -------------------------
     # الإدخال اليدوي (نموذج)
@@ -367,6 +453,9 @@ class AccountingAIApp:
                 transaction_party = st.text_input("العميل/المورد", key="trans_party")
             with c2:
                 transaction_amount = st.number_input("المبلغ", min_value=0.0, format="%.2f", key="trans_amount")
+                transaction_currency = st.selectbox("العملة", list(CURRENCY_NAMES), format_func=lambda c: f"{CURRENCY_NAMES[c]} ({c})",
+                                                    index=list(CURRENCY_NAMES).index(BASE_CURRENCY) if BASE_CURRENCY in CURRENCY_NAMES else 0,
+                                                    key="trans_currency")
                 transaction_desc = st.text_area("الوصف", key="trans_desc")
 
             c3, c4 = st.columns(2)
@@ -388,19 +477,21 @@ class AccountingAIApp:
                         "التاريخ": transaction_date.strftime("%Y-%m-%d"),
                         "المبلغ": transaction_amount,
                         "الوصف": transaction_desc,
-                        "الحالة": "مكتمل"
+                        "الحالة": "مكتمل",
+                        "العملة": transaction_currency
                     }
                     if transaction_type == "بيع":
                         new_record["العميل"] = transaction_party
-                        st.session_state.data["المبيعات"] = pd.concat([st.session_state.data["المبيعات"], pd.DataFrame([new_record])], ignore_index=True)
+                        added = self.add_record("المبيعات", new_record)
                     elif transaction_type == "شراء":
                         new_record["المورد"] = transaction_party
-                        st.session_state.data["المشتريات"] = pd.concat([st.session_state.data["المشتريات"], pd.DataFrame([new_record])], ignore_index=True)
+                        added = self.add_record("المشتريات", new_record)
                     else:
                         new_record["النوع"] = transaction_type
-                        st.session_state.data["المصروفات"] = pd.concat([st.session_state.data["المصروفات"], pd.DataFrame([new_record])], ignore_index=True)
+                        added = self.add_record("المصروفات", new_record)
+                    if not added:
+                        return
 
-                    self.save_data()
                     st.success("✅ تمت إضافة المعاملة بنجاح")
                     st.session_state.show_manual_input = False
                     st.session_state.input_text = ""
@@ -409,118 +500,389 @@ class AccountingAIApp:
     # -------------------------
     # التقارير
     # -------------------------
+    @metrics.instrument()
     def show_reports_page(self):
         st.title("📊 التقارير المحاسبية")
         report_type = st.selectbox("اختر نوع التقرير", list(st.session_state.data.keys()), key="report_type")
         if st.button("إنشاء التقرير", key="generate_report_btn"):
+            st.session_state.active_report = report_type
+        # يبقى التقرير معروضًا أثناء التنقل بين الصفحات وتغيير المرشحات
+        if st.session_state.get('active_report') == report_type:
             self.generate_report(report_type)
-
+        st.divider()
+        self.show_aging_report()
+        st.divider()
+        self.show_financial_statements()
+
+    def sheet_size(self, sheet_name):
+        """عدد صفوف الورقة دون تحميلها في نمط sqlite"""
+        if STORAGE_MODE == "sqlite" and sheet_name in SHEET_COLUMNS and sheet_name not in st.session_state.data.dirty():
+            return sqlite_ledger.count(sheet_name)
+        return len(st.session_state.data.buffer(sheet_name))
+
+    def report_index(self, report_type):
+        if STORAGE_MODE == "sqlite" and report_type in SHEET_COLUMNS and report_type not in st.session_state.data.dirty():
+            return report_source(report_type)
+        return report_source(report_type, st.session_state.data.buffer(report_type))
+
+    @metrics.instrument()
     def generate_report(self, report_type):
-        df = st.session_state.data.get(report_type, pd.DataFrame())
-        if df.empty:
+        if report_type not in st.session_state.data or not self.sheet_size(report_type):
             st.warning("لا توجد بيانات لهذا التقرير.")
             return
 
-        df_display = df.copy()
+        index = self.report_index(report_type)
+        filters = {}
+        c1, c2, c3 = st.columns(3)
+        with c1:
+            bounds = index.date_bounds()
+            if bounds:
+                date_range = st.date_input("الفترة", value=bounds, key=f"report_dates_{report_type}")
+                if isinstance(date_range, (list, tuple)) and len(date_range) == 2:
+                    filters["start"], filters["end"] = date_range
+        with c2:
+            if index.party_column:
+                party = st.selectbox(index.party_column, ["الكل"] + index.parties(), key=f"report_party_{report_type}")
+                if party != "الكل":
+                    filters["party"] = party
+        with c3:
+            if index.has_status:
+                status = st.selectbox("الحالة", ["الكل"] + index.statuses(), key=f"report_status_{report_type}")
+                if status != "الكل":
+                    filters["status"] = status
+
+        selection = index.select(**filters)
+        count = index.count(selection)
+        metrics.note_rows(count)
+        total_amount = index.total(selection)
+
+        p1, p2 = st.columns(2)
+        with p1:
+            page_size = st.selectbox("عدد الصفوف في الصفحة", REPORT_PAGE_SIZES, key=f"report_page_size_{report_type}")
+        pages = max(1, -(-count // page_size))
+        with p2:
+            page = st.number_input(f"الصفحة (من {pages:,})", min_value=1, max_value=pages, value=1, step=1, key=f"report_page_{report_type}")
+
+        # نرسل صفحة واحدة فقط إلى المتصفح
+        df_display = index.rows(selection, (page - 1) * page_size, page_size).copy()
+        # أسعار الصرف الحالية دون انتظار؛ التحديث (إن لزم) يجري في الخلفية
+        rates = currency_rates.rates()
+        if report_type in REGISTRY_SHEETS:
+            # الرصيد الحالي من فهرس الأرصدة بدل القيمة المحفوظة في السجل
+            df_display = registry_with_balances(df_display, self.balances(REGISTRY_SHEETS[report_type]).balances(rates))
         if "المبلغ" in df_display.columns:
-            df_display['المبلغ'] = pd.to_numeric(df_display['المبلغ'], errors='coerce').fillna(0)
-
+            if "العملة" in df_display.columns:
+                df_display[f'المبلغ ({BASE_CURRENCY})'] = convert_to_base(df_display, rates).round(2)
+            df_display['المبلغ'] = as_amounts(df_display['المبلغ']).fillna(0)
         st.dataframe(df_display, use_container_width=True)
-        total_amount = df_display['المبلغ'].sum() if 'المبلغ' in df_display.columns else 0
-        count = len(df_display)
 
+        by_currency = index.totals_by_currency(selection) if "المبلغ" in df_display.columns else {}
         c1, c2 = st.columns(2)
         with c1:
-            st.metric("عدد المعاملات", count)
+            st.metric("عدد المعاملات", f"{count:,}")
         with c2:
-            st.metric("إجمالي المبلغ", f"{total_amount:,.2f} ريال")
-
-        csv = df_display.to_csv(index=False, encoding='utf-8-sig')
-        st.download_button(
-            label="📥 تحميل التقرير كملف CSV",
-            data=csv,
-            file_name=f"{report_type}_report.csv",
-            mime="text/csv",
-            key=f"download_{report_type}"
-        )
+            if set(by_currency) - {BASE_CURRENCY}:
+                total_base, missing = totals_in_base(by_currency, rates)
+                st.metric(f"إجمالي المبلغ ({BASE_CURRENCY})", f"{total_base:,.2f}")
+                if missing:
+                    st.warning(f"لا تتوفر أسعار صرف بعد لـ: {'، '.join(missing)} — لم تُحتسب في الإجمالي")
+            else:
+                st.metric("إجمالي المبلغ", f"{total_amount:,.2f} ريال")
+
+        # ملف CSV يُبنى فقط عند طلبه
+        if st.button("📄 تجهيز ملف CSV", key=f"prepare_csv_{report_type}"):
+            selected = index.rows(selection)
+            st.download_button(
+                label="📥 تحميل التقرير كملف CSV",
+                data=storage_frame(selected).to_csv(index=False, encoding='utf-8-sig'),
+                file_name=f"{report_type}_report.csv",
+                mime="text/csv",
+                key=f"download_{report_type}"
+            )
+
+    def balances(self, sheet_name):
+        """فهرس أرصدة الأطراف للورقة (تراكمي؛ لا يمسح القيود عند كل طلب)"""
+        if STORAGE_MODE == "sqlite" and sheet_name not in st.session_state.data.dirty():
+            return balance_index(sheet_name)
+        return balance_index(sheet_name, st.session_state.data.buffer(sheet_name))
+
+    @metrics.instrument()
+    def show_aging_report(self):
+        st.subheader("📒 أرصدة الأطراف وأعمار الذمم")
+        c1, c2 = st.columns(2)
+        with c1:
+            registry = st.radio("الذمم", list(REGISTRY_SHEETS), horizontal=True, key="aging_registry",
+                                format_func=lambda r: "مدينة (العملاء)" if r == "العملاء" else "دائنة (الموردين)")
+        with c2:
+            as_of = st.date_input("بتاريخ", datetime.now(), key="aging_date")
+        sheet_name = REGISTRY_SHEETS[registry]
+        if not self.sheet_size(sheet_name):
+            st.info(f"لا توجد قيود في {sheet_name} بعد.")
+            return
+
+        index = self.balances(sheet_name)
+        rates = currency_rates.rates()
+        aging = index.aging(as_of, rates)
+        metrics.note_rows(len(aging))
+        totals = aging[AGING_LABELS].sum() if not aging.empty else pd.Series(0.0, index=AGING_LABELS)
+        for column, label in zip(st.columns(len(AGING_LABELS)), AGING_LABELS):
+            with column:
+                st.metric(label, f"{totals[label]:,.2f} {BASE_CURRENCY}")
+        missing = index.missing_rates(rates)
+        if missing:
+            st.warning(f"لا تتوفر أسعار صرف بعد لـ: {'، '.join(missing)} — لم تُحتسب أرصدتها")
+
+        tab_aging, tab_balances = st.tabs(["أعمار الذمم المفتوحة", "الأرصدة حسب الطرف"])
+        with tab_aging:
+            st.dataframe(aging.round(2), use_container_width=True)
+        with tab_balances:
+            st.dataframe(index.balances(rates).round(2), use_container_width=True)
+
+        if st.button(f"💾 تحديث عمود الرصيد في {registry}", key="sync_balances_btn"):
+            ledger = st.session_state.data
+            ledger[registry] = registry_with_balances(ledger[registry], index.balances(rates))
+            self.save_data()
+
+    def journal_daily(self):
+        """المجاميع اليومية لليومية (من SQLite ما لم تعدّلها الجلسة، وإلا من فهرس المخزن)"""
+        if STORAGE_MODE == "sqlite" and JOURNAL_SHEET not in st.session_state.data.dirty():
+            return journal_daily()
+        return journal_daily(st.session_state.data.buffer(JOURNAL_SHEET))
+
+    @metrics.instrument()
+    def show_financial_statements(self):
+        st.subheader("📚 القوائم المالية من اليومية")
+        c1, c2 = st.columns(2)
+        with c1:
+            start = st.date_input("من", datetime.now().replace(month=1, day=1), key="statements_start")
+        with c2:
+            end = st.date_input("إلى", datetime.now(), key="statements_end")
+        daily = self.journal_daily()
+        metrics.note_rows(len(daily))
+        if daily.empty:
+            st.info("لا توجد أسطر في اليومية بعد — أضف معاملات أو أعد بناء اليومية من الأوراق الحالية.")
+        else:
+            statements = FinancialStatements(daily, currency_rates.rates())
+            if statements.missing_rates:
+                st.warning(f"لا تتوفر أسعار صرف بعد لـ: {'، '.join(statements.missing_rates)} — لم تُحتسب قيودها")
+            tab_trial, tab_income, tab_vat = st.tabs(["ميزان المراجعة", "قائمة الدخل", "إقرار ضريبة القيمة المضافة"])
+            with tab_trial:
+                trial = statements.trial_balance(start, end)
+                st.dataframe(trial, use_container_width=True)
+                debit, credit = trial["مدين"].sum(), trial["دائن"].sum()
+                if abs(debit - credit) < 0.01:
+                    st.success(f"✅ الميزان متوازن: {debit:,.2f} {BASE_CURRENCY}")
+                else:
+                    st.error(f"الميزان غير متوازن: مدين {debit:,.2f} — دائن {credit:,.2f}")
+            with tab_income:
+                st.dataframe(statements.income_statement(start, end), use_container_width=True)
+            with tab_vat:
+                st.dataframe(statements.vat_return(start, end), use_container_width=True)
+
+        with st.expander("🔒 إقفال فترة وإعادة بناء اليومية"):
+            through = closed_through()
+            st.caption(f"آخر إقفال: {through:%Y-%m-%d}" if through is not None else "لم تُقفل أي فترة بعد")
+            close_date = st.date_input("إقفال حتى", end, key="close_through")
+            if st.button("🔒 إقفال الفترة", key="close_period_btn"):
+                try:
+                    closed = close_period(close_date)
+                    st.success(f"✅ أُقفلت الفترة حتى {close_date:%Y-%m-%d} ({closed:,} سطر نُقل إلى الأرشيف)")
+                except Exception as e:
+                    st.error(f"تعذر الإقفال: {e}")
+            if st.button("🔁 إعادة بناء اليومية من الأوراق", key="rebuild_journal_btn"):
+                ledger = st.session_state.data
+                ledger[JOURNAL_SHEET] = rebuild_journal(ledger)
+                self.save_data()
 
     # -------------------------
     # التحليل والرسوم
     # -------------------------
+    @metrics.instrument()
     def show_analysis_page(self):
         st.title("📈 التحليل المالي التفاعلي")
+        labels = list(CHART_GRANULARITIES.keys())
+        granularity = st.radio("الدقة الزمنية", labels, index=labels.index("شهري"), horizontal=True, key="analysis_granularity")
         c1, c2, c3 = st.columns(3)
         with c1:
             if st.button("تحليل المبيعات", key="sales_analysis_btn"):
-                self.create_chart("المبيعات")
+                st.session_state.analysis_chart = "المبيعات"
         with c2:
             if st.button("تحليل المصروفات", key="expenses_analysis_btn"):
-                self.create_chart("المصروفات")
+                st.session_state.analysis_chart = "المصروفات"
         with c3:
             if st.button("مقارنة الإيرادات", key="comparison_btn"):
-                self.create_comparison_chart()
+                st.session_state.analysis_chart = "comparison"
+
+        # الرسم المختار يبقى معروضًا عبر إعادة التشغيل حتى يعيد تغيير النطاق أو الدقة تجميعه
+        chart = st.session_state.get("analysis_chart")
+        if not chart:
+            return
+        sheets = ["المبيعات", "المشتريات"] if chart == "comparison" else [chart]
+        start, end = self.chart_range(sheets, key=f"analysis_range_{chart}")
+        if chart == "comparison":
+            self.create_comparison_chart(granularity, start, end)
+        else:
+            self.create_chart(chart, granularity, start, end)
+
+    def chart_range(self, sheet_names, key):
+        """منزلق النطاق الزمني بين أول قيد وآخره؛ تضييقه هو التكبير: يعيد التجميع على الخادم بدقة أدق
+        (Streamlit لا يعيد أحداث التكبير في Plotly، فالتكبير داخل الرسم يبقى على النقاط المرسلة)"""
+        bounds = []
+        for sheet_name in sheet_names:
+            if sheet_name not in st.session_state.data or not self.sheet_size(sheet_name):
+                continue
+            if STORAGE_MODE == "sqlite" and sheet_name not in st.session_state.data.dirty():
+                sheet_bounds = sqlite_ledger.chart_bounds(sheet_name)
+            else:
+                sheet_bounds = st.session_state.data.buffer(sheet_name).index("rollup", RollupIndex).bounds()
+            if sheet_bounds:
+                bounds.append(sheet_bounds)
+        if not bounds:
+            return None, None
+        first = min(b[0] for b in bounds).date()
+        last = max(b[1] for b in bounds).date()
+        if first >= last:
+            return None, None
+        return st.slider("النطاق الزمني", min_value=first, max_value=last, value=(first, last), key=key)
+
+    def rollup(self, sheet_name, granularity="شهري", start=None, end=None):
+        """سلسلة المجاميع المسبقة للورقة من فهرسها التراكمي"""
+        if sheet_name not in st.session_state.data:
+            return RollupIndex.empty()
+        if STORAGE_MODE == "sqlite" and sheet_name not in st.session_state.data.dirty():
+            # التجميع داخل القاعدة؛ لا يعود إلا صف لكل فترة
+            rolled = sqlite_ledger.rollup(sheet_name, GRANULARITIES[granularity][0], start, end)
+            return rolled.astype({'المبلغ': float, 'العدد': 'int64'}) if not rolled.empty else RollupIndex.empty()
+        index = st.session_state.data.buffer(sheet_name).index("rollup", RollupIndex)
+        return index.series(GRANULARITIES[granularity][0], start, end)
+
+    def chart_points(self, sheet_name, start=None, end=None):
+        """نقطة لكل قيد في النطاق مقلّصة إلى ميزانية النقاط، مع عدد قيود النطاق"""
+        if sheet_name not in st.session_state.data or not self.sheet_size(sheet_name):
+            return pd.DataFrame({'التاريخ': pd.Series(dtype='datetime64[ns]'), 'المبلغ': pd.Series(dtype=float)}), 0
+        if STORAGE_MODE == "sqlite" and sheet_name not in st.session_state.data.dirty():
+            return sqlite_ledger.chart_points(sheet_name, start, end)
+        return st.session_state.data.buffer(sheet_name).index("chart", ChartIndex).points(start, end)
+
+    def figure_cache(self, sheet_name):
+        """ذاكرة رسوم الورقة؛ تُفرغ مع أي إدراج فيها"""
+        if STORAGE_MODE == "sqlite" and sheet_name not in st.session_state.data.dirty():
+            return sqlite_ledger.figure_cache(sheet_name)
+        return st.session_state.data.buffer(sheet_name).index("chart", ChartIndex).figures
+
+    def resolve_granularity(self, sheet_names, granularity, start=None, end=None):
+        """رمز الدقة الفعلي؛ "تلقائي" يختار أدق دقة يسع فيها مجموع قيود الأوراق في النطاق ميزانية النقاط"""
+        code = CHART_GRANULARITIES[granularity][0]
+        if code != "auto":
+            return code
+        daily = [d for d in (self.rollup(s, "يومي", start, end) for s in sheet_names) if not d.empty]
+        if not daily:
+            return "D"
+        first = min(d['الفترة'].iloc[0] for d in daily)
+        last = max(d['الفترة'].iloc[-1] for d in daily)
+        return chart_granularity(first, last, sum(int(d['العدد'].sum()) for d in daily))
+
+    def chart_series(self, sheet_name, code, start=None, end=None):
+        """(إطار الفترة والمبلغ، عدد نقاط المصدر)؛ السلاسل الأطول من ميزانية النقاط تُقلّص مع حفظ شكلها"""
+        if code == "T":
+            points, count = self.chart_points(sheet_name, start, end)
+            return points.rename(columns={'التاريخ': 'الفترة'}), count
+        rolled = self.rollup(sheet_name, GRANULARITY_LABELS[code], start, end)[['الفترة', 'المبلغ']]
+        if len(rolled) > CHART_POINT_BUDGET:
+            times = pd.to_datetime(rolled['الفترة']).to_numpy().astype('int64')
+            return rolled.iloc[decimate(times, rolled['المبلغ'].to_numpy())].reset_index(drop=True), len(rolled)
+        return rolled, len(rolled)
+
+    @staticmethod
+    def chart_trace(series, code, name, color, webgl=None):
+        """عمود لكل فترة في السلاسل القصيرة؛ الطويلة أو المقلّصة أو كل قيد تُرسم بـ WebGL"""
+        if webgl is None:
+            webgl = code == "T" or len(series) > CHART_WEBGL_MIN_POINTS
+        if not webgl:
+            return go.Bar(x=series['الفترة'], y=series['المبلغ'], name=name, marker_color=color)
+        return go.Scattergl(
+            x=pd.to_datetime(series['الفترة']), y=series['المبلغ'], name=name,
+            mode='markers' if code == "T" else 'lines', marker_color=color
+        )
 
-    def create_chart(self, data_type):
-        df = st.session_state.data.get(data_type, pd.DataFrame()).copy()
-        if df.empty:
+    @metrics.instrument()
+    def create_chart(self, data_type, granularity="شهري", start=None, end=None):
+        if data_type not in st.session_state.data or not self.sheet_size(data_type):
             st.warning("لا توجد بيانات للرسم")
             return
 
-        df['التاريخ'] = pd.to_datetime(df['التاريخ'], errors='coerce')
-        df['المبلغ'] = pd.to_numeric(df['المبلغ'], errors='coerce').fillna(0)
-        df = df.dropna(subset=['التاريخ'])
-        if df.empty:
+        metrics.note_rows(self.sheet_size(data_type))
+        key = ("chart", granularity, start, end, CHART_POINT_BUDGET)
+        fig = self.figure_cache(data_type).get(key, lambda: self.build_chart(data_type, granularity, start, end))
+        if fig is None:
             st.warning("لا توجد تواريخ صالحة للرسم")
             return
-
-        df['الشهر'] = df['التاريخ'].dt.to_period('M').astype(str)
-        monthly = df.groupby('الشهر')['المبلغ'].sum().reset_index()
-        fig = px.bar(monthly, x='الشهر', y='المبلغ', title=f'{data_type} الشهرية', color_discrete_sequence=[excel_color])
-        fig.update_layout(xaxis_title="الشهر", yaxis_title="المبلغ", xaxis_tickangle=-45)
-        st.plotly_chart(fig, use_container_width=True)
-
-    def create_comparison_chart(self):
-        sales = st.session_state.data.get("المبيعات", pd.DataFrame()).copy()
-        purchases = st.session_state.data.get("المشتريات", pd.DataFrame()).copy()
-        if sales.empty and purchases.empty:
+        with metrics.span("plotly_render"):
+            st.plotly_chart(fig, use_container_width=True)
+
+    def build_chart(self, data_type, granularity="شهري", start=None, end=None):
+        code = self.resolve_granularity([data_type], granularity, start, end)
+        series, count = self.chart_series(data_type, code, start, end)
+        if series.empty:
+            return None
+        _, axis_title, title_suffix = CHART_GRANULARITIES[GRANULARITY_LABELS[code]]
+        title = f'{data_type} {title_suffix}'
+        if len(series) < count:
+            title += f' ({len(series):,} نقطة تمثل {count:,})'
+        fig = go.Figure(self.chart_trace(series, code, data_type, excel_color))
+        fig.update_layout(title=title, xaxis_title=axis_title, yaxis_title="المبلغ", xaxis_tickangle=-45)
+        return fig
+
+    @metrics.instrument()
+    def create_comparison_chart(self, granularity="شهري", start=None, end=None):
+        sheets = [s for s in ("المبيعات", "المشتريات") if s in st.session_state.data and self.sheet_size(s)]
+        if not sheets:
             st.warning("لا توجد بيانات للمقارنة")
             return
 
-        for df in (sales, purchases):
-            if not df.empty:
-                df['التاريخ'] = pd.to_datetime(df['التاريخ'], errors='coerce')
-                df['المبلغ'] = pd.to_numeric(df['المبلغ'], errors='coerce').fillna(0)
-
-        sales = sales.dropna(subset=['التاريخ'])
-        purchases = purchases.dropna(subset=['التاريخ'])
-
-        if not sales.empty:
-            sales['الشهر'] = sales['التاريخ'].dt.to_period('M').astype(str)
-            monthly_sales = sales.groupby('الشهر')['المبلغ'].sum().reset_index()
-        else:
-            monthly_sales = pd.DataFrame(columns=['الشهر', 'المبلغ'])
-
-        if not purchases.empty:
-            purchases['الشهر'] = purchases['التاريخ'].dt.to_period('M').astype(str)
-            monthly_purchases = purchases.groupby('الشهر')['المبلغ'].sum().reset_index()
-        else:
-            monthly_purchases = pd.DataFrame(columns=['الشهر', 'المبلغ'])
-
-        comparison = pd.merge(monthly_sales, monthly_purchases, on='الشهر', how='outer', suffixes=('_مبيعات', '_مشتريات')).fillna(0)
+        # يُحفظ الرسم مع ذاكرة المبيعات، ورقم تفريغ ذاكرة المشتريات جزء من مفتاحه
+        caches = [self.figure_cache(s) for s in sheets]
+        key = ("comparison", tuple(sheets), granularity, start, end, CHART_POINT_BUDGET, tuple(c.generation for c in caches[1:]))
+        fig = caches[0].get(key, lambda: self.build_comparison_chart(sheets, granularity, start, end))
+        if fig is None:
+            st.warning("لا توجد بيانات للمقارنة")
+            return
+        with metrics.span("plotly_render"):
+            st.plotly_chart(fig, use_container_width=True)
+
+    def build_comparison_chart(self, sheets, granularity="شهري", start=None, end=None):
+        code = self.resolve_granularity(sheets, granularity, start, end)
+        series = {s: self.chart_series(s, code, start, end)[0] for s in sheets}
+        if all(frame.empty for frame in series.values()):
+            return None
+        _, axis_title, _ = CHART_GRANULARITIES[GRANULARITY_LABELS[code]]
+        colors = {"المبيعات": excel_color, "المشتريات": chatgpt_color}
         fig = go.Figure()
-        fig.add_trace(go.Bar(x=comparison['الشهر'], y=comparison['المبلغ_مبيعات'], name='المبيعات', marker_color=excel_color))
-        fig.add_trace(go.Bar(x=comparison['الشهر'], y=comparison['المبلغ_مشتريات'], name='المشتريات', marker_color=chatgpt_color))
-        fig.update_layout(title='مقارنة المبيعات والمشتريات', xaxis_title="الشهر", yaxis_title="المبلغ", xaxis_tickangle=-45, barmode='group')
-        st.plotly_chart(fig, use_container_width=True)
+        if code != "T" and all(len(frame) <= CHART_WEBGL_MIN_POINTS for frame in series.values()):
+            # أعمدة متجاورة لكل فترة كما كانت، بفترات موحدة بين الورقتين
+            periods = sorted(set().union(*(frame['الفترة'] for frame in series.values())))
+            for sheet_name, frame in series.items():
+                amounts = frame.set_index('الفترة')['المبلغ'].reindex(periods, fill_value=0)
+                fig.add_trace(go.Bar(x=periods, y=amounts, name=sheet_name, marker_color=colors[sheet_name]))
+        else:
+            for sheet_name, frame in series.items():
+                fig.add_trace(self.chart_trace(frame, code, sheet_name, colors[sheet_name], webgl=True))
+        fig.update_layout(title='مقارنة المبيعات والمشتريات', xaxis_title=axis_title, yaxis_title="المبلغ", xaxis_tickangle=-45, barmode='group')
+        return fig
 
     # -------------------------
     # الإعدادات والربط
     # -------------------------
+    @metrics.instrument()
     def show_settings_page(self):
         st.title("⚙️ إعدادات النظام والربط الخارجي")
         st.subheader("إعدادات الربط")
-        st.info("💱 أسعار العملات: محدث تلقائياً (محاكاة)")
-        st.info("🏦 الربط البنكي: غير مفعل (محاكاة)")
+        self.show_rates_status()
+        result = st.session_state.get("reconciliation")
+        if result:
+            st.info(f"🏦 الربط البنكي: آخر كشف مستورد {result['lines']:,} حركة، طوبق منها {len(result['matches']):,}")
+        else:
+            st.info("🏦 الربط البنكي: استيراد كشوف CSV/OFX ومطابقتها من صفحة التدقيق والمطابقة")
         st.checkbox("🔄 التحديث التلقائي", value=True, key="auto_update")
 
         c1, c2, c3 = st.columns(3)
@@ -531,64 +893,271 @@ class AccountingAIApp:
             if st.button("🔗 اختبار الاتصالات", key="test_connections_btn"):
                 self.test_connections()
         with c3:
+            export_format = st.selectbox("صيغة التصدير", list(EXPORT_FORMATS.keys()), key="export_format")
             if st.button("📤 تصدير البيانات", key="export_data_btn"):
-                self.export_data()
+                self.export_data(export_format)
+
+        self.show_base_currency_totals()
+        self.show_ledger_import()
+
+    def show_ledger_import(self):
+        """استيراد دفتر تاريخي من نظام آخر؛ الملفات الكبيرة جدًا تُستورد بواجهة الأوامر (import-ledger)"""
+        with st.expander("📥 استيراد دفتر تاريخي (CSV أو Excel)"):
+            sheet_name = st.selectbox("الورقة الهدف", LEDGER_IMPORT_SHEETS, key="ledger_import_sheet")
+            uploaded = st.file_uploader("ملف الدفتر", type=['csv', 'xlsx'], key="ledger_import_uploader")
+            if uploaded and st.button("بدء الاستيراد", key="ledger_import_btn"):
+                self.import_ledger(uploaded, sheet_name)
+
+            result = st.session_state.get("ledger_import")
+            if result and result["stats"]["rejected"] and os.path.exists(result["rejects_path"]):
+                with open(result["rejects_path"], "rb") as f:
+                    st.download_button(f"📥 الصفوف المرفوضة ({result['stats']['rejected']:,})", data=f.read(),
+                                       file_name=f"{result['sheet']}.rejected.csv", mime="text/csv", key="ledger_rejects_download")
+
+    @metrics.instrument()
+    def import_ledger(self, uploaded_file, sheet_name):
+        """قراءة الملف المرفوع على دفعات، والتحقق منها في مجموعة عمليات، وإضافة كل دفعة مقبولة فور جاهزيتها"""
+        start = time.perf_counter()
+        progress = st.progress(0.0, text="جاري الاستيراد...")
+        size = uploaded_file.size or 0
+        streamed = uploaded_file.name.lower().endswith(".csv") and size
+
+        def report(stats):
+            done = stats["imported"] + stats["rejected"]
+            # موضع القراءة في الملف تقريب كافٍ للتقدم في CSV؛ مصنف XLSX لا يُعرف عدد صفوفه مسبقًا
+            fraction = min(uploaded_file.tell() / size, 1.0) if streamed else 0.0
+            progress.progress(fraction, text=f"تمت معالجة {done:,} صف (مرفوض {stats['rejected']:,})...")
+
+        fd, rejects_path = tempfile.mkstemp(suffix=".rejected.csv")
+        os.close(fd)
+        try:
+            stats = import_ledger_file(uploaded_file, sheet_name, name=uploaded_file.name, rejects_path=rejects_path,
+                                       write=self.write_frames, progress=report)
+        except Exception as e:
+            progress.empty()
+            st.error(f"فشل الاستيراد: {e}")
+            return
+        progress.progress(1.0, text="اكتمل الاستيراد")
+        previous = st.session_state.get("ledger_import")
+        if previous and previous["rejects_path"] != rejects_path and os.path.exists(previous["rejects_path"]):
+            os.remove(previous["rejects_path"])
+        st.session_state.ledger_import = {"sheet": sheet_name, "stats": stats, "rejects_path": rejects_path}
+
+        elapsed = time.perf_counter() - start
+        st.success(f"✅ تم استيراد {stats['imported']:,} صف إلى {sheet_name} في {elapsed:.2f} ث "
+                   f"({stats['rows'] / elapsed if elapsed else 0:,.0f} صف/ثانية)")
+        if stats["rejected"]:
+            st.warning(f"رُفض {stats['rejected']:,} صف ولم يُضف؛ حمّلها من الزر أدناه لتصحيحها وإعادة استيرادها")
+            st.dataframe(pd.DataFrame(list(stats["reasons"].items()), columns=["سبب الرفض", "العدد"]), use_container_width=True)
+
+    def show_rates_status(self):
+        status = currency_rates.status()
+        if status["fetched_at"] is None:
+            st.info(f"💱 أسعار العملات: لم تُجلب بعد{' (جارٍ الجلب...)' if status['refreshing'] else ''}")
+        else:
+            freshness = "قديمة، جارٍ التحديث" if status["refreshing"] else ("قديمة" if status["stale"] else "محدثة")
+            st.info(f"💱 أسعار العملات ({status['currencies']} عملة مقابل {status['base']}): {freshness} — آخر جلب {status['fetched_at']:%Y-%m-%d %H:%M}")
+        if status["error"]:
+            st.warning(f"آخر محاولة لجلب الأسعار فشلت: {status['error']}")
+
+    def show_base_currency_totals(self):
+        """إجمالي كل ورقة معاملات بالعملة الأساسية، محسوب من مجاميع كل عملة"""
+        rates = currency_rates.rates()
+        rows = []
+        for sheet_name in PARTY_SHEETS:
+            if not self.sheet_size(sheet_name):
+                continue
+            source = self.report_index(sheet_name)
+            by_currency = source.totals_by_currency(source.select())
+            total_base, missing = totals_in_base(by_currency, rates)
+            rows.append({"الورقة": sheet_name, f"الإجمالي ({BASE_CURRENCY})": round(total_base, 2),
+                         "العملات": "، ".join(sorted(by_currency)), "بلا سعر": "، ".join(missing)})
+        if rows:
+            st.subheader("الإجماليات بالعملة الأساسية")
+            st.dataframe(pd.DataFrame(rows), use_container_width=True)
 
     def update_external_data(self):
-        with st.spinner("جاري تحديث البيانات..."):
-            time.sleep(1.2)
-            st.success("✅ تم تحديث البيانات (محاكاة)")
+        # التحديث يجري في الخلفية؛ الصفحة لا تنتظره وتعرض النتيجة عند إعادة الرسم التالية
+        currency_rates.refresh()
+        st.success("🔄 بدأ تحديث أسعار العملات في الخلفية")
 
     def test_connections(self):
-        with st.spinner("جاري اختبار الاتصالات..."):
-            time.sleep(1.2)
-            st.success("✅ اختبار الاتصالات ناجح (محاكاة)")
-
-    def export_data(self):
+        status = currency_rates.status()
+        if status["error"]:
+            st.error(f"❌ مزود أسعار العملات: {status['error']}")
+        elif status["fetched_at"] is not None:
+            st.success(f"✅ مزود أسعار العملات متصل (آخر جلب {status['fetched_at']:%H:%M:%S})")
+        else:
+            currency_rates.refresh()
+            st.info("⏳ جارٍ الاتصال بمزود أسعار العملات في الخلفية؛ أعد المحاولة بعد لحظات")
+
+    @metrics.instrument()
+    def export_data(self, export_format="Excel"):
+        """تصدير متدفق إلى ملف مؤقت على القرص ثم تقديم التنزيل منه، فلا تُبنى نسخة كاملة في الذاكرة"""
+        writer, file_name, mime = EXPORT_FORMATS[export_format]
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(file_name)[1])
+        os.close(fd)
         try:
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                for sheet_name, df in st.session_state.data.items():
-                    df.to_excel(writer, sheet_name=sheet_name, index=False)
-            data_bytes = output.getvalue()
-            st.download_button(
-                label="📥 تحميل البيانات كملف Excel",
-                data=data_bytes,
-                file_name="accounting_data_export.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                key="download_excel"
-            )
+            with st.spinner("جاري تجهيز ملف التصدير..."):
+                writer(st.session_state.data, path)
+            with open(path, "rb") as f:
+                st.download_button(
+                    label=f"📥 تحميل البيانات ({export_format})",
+                    data=f,
+                    file_name=file_name,
+                    mime=mime,
+                    key="download_excel"
+                )
             st.success("✅ تم تجهيز الملف للتنزيل")
+        except ImportError as e:
+            st.error(f"صيغة {export_format} تتطلب مكتبة غير مثبتة: {e.name}")
         except Exception as e:
             st.error(f"فشل التصدير: {e}")
+        finally:
+            os.remove(path)
+
+    # -------------------------
+    # التشخيص والأداء
+    # -------------------------
+    def show_diagnostics_page(self):
+        st.title("🩺 التشخيص والأداء")
+        metrics.profiling = st.checkbox("التقاط cProfile لكل تفاعل", value=metrics.profiling, key="profile_interactions")
+
+        summary = metrics.summary()
+        if not summary:
+            st.info("لا توجد قياسات بعد؛ تنقّل بين الصفحات ثم عد إلى هنا.")
+        else:
+            table = pd.DataFrame(summary).rename(columns={
+                "operation": "العملية", "count": "العدد", "p50_ms": "p50 (مللي ث)", "p95_ms": "p95 (مللي ث)",
+                "max_ms": "الأقصى (مللي ث)", "rows": "الصفوف", "rss_mb": "الذاكرة (MB)", "max_rss_delta_mb": "أكبر زيادة ذاكرة (MB)",
+            })
+            st.dataframe(table.sort_values("p95 (مللي ث)", ascending=False).round(2), use_container_width=True)
+
+        c1, c2, c3 = st.columns(3)
+        with c1:
+            if st.button("💾 كتابة ملف Prometheus", key="write_metrics_btn"):
+                try:
+                    st.success(f"✅ تمت الكتابة إلى {metrics.write_prometheus(METRICS_PATH)}")
+                except OSError as e:
+                    st.error(f"تعذرت كتابة الملف: {e}")
+        with c2:
+            st.download_button("📥 تحميل القياسات (Prometheus)", data=metrics.prometheus_text(),
+                               file_name="accounting_metrics.prom", mime="text/plain", key="download_metrics")
+        with c3:
+            if st.button("🧹 تصفير القياسات", key="reset_metrics_btn"):
+                metrics.reset()
+
+        self.show_parse_cache_stats()
+
+        for profile in metrics.profiles():
+            with st.expander(f"cProfile — {profile['operation']} ({profile['seconds'] * 1000:,.0f} مللي ث، {profile['time']:%H:%M:%S})"):
+                st.code(profile["stats"])
+
+    def show_parse_cache_stats(self):
+        """إحصاءات ذاكرة التحليل: كم طلبًا أُجيب دون استدعاء المحلل"""
+        st.subheader("ذاكرة التحليل")
+        stats = parse_cache.stats()
+        c1, c2, c3, c4 = st.columns(4)
+        with c1:
+            st.metric("نسبة الإصابة", f"{stats['hit_rate']:.0%}")
+        with c2:
+            st.metric("من الذاكرة", f"{stats['hits']:,}")
+        with c3:
+            st.metric("تحليل جديد", f"{stats['misses']:,}")
+        with c4:
+            st.metric("المدخلات المحفوظة", f"{stats['entries']:,} / {stats['size']:,}")
+        st.caption(f"تُحفظ في {parse_cache.path}" if parse_cache.path else "في الذاكرة فقط (ACCOUNTING_PARSE_CACHE_PATH غير محدد)")
+        if st.button("🧹 تفريغ ذاكرة التحليل", key="clear_parse_cache_btn"):
+            parse_cache.clear()
 
     # -------------------------
     # التدقيق والمطابقة
     # -------------------------
+    @metrics.instrument()
     def show_audit_page(self):
         st.title("🔍 تدقيق المحاسبة واكتشاف الأخطاء")
+        mode = st.radio("نوع التدقيق", list(AUDIT_MODES), format_func=AUDIT_MODES.get, horizontal=True, key="audit_mode",
+                        help="كشف الشذوذ يقارن كل قيد بخط أساس طرفه (الدرجة المعيارية المتينة، قانون بنفورد، طفرات التكرار) "
+                             "ولا يمر في التدقيق التالي إلا بالقيود الجديدة")
         if st.button("▶️ بدء عملية التدقيق", key="start_audit_btn"):
-            self.run_audit()
+            self.run_audit(mode)
+        st.divider()
+        self.show_reconciliation()
 
-    def run_audit(self):
+    @metrics.instrument()
+    def run_audit(self, mode="rules"):
         with st.spinner("جاري تدقيق البيانات..."):
-            time.sleep(2.0)
-            results = {
-                "status": "تم التدقيق",
-                "issues_found": [
-                    {
-                        "type": "تناقض",
-                        "description": "مثال: رصيد مدين لا يساوي الرصيد الدائن لقيد معين (محاكاة)",
-                        "suggestion": "مراجعة القيد رقم JV-XXXX"
-                    }
-                ],
-                "recommendations": [
-                    "مراجعة دليل الحسابات",
-                    "التأكد من توازن قيود اليومية"
-                ]
-            }
+            if STORAGE_MODE == "sqlite" and not st.session_state.data.dirty():
+                results = SqliteAuditEngine(mode=mode).run()
+            else:
+                results = AuditEngine(mode=mode).run(st.session_state.data)
+            metrics.note_rows(results.get('rows_checked', 0))
             self.display_audit_results(results)
 
+    def audit_data(self):
+        """التدقيق السريع من صفحة الإدخال"""
+        self.run_audit()
+
+    @metrics.instrument()
+    def show_reconciliation(self):
+        st.subheader("🏦 مطابقة كشف الحساب البنكي")
+        uploaded = st.file_uploader("كشف الحساب (CSV أو OFX)", type=["csv", "ofx", "qfx"], key="bank_statement")
+        c1, c2, c3 = st.columns(3)
+        with c1:
+            window = st.slider("نافذة التاريخ (أيام)", 0, 15, RECONCILE_WINDOW_DAYS, key="reconcile_window")
+        with c2:
+            tolerance = st.slider("سماح المبلغ للمطابقة بالاسم (%)", 0.0, 10.0, RECONCILE_AMOUNT_TOLERANCE * 100, 0.5, key="reconcile_tolerance")
+        with c3:
+            fuzzy = st.checkbox("مطابقة تقريبية بالاسم", value=True, key="reconcile_fuzzy")
+
+        if uploaded is not None and st.button("🔗 مطابقة الكشف بالدفتر", key="reconcile_btn"):
+            try:
+                statement = read_bank_statement(uploaded.getvalue(), uploaded.name)
+            except ValueError as e:
+                st.error(f"تعذرت قراءة الكشف: {e}")
+                return
+            engine = ReconciliationEngine(window, tolerance / 100, fuzzy=fuzzy, rates=currency_rates.rates())
+            with st.spinner("جاري المطابقة..."):
+                result = engine.run(statement, st.session_state.data)
+            metrics.note_rows(result["lines"] + result["entries"])
+            st.session_state.reconciliation = result
+
+        result = st.session_state.get("reconciliation")
+        if result:
+            self.display_reconciliation(result)
+
+    def display_reconciliation(self, result):
+        matches = result["matches"]
+        c1, c2, c3, c4 = st.columns(4)
+        c1.metric("حركات الكشف", f"{result['lines']:,}")
+        c2.metric("مطابقة", f"{len(matches):,}")
+        c3.metric("حركات بلا مقابل", f"{len(result['unmatched']):,}")
+        c4.metric("قيود مفتوحة بلا مطابقة", f"{result['entries_left']:,}")
+        st.caption("، ".join(f"{method}: {count:,}" for method, count in result["by_method"].items())
+                   + f" — زمن المطابقة {result['timings']['الإجمالي']:.2f} ث")
+
+        tab_matches, tab_unmatched = st.tabs(["المطابقات", "حركات بلا مقابل"])
+        with tab_matches:
+            st.dataframe(matches.head(1000), use_container_width=True)
+        with tab_unmatched:
+            st.dataframe(result["unmatched"].head(1000), use_container_width=True)
+        if matches.empty:
+            return
+        st.download_button("📥 تحميل المطابقات (CSV)", data=storage_frame(matches).to_csv(index=False).encode('utf-8-sig'),
+                           file_name="reconciliation.csv", mime="text/csv", key="download_reconciliation")
+
+        if st.button(f"✅ اعتماد المطابقات ونقل {len(matches):,} قيد إلى \"{SETTLED_STATUS}\"", key="settle_matches_btn"):
+            ledger = st.session_state.data
+            try:
+                frames = settle_matches(ledger, matches)
+            except ValueError as e:
+                st.error(str(e))
+                return
+            for sheet_name, df in frames.items():
+                ledger[sheet_name] = df
+            self.save_data()
+            st.session_state.reconciliation = None
+
     def display_audit_results(self, results):
         st.subheader("نتائج التدقيق")
         st.write(f"**حالة التدقيق:** {results.get('status','')}")
@@ -597,10 +1166,20 @@ class AccountingAIApp:
             for issue in results['issues_found']:
                 st.write(f"- **{issue.get('type','')}**: {issue.get('description','')}")
                 st.write(f"  اقتراح: {issue.get('suggestion','')}")
+                sample = issue.get('sample')
+                if sample is not None and not sample.empty:
+                    with st.expander(f"عينة من القيود ({len(sample)})"):
+                        st.dataframe(sample, use_container_width=True)
         if results.get('recommendations'):
             st.write("**التوصيات:**")
             for rec in results['recommendations']:
                 st.write(f"- {rec}")
+        if results.get('timings'):
+            st.write(f"**زمن الفحوصات** ({results.get('rows_checked', 0):,} قيد):")
+            st.dataframe(
+                pd.DataFrame({"الفحص": list(results['timings'].keys()), "الزمن (ث)": [round(v, 3) for v in results['timings'].values()]}),
+                use_container_width=True
+            )
 
         # زر تصدير تقرير نصي
         audit_text = "نتائج تدقيق النظام المحاسبي\n" + "="*50 + "\n\n"
@@ -613,13 +1192,19 @@ class AccountingAIApp:
             audit_text += "التوصيات:\n"
             for rec in results['recommendations']:
                 audit_text += f"- {rec}\n"
+        if results.get('timings'):
+            audit_text += "\nزمن الفحوصات:\n"
+            for name, seconds in results['timings'].items():
+                audit_text += f"- {name}: {seconds:.3f} ث\n"
 
         st.download_button(label="📄 تحميل تقرير التدقيق", data=audit_text, file_name="audit_report.txt", mime="text/plain", key="download_audit")
 
 
 if __name__ == "__main__":
-    app = AccountingAIApp()
-    app.run()
+    # كل إعادة تشغيل للسكربت تفاعل واحد يُقاس (ويُلتقط له cProfile عند تفعيله)
+    with metrics.span("interaction"):
+        app = AccountingAIApp()
+        app.run()
 
 
 
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+واجهة أوامر نظام المحاسبة للسكربتات ومهام cron، دون Streamlit.
+
+أمثلة:
+    python accounting_cli.py import transactions.txt
+    python accounting_cli.py import-ledger sales_2019_2023.xlsx المبيعات --rejects rejected.csv
+    python accounting_cli.py report المبيعات --start 2024-01-01 --end 2024-03-31 --status معلقة -o sales.csv
+    python accounting_cli.py aging العملاء --today 2024-12-31
+    python accounting_cli.py reconcile statement.ofx --window 5 --apply -o matches.csv
+    python accounting_cli.py statements trial --start 2024-01-01 --end 2024-12-31
+    python accounting_cli.py statements vat --start 2024-10-01 --end 2024-12-31 -o vat.csv
+    python accounting_cli.py close-period 2023-12-31
+    python accounting_cli.py export --format "CSV (zip)" -o ledger.zip
+    python accounting_cli.py audit --json
+    python accounting_cli.py audit --anomalies
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+# accounting_core يقرأ نمط التخزين عند استيراده، لذا يُستورد داخل main بعد ضبط الخيارات
+core = None
+
+
+def cmd_import(args):
+    started = time.perf_counter()
+    with open(args.file, "rb") as stream:
+        frames, stats = core.import_transaction_lines(
+            stream, args.chunk_size,
+            progress=None if args.quiet else lambda total: print(f"\rتمت معالجة {total:,} سطر...", end="", file=sys.stderr)
+        )
+    try:
+        for sheet_name in core.POSTING_RULES:
+            if sheet_name in frames:
+                core.check_open_period(frames[sheet_name]["التاريخ"])
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    for sheet_name, df in frames.items():
+        if not df.empty:
+            core.append_rows(sheet_name, df)
+    if not args.quiet:
+        print(file=sys.stderr)
+    elapsed = time.perf_counter() - started
+    imported = stats["total"] - stats["unclassified"]
+    print(f"تم استيراد {imported:,} معاملة من {stats['total']:,} سطر في {elapsed:.2f} ث")
+    for sheet_name, df in frames.items():
+        print(f"  {sheet_name}: {len(df):,}")
+    print(f"  ضريبة القيمة المضافة: {stats['vat_total']:,.2f} ريال")
+    if stats["unclassified"]:
+        print(f"  {stats['unclassified']:,} سطر غير محدد النوع لم يُضف")
+    return 0
+
+
+def cmd_import_ledger(args):
+    started = time.perf_counter()
+    try:
+        stats = core.import_ledger_file(
+            args.file, args.sheet, rejects_path=args.rejects, chunk_size=args.chunk_size or core.LEDGER_IMPORT_CHUNK_SIZE,
+            workers=args.workers or core.LEDGER_IMPORT_WORKERS,
+            excel_sheet=args.excel_sheet,
+            progress=None if args.quiet else lambda s: print(
+                f"\rتمت معالجة {s['imported'] + s['rejected']:,} صف (مرفوض {s['rejected']:,})...", end="", file=sys.stderr)
+        )
+    except (ValueError, ImportError) as e:
+        print(e, file=sys.stderr)
+        return 2
+    core.sheet_writer.flush()
+    if not args.quiet:
+        print(file=sys.stderr)
+    elapsed = time.perf_counter() - started
+    print(f"تم استيراد {stats['imported']:,} صف إلى {args.sheet} من {stats['rows']:,} في {elapsed:.2f} ث "
+          f"({stats['rows'] / elapsed if elapsed else 0:,.0f} صف/ثانية)")
+    if stats["rejected"]:
+        print(f"  رُفض {stats['rejected']:,} صف، كُتبت إلى {stats['rejects_path']}:")
+        for reason, count in stats["reasons"].items():
+            print(f"    {reason}: {count:,}")
+    return 0
+
+
+def cmd_report(args):
+    if args.sheet not in core.SHEET_COLUMNS:
+        print(f"ورقة غير معروفة: {args.sheet} (المتاح: {'، '.join(core.SHEET_COLUMNS)})", file=sys.stderr)
+        return 2
+    source = core.report_source(args.sheet)
+    filters = {key: getattr(args, key) for key in ("start", "end", "party", "status") if getattr(args, key)}
+    selection = source.select(**filters)
+    count = source.count(selection)
+    rows = source.rows(selection, 0, args.limit)
+    if args.output:
+        core.storage_frame(rows).to_csv(args.output, index=False, encoding='utf-8-sig')
+    else:
+        print(rows.to_string(index=False))
+    out = sys.stderr if not args.output else sys.stdout
+    by_currency = source.totals_by_currency(selection)
+    if set(by_currency) - {core.BASE_CURRENCY}:
+        total, missing = core.totals_in_base(by_currency, wait_for_rates())
+        print(f"عدد المعاملات: {count:,} — إجمالي المبلغ: {total:,.2f} {core.BASE_CURRENCY}", file=out)
+        if missing:
+            print(f"  عملات بلا سعر لم تُحتسب: {'، '.join(missing)}", file=out)
+    else:
+        print(f"عدد المعاملات: {count:,} — إجمالي المبلغ: {source.total(selection):,.2f} ريال", file=out)
+    return 0
+
+
+def wait_for_rates():
+    """أسعار الصرف بعد انتظار الجلب؛ السكربت يستطيع الانتظار بخلاف الواجهة"""
+    try:
+        core.currency_rates.refresh().result(core.RATES_TIMEOUT + 1)
+    except Exception as e:
+        print(f"تعذر جلب أسعار الصرف: {e}", file=sys.stderr)
+    return core.currency_rates.rates()
+
+
+def cmd_aging(args):
+    index = core.balance_index(core.REGISTRY_SHEETS[args.registry])
+    rates = wait_for_rates() if index.missing_rates({core.BASE_CURRENCY: 1.0}) else None
+    table = index.aging(args.today, rates) if not args.balances else index.balances(rates)
+    table = table.round(2)
+    missing = index.missing_rates(rates)
+    if missing:
+        print(f"عملات بلا سعر لم تُحتسب: {'، '.join(missing)}", file=sys.stderr)
+    if args.output:
+        table.to_csv(args.output, index=False, encoding='utf-8-sig')
+    else:
+        print(table.head(args.limit).to_string(index=False) if args.limit else table.to_string(index=False))
+    if not args.balances:
+        totals = table[core.AGING_LABELS].sum()
+        print("  ".join(f"{label}: {totals[label]:,.2f}" for label in core.AGING_LABELS) + f" {core.BASE_CURRENCY}",
+              file=sys.stderr if not args.output else sys.stdout)
+    return 0
+
+
+def cmd_reconcile(args):
+    started = time.perf_counter()
+    try:
+        with open(args.file, "rb") as stream:
+            statement = core.read_bank_statement(stream, args.file)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    ledger = core.Ledger(core.ledger_cache)
+    currencies = set()
+    for sheet_name in core.RECONCILE_SHEETS:
+        source = core.report_source(sheet_name)
+        currencies |= set(source.totals_by_currency(source.select()))
+    engine = core.ReconciliationEngine(
+        core.RECONCILE_WINDOW_DAYS if args.window is None else args.window,
+        core.RECONCILE_AMOUNT_TOLERANCE if args.tolerance is None else args.tolerance / 100,
+        fuzzy=not args.no_fuzzy,
+        rates=wait_for_rates() if currencies - {core.BASE_CURRENCY} else None,
+    )
+    result = engine.run(statement, ledger)
+    matches = result["matches"]
+    if args.output:
+        core.storage_frame(matches).to_csv(args.output, index=False, encoding='utf-8-sig')
+    print(f"تمت مطابقة {len(matches):,} من {result['lines']:,} حركة مع {result['entries']:,} قيد في {time.perf_counter() - started:.2f} ث")
+    for method, count in result["by_method"].items():
+        print(f"  {method}: {count:,}")
+    print(f"  حركات بلا مقابل: {len(result['unmatched']):,} — قيود مفتوحة بلا مطابقة: {result['entries_left']:,}")
+    if args.apply and not matches.empty:
+        for sheet_name, df in core.settle_matches(ledger, matches).items():
+            core.replace_rows(sheet_name, df)
+        print(f"تم نقل {len(matches):,} قيد إلى \"{core.SETTLED_STATUS}\"")
+    return 0
+
+
+def cmd_statements(args):
+    daily = core.journal_daily()
+    currencies = set(core.as_labels(daily["العملة"], core.BASE_CURRENCY))
+    statements = core.FinancialStatements(daily, wait_for_rates() if currencies - {core.BASE_CURRENCY} else None)
+    builder = {"trial": statements.trial_balance, "income": statements.income_statement, "vat": statements.vat_return}[args.statement]
+    table = builder(args.start, args.end)
+    if args.output:
+        table.to_csv(args.output, index=False, encoding='utf-8-sig')
+    else:
+        print(table.to_string(index=False))
+    if statements.missing_rates:
+        print(f"عملات بلا سعر لم تُحتسب: {'، '.join(statements.missing_rates)}", file=sys.stderr)
+    if args.statement == "trial":
+        debit, credit = table["مدين"].sum(), table["دائن"].sum()
+        print(f"مدين: {debit:,.2f} — دائن: {credit:,.2f} {core.BASE_CURRENCY}" + ("" if abs(debit - credit) < 0.01 else " (غير متوازن)"),
+              file=sys.stderr if not args.output else sys.stdout)
+    return 0
+
+
+def cmd_close_period(args):
+    try:
+        closed = core.close_period(args.through)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    print(f"أُقفلت الفترة حتى {args.through}: {closed:,} سطر نُقل إلى {core.JOURNAL_ARCHIVE_DIR}")
+    return 0
+
+
+def cmd_rebuild_journal(args):
+    lines = core.rebuild_journal(core.Ledger(core.ledger_cache))
+    core.replace_rows(core.JOURNAL_SHEET, lines)
+    print(f"أُعيد بناء اليومية: {len(lines):,} سطر")
+    return 0
+
+
+def cmd_export(args):
+    writer, file_name, _ = core.EXPORT_FORMATS[args.format]
+    output = args.output or file_name
+    started = time.perf_counter()
+    writer(core.Ledger(core.ledger_cache), output)
+    print(f"تم التصدير إلى {output} في {time.perf_counter() - started:.2f} ث")
+    return 0
+
+
+def cmd_audit(args):
+    mode = "anomalies" if args.anomalies else "rules"
+    if core.STORAGE_MODE == "sqlite":
+        results = core.SqliteAuditEngine(today=args.today, mode=mode).run()
+    else:
+        results = core.AuditEngine(today=args.today, mode=mode).run(core.Ledger(core.ledger_cache))
+    if args.json:
+        summary = dict(results, issues_found=[
+            {key: value for key, value in issue.items() if key != "sample"} for issue in results["issues_found"]
+        ])
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    else:
+        print(f"{results['status']} ({results['rows_checked']:,} صف)")
+        for issue in results["issues_found"]:
+            print(f"- {issue['type']}: {issue['description']}\n  اقتراح: {issue['suggestion']}")
+        for rec in results["recommendations"]:
+            print(f"* {rec}")
+    return 1 if results["issues_found"] and args.fail_on_issues else 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="accounting_cli.py", description="نظام المحاسبة الذكي — واجهة الأوامر")
+    parser.add_argument("--dir", default=".", help="مجلد ملفات الدفتر")
+    parser.add_argument("--mode", choices=["journal", "csv", "sqlite"], help="نمط التخزين (افتراضيًا ACCOUNTING_STORAGE_MODE)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("import", help="استيراد ملف أسطر معاملات (سطر لكل معاملة)")
+    p.add_argument("file")
+    p.add_argument("--chunk-size", type=int, default=50_000)
+    p.add_argument("-q", "--quiet", action="store_true")
+    p.set_defaults(handler=cmd_import)
+
+    p = commands.add_parser("import-ledger", help="استيراد دفتر CSV أو XLSX من نظام آخر على دفعات مع التحقق من كل صف")
+    p.add_argument("file")
+    p.add_argument("sheet", help="الورقة الهدف، مثل المبيعات أو العملاء")
+    p.add_argument("--rejects", help="ملف CSV للصفوف المرفوضة (افتراضيًا <الورقة>.rejected.csv)")
+    p.add_argument("--excel-sheet", help="ورقة المصنف في ملفات XLSX (افتراضيًا الورقة النشطة)")
+    p.add_argument("--chunk-size", type=int, default=None, help="صفوف كل دفعة (افتراضيًا ACCOUNTING_IMPORT_CHUNK_SIZE)")
+    p.add_argument("--workers", type=int, default=None, help="عمليات التحقق المتوازية (1 = دون مجموعة عمليات)")
+    p.add_argument("-q", "--quiet", action="store_true")
+    p.set_defaults(handler=cmd_import_ledger)
+
+    p = commands.add_parser("report", help="تقرير ورقة مع مرشحات")
+    p.add_argument("sheet")
+    p.add_argument("--start", help="YYYY-MM-DD")
+    p.add_argument("--end", help="YYYY-MM-DD")
+    p.add_argument("--party")
+    p.add_argument("--status")
+    p.add_argument("--limit", type=int, help="أقصى عدد صفوف في المخرج")
+    p.add_argument("-o", "--output", help="ملف CSV للصفوف المطابقة")
+    p.set_defaults(handler=cmd_report)
+
+    p = commands.add_parser("aging", help="أعمار الذمم المفتوحة (أو أرصدة الأطراف) بالعملة الأساسية")
+    p.add_argument("registry", nargs="?", default="العملاء", choices=["العملاء", "الموردين"])
+    p.add_argument("--today", help="تاريخ احتساب الأعمار (افتراضيًا اليوم)")
+    p.add_argument("--balances", action="store_true", help="أرصدة مفتوحة ومسددة لكل طرف بدل الأعمار")
+    p.add_argument("--limit", type=int, help="أقصى عدد أطراف في المخرج")
+    p.add_argument("-o", "--output", help="ملف CSV للجدول")
+    p.set_defaults(handler=cmd_aging)
+
+    p = commands.add_parser("reconcile", help="مطابقة كشف حساب بنكي (CSV أو OFX) بالقيود المفتوحة")
+    p.add_argument("file")
+    p.add_argument("--window", type=int, default=None, help="أقصى فرق بالأيام بين الحركة والقيد")
+    p.add_argument("--tolerance", type=float, default=None, help="سماح المبلغ للمطابقة بالاسم (٪)")
+    p.add_argument("--no-fuzzy", action="store_true", help="دون المطابقة التقريبية بالاسم")
+    p.add_argument("--apply", action="store_true", help="نقل القيود المطابقة إلى حالة التسوية وحفظها")
+    p.add_argument("-o", "--output", help="ملف CSV للمطابقات")
+    p.set_defaults(handler=cmd_reconcile)
+
+    p = commands.add_parser("statements", help="القوائم المالية من اليومية بالعملة الأساسية")
+    p.add_argument("statement", choices=["trial", "income", "vat"], help="ميزان المراجعة، قائمة الدخل، أو إقرار الضريبة")
+    p.add_argument("--start", help="YYYY-MM-DD")
+    p.add_argument("--end", help="YYYY-MM-DD")
+    p.add_argument("-o", "--output", help="ملف CSV للقائمة")
+    p.set_defaults(handler=cmd_statements)
+
+    p = commands.add_parser("close-period", help="إقفال اليومية حتى تاريخ وأرشفة أسطرها")
+    p.add_argument("through", help="YYYY-MM-DD")
+    p.set_defaults(handler=cmd_close_period)
+
+    p = commands.add_parser("rebuild-journal", help="إعادة بناء اليومية من أوراق المعاملات للفترة المفتوحة")
+    p.set_defaults(handler=cmd_rebuild_journal)
+
+    p = commands.add_parser("export", help="تصدير كل الأوراق")
+    p.add_argument("--format", default="CSV (zip)", choices=["Excel", "CSV (zip)", "Parquet (zip)"])
+    p.add_argument("-o", "--output")
+    p.set_defaults(handler=cmd_export)
+
+    p = commands.add_parser("audit", help="تدقيق الدفتر")
+    p.add_argument("--today", help="تاريخ المرجع للتدقيق (افتراضيًا اليوم)")
+    p.add_argument("--json", action="store_true")
+    p.add_argument("--anomalies", action="store_true", help="كشف الشذوذ الإحصائي بدل فحوصات القواعد")
+    p.add_argument("--fail-on-issues", action="store_true", help="رمز خروج 1 عند وجود مشكلات")
+    p.set_defaults(handler=cmd_audit)
+    return parser
+
+
+def main(argv=None):
+    global core
+    args = build_parser().parse_args(argv)
+    if args.mode:
+        os.environ["ACCOUNTING_STORAGE_MODE"] = args.mode
+    os.chdir(args.dir)
+    import accounting_core
+    core = accounting_core
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
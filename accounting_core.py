@@ -0,0 +1,4434 @@
+# accounting_core.py
+"""
+منطق الدفتر والتخزين والتحليل والتقارير والتدقيق والتصدير دون واجهة.
+
+يُستورد بسرعة: لا Streamlit ولا Plotly، وpandas/numpy/PIL تُحمّل عند أول استخدام فقط،
+فيمكن استخدامه من السكربتات ومهام cron وواجهة الأوامر accounting_cli.py.
+"""
+import re
+import io
+import os
+import atexit
+import json
+import time
+import dataclasses
+import functools
+import hashlib
+import importlib
+import itertools
+import math
+import multiprocessing
+import queue
+import sqlite3
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+
+class _LazyModule:
+    """وحدة تُستورد عند أول وصول لخاصية فيها، ثم تحل محل نفسها في هذا الملف"""
+
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+
+pd = _LazyModule("pandas", "pd")
+np = _LazyModule("numpy", "np")
+
+# أعمدة كل ورقة في الدفتر
+SHEET_COLUMNS = {
+    "المبيعات": ["التاريخ", "العميل", "المبلغ", "الوصف", "الحالة", "العملة"],
+    "المشتريات": ["التاريخ", "المورد", "المبلغ", "الوصف", "الحالة", "العملة"],
+    "المصروفات": ["التاريخ", "النوع", "المبلغ", "الوصف", "الحالة", "العملة"],
+    "العملاء": ["الاسم", "البريد", "الهاتف", "الرصيد"],
+    "الموردين": ["الاسم", "البريد", "الهاتف", "الرصيد"],
+    "القيود": ["رقم القيد", "التاريخ", "الحساب", "مدين", "دائن", "الضريبة", "العملة", "الوصف"],
+    "الأرصدة المقفلة": ["مقفلة حتى", "التاريخ", "الحساب", "العملة", "مدين", "دائن", "الضريبة", "الخاضع", "العدد"],
+}
+
+# الورقة ← عمود الطرف
+PARTY_COLUMNS = {"المبيعات": "العميل", "المشتريات": "المورد", "المصروفات": "النوع"}
+
+# أنواع الأعمدة في الذاكرة: تواريخ datetime64، مبالغ مقربة لأقرب هللة،
+# وأعمدة فئوية (category) للقيم التي تتكرر في كل صف
+DATE_COLUMNS = {"التاريخ", "مقفلة حتى"}
+AMOUNT_COLUMNS = {"المبلغ", "الرصيد", "مدين", "دائن", "الضريبة", "الخاضع"}
+CATEGORY_COLUMNS = {"العميل", "المورد", "النوع", "الحالة", "العملة", "الحساب"}
+# عدد الوحدات الصغرى (الهللات) في الوحدة؛ المجاميع تُحسب بأعداد صحيحة منها
+MINOR_UNITS = 100
+
+# نمط التخزين: "csv" (الافتراضي) ملف CSV كامل لكل ورقة يُكتب المعدل منه بالخلفية،
+# و"journal" (اختياري) يلحق كل قيد بسطر واحد ثم يطوي السجل في ملفات CSV نفسها بالخلفية،
+# و"sqlite" قاعدة بيانات مفهرسة تُنفذ فيها التصفية والتجميع
+STORAGE_MODE = os.environ.get("ACCOUNTING_STORAGE_MODE", "csv")
+JOURNAL_COMPACT_THRESHOLD = int(os.environ.get("ACCOUNTING_JOURNAL_COMPACT_THRESHOLD", "5000"))
+SQLITE_PATH = os.environ.get("ACCOUNTING_SQLITE_PATH", "accounting.db")
+SQLITE_POOL_SIZE = int(os.environ.get("ACCOUNTING_SQLITE_POOL_SIZE", "4"))
+# مهلة تجميع الكتابات المؤجلة في نمط csv (ثوانٍ): تعديلات الورقة خلالها تُكتب مرة واحدة
+WRITE_BEHIND_DELAY = float(os.environ.get("ACCOUNTING_WRITE_BEHIND_DELAY", "0.5"))
+
+# نسبة ضريبة القيمة المضافة
+VAT_RATE = 0.15
+
+# العملة الأساسية للتقارير؛ القيود بدون عمود العملة (البيانات القديمة) تُعد بها
+BASE_CURRENCY = os.environ.get("ACCOUNTING_BASE_CURRENCY", "SAR")
+
+
+def file_signature(paths):
+    """بصمة ملفات الورقة على القرص (الهوية، وقت التعديل، الحجم) لاكتشاف التغيير دون قراءتها"""
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append((path, None))
+    return tuple(signature)
+
+
+# -------------------------
+# السجل الإلحاقي (Journal)
+# -------------------------
+class LedgerJournal:
+    """سجل إلحاقي لكل ورقة: اللقطة هي ملف CSV المعتاد، وكل قيد جديد سطر JSON في ملف السجل"""
+
+    def __init__(self, directory=".", compact_threshold=JOURNAL_COMPACT_THRESHOLD):
+        self.directory = directory
+        self.compact_threshold = compact_threshold
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._compacting = set()
+        self._threads = set()
+        # دوال تُستدعى بعد كل تبديل ملفات لا يغيّر المحتوى المنطقي (sheet_name, before, after)
+        self.listeners = []
+
+    def paths(self, sheet_name):
+        return [self.snapshot_path(sheet_name), self.rotated_path(sheet_name), self.journal_path(sheet_name)]
+
+    def marker_path(self, sheet_name):
+        # هوية السجل المطوي واللقطة الناتجة عنه؛ تُكتب قبل تبديل اللقطة وتُحذف بعد حذف السجل المطوي
+        return os.path.join(self.directory, f"{sheet_name}.journal.folded.json")
+
+    @staticmethod
+    def _identity(stat):
+        return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+    def _already_folded(self, sheet_name, snapshot_stat, rotated_stat):
+        """هل السجل المطوي داخل اللقطة أصلًا؟ (انقطاع بين تبديل اللقطة وحذفه) — لا يُعاد تشغيله حينها"""
+        if snapshot_stat is None or rotated_stat is None:
+            return False
+        try:
+            with open(self.marker_path(sheet_name), encoding="utf-8") as f:
+                marker = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        return marker == {"snapshot": self._identity(snapshot_stat), "rotated": self._identity(rotated_stat)}
+
+    def snapshot_path(self, sheet_name):
+        return os.path.join(self.directory, f"{sheet_name}.csv")
+
+    def journal_path(self, sheet_name):
+        return os.path.join(self.directory, f"{sheet_name}.journal.jsonl")
+
+    def rotated_path(self, sheet_name):
+        # السجل أثناء الطي؛ يبقى على القرص إن انقطع الطي ليُطوى في المرة التالية
+        return os.path.join(self.directory, f"{sheet_name}.journal.compacting.jsonl")
+
+    def append(self, sheet_name, record):
+        """إلحاق قيد واحد بسطر واحد في سجل الورقة"""
+        self._write(sheet_name, json.dumps(record, ensure_ascii=False, default=str) + "\n", 1)
+
+    def append_frame(self, sheet_name, df):
+        """إلحاق دفعة صفوف بكتابة واحدة (سطر لكل صف)"""
+        if df.empty:
+            return
+        self._write(sheet_name, self._payload(df), len(df))
+
+    def append_frames(self, frames):
+        """إلحاق دفعات لعدة أوراق كوحدة واحدة (مثل القيد وأسطر يوميته): إن فشلت كتابة إحداها
+        تُقص سجلات ما كُتب قبلها إلى طولها السابق، فلا يبقى قيد بلا قيده المقابل"""
+        payloads = [(sheet_name, self._payload(df), len(df)) for sheet_name, df in frames.items() if not df.empty]
+        with self._lock:
+            written = []
+            try:
+                for sheet_name, payload, _ in payloads:
+                    path = self.journal_path(sheet_name)
+                    written.append((path, os.path.getsize(path) if os.path.exists(path) else None))
+                    self._append_payload(path, payload)
+            except BaseException:
+                for path, size in reversed(written):
+                    if size is None:
+                        if os.path.exists(path):
+                            os.remove(path)
+                        continue
+                    with open(path, "r+b") as f:
+                        f.truncate(size)
+                        f.flush()
+                        os.fsync(f.fileno())
+                raise
+            full = []
+            for sheet_name, _, count in payloads:
+                self._pending[sheet_name] = self._pending.get(sheet_name, 0) + count
+                if self._pending[sheet_name] >= self.compact_threshold:
+                    full.append(sheet_name)
+        for sheet_name in full:
+            self.compact_async(sheet_name)
+
+    @staticmethod
+    def _payload(df):
+        payload = storage_frame(df).to_json(orient="records", lines=True, force_ascii=False)
+        return payload if payload.endswith("\n") else payload + "\n"
+
+    @staticmethod
+    def _append_payload(path, payload):
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write(self, sheet_name, payload, count):
+        with self._lock:
+            self._append_payload(self.journal_path(sheet_name), payload)
+            self._pending[sheet_name] = self._pending.get(sheet_name, 0) + count
+            pending = self._pending[sheet_name]
+        if pending >= self.compact_threshold:
+            self.compact_async(sheet_name)
+
+    def read(self, sheet_name):
+        """قراءة اللقطة ثم إعادة تشغيل ذيل السجل فوقها"""
+        # نفتح الملفات تحت القفل فتبقى المقابض متسقة حتى لو استُبدلت الملفات أثناء القراءة
+        with self._lock:
+            handles = []
+            for path in self.paths(sheet_name):
+                try:
+                    handles.append(open(path, "rb"))
+                except FileNotFoundError:
+                    handles.append(None)
+            snapshot_fh, rotated_fh, journal_fh = handles
+            if snapshot_fh and rotated_fh and self._already_folded(
+                    sheet_name, os.fstat(snapshot_fh.fileno()), os.fstat(rotated_fh.fileno())):
+                rotated_fh.close()
+                rotated_fh = handles[1] = None
+        try:
+            if all(h is None for h in handles):
+                raise FileNotFoundError(self.snapshot_path(sheet_name))
+            base = pd.read_csv(snapshot_fh, encoding='utf-8-sig') if snapshot_fh else None
+            records = self._read_records(rotated_fh) + self._read_records(journal_fh)
+        finally:
+            for h in handles:
+                if h is not None:
+                    h.close()
+
+        with self._lock:
+            self._pending[sheet_name] = len(records)
+        return self._fold(sheet_name, base, records)
+
+    def compact(self, sheet_name):
+        """طي السجل في ملف اللقطة (كتابة مؤقتة ثم استبدال ذري)"""
+        with self._lock:
+            if sheet_name in self._compacting:
+                return
+            rotated = self.rotated_path(sheet_name)
+            rotation = None
+            cleanup = self._drop_folded(sheet_name)
+            if not os.path.exists(rotated):
+                if not os.path.exists(self.journal_path(sheet_name)):
+                    return
+                before = file_signature(self.paths(sheet_name))
+                os.replace(self.journal_path(sheet_name), rotated)
+                rotation = (before, file_signature(self.paths(sheet_name)))
+                self._pending[sheet_name] = 0
+            self._compacting.add(sheet_name)
+        for change in (cleanup, rotation):
+            if change:
+                self._notify(sheet_name, *change)
+        try:
+            snapshot = self.snapshot_path(sheet_name)
+            try:
+                base = pd.read_csv(snapshot, encoding='utf-8-sig')
+            except FileNotFoundError:
+                base = None
+            with open(rotated, "rb") as fh:
+                records = self._read_records(fh)
+            folded = self._fold(sheet_name, base, records)
+            tmp_path = snapshot + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8-sig", newline="") as f:
+                folded.to_csv(f, index=False)
+                f.flush()
+                os.fsync(f.fileno())
+            # العلامة تسبق تبديل اللقطة: إن انقطعت العملية قبل حذف السجل المطوي عرفت القراءة والطي التاليان
+            # أنه داخل اللقطة فلا يُضاف مرتين
+            self._write_marker(sheet_name, {"snapshot": self._identity(os.stat(tmp_path)),
+                                            "rotated": self._identity(os.stat(rotated))})
+            with self._lock:
+                before = file_signature(self.paths(sheet_name))
+                os.replace(tmp_path, snapshot)
+                os.remove(rotated)
+                os.remove(self.marker_path(sheet_name))
+                after = file_signature(self.paths(sheet_name))
+            self._notify(sheet_name, before, after)
+        finally:
+            with self._lock:
+                self._compacting.discard(sheet_name)
+
+    def _write_marker(self, sheet_name, marker):
+        path = self.marker_path(sheet_name)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(marker, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def _drop_folded(self, sheet_name):
+        """حذف سجل مطوي بقي بعد انقطاع وهو داخل اللقطة، مع علامته (تحت القفل)؛ يعيد (before, after) إن حُذف شيء"""
+        marker = self.marker_path(sheet_name)
+        if not os.path.exists(marker):
+            return None
+        snapshot, rotated = self.snapshot_path(sheet_name), self.rotated_path(sheet_name)
+        before = file_signature(self.paths(sheet_name))
+        if os.path.exists(snapshot) and os.path.exists(rotated) and self._already_folded(
+                sheet_name, os.stat(snapshot), os.stat(rotated)):
+            os.remove(rotated)
+        os.remove(marker)
+        after = file_signature(self.paths(sheet_name))
+        return (before, after) if after != before else None
+
+    def _notify(self, sheet_name, before, after):
+        for listener in list(self.listeners):
+            listener(sheet_name, before, after)
+
+    def replace(self, sheet_name, df):
+        """استبدال محتوى الورقة كاملًا بلقطة جديدة وإفراغ السجل"""
+        snapshot = self.snapshot_path(sheet_name)
+        tmp_path = snapshot + ".replace.tmp"
+        storage_frame(df).to_csv(tmp_path, index=False, encoding='utf-8-sig')
+        with self._lock:
+            if sheet_name in self._compacting:
+                os.remove(tmp_path)
+                raise RuntimeError(f"جارٍ طي سجل {sheet_name}، أعد المحاولة بعد قليل")
+            os.replace(tmp_path, snapshot)
+            for path in (self.rotated_path(sheet_name), self.journal_path(sheet_name), self.marker_path(sheet_name)):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._pending[sheet_name] = 0
+
+    def compact_async(self, sheet_name):
+        """تشغيل الطي في خيط خلفي حتى لا تتعطل الواجهة"""
+        thread = threading.Thread(target=self._compact_quietly, args=(sheet_name,), daemon=True)
+        with self._lock:
+            self._threads.add(thread)
+        thread.start()
+
+    def _compact_quietly(self, sheet_name):
+        try:
+            self.compact(sheet_name)
+        except Exception:
+            # يبقى السجل كما هو ويُعاد الطي لاحقًا
+            pass
+        finally:
+            with self._lock:
+                self._threads.discard(threading.current_thread())
+
+    def flush(self, timeout=None):
+        """انتظار عمليات الطي الجارية في الخلفية؛ يعيد True إن انتهت كلها"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                threads = list(self._threads)
+            if not threads:
+                return True
+            for thread in threads:
+                thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+                if thread.is_alive():
+                    return False
+
+    @staticmethod
+    def _read_records(fh):
+        if fh is None:
+            return []
+        records = []
+        for raw in fh:
+            raw = raw.strip()
+            if not raw:
+                continue
+            try:
+                records.append(json.loads(raw.decode("utf-8")))
+            except ValueError:
+                # سطر أخير مبتور بسبب انقطاع أثناء الكتابة — نتجاهله
+                continue
+        return records
+
+    @staticmethod
+    def _fold(sheet_name, base, records):
+        columns = SHEET_COLUMNS.get(sheet_name)
+        if base is None:
+            base = pd.DataFrame(columns=columns)
+        if columns:
+            # أعمدة الورقة المعتمدة ثم أي أعمدة إضافية في اللقطة: لقطة قديمة بلا عمود (مثل العملة)
+            # لا تُسقطه من القيود الجديدة عند القراءة ولا عند الطي
+            columns = columns + [c for c in base.columns if c not in columns]
+            base = base.reindex(columns=columns)
+        if not records:
+            return base
+        tail = pd.DataFrame(records)
+        if columns:
+            tail = tail.reindex(columns=columns)
+        if base.empty:
+            return tail
+        return pd.concat([base, tail], ignore_index=True)
+
+
+# سجل واحد مشترك لكل الجلسات داخل العملية؛ الطي الجاري يُنتظر عند الخروج
+ledger_journal = LedgerJournal()
+atexit.register(ledger_journal.flush)
+
+
+# -------------------------
+# قاعدة بيانات SQLite
+# -------------------------
+def quote_identifier(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def sql_day(column="التاريخ"):
+    """تعبير SQL لتاريخ اليوم من عمود نصي (NULL إن لم يكن تاريخًا صالحًا)"""
+    return f"date(substr({quote_identifier(column)}, 1, 10))"
+
+
+class SqlitePool:
+    """مجموعة صغيرة من اتصالات SQLite مشتركة بين الجلسات (وضع WAL: قراءات متزامنة مع كاتب واحد)"""
+
+    def __init__(self, path, size=SQLITE_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            conn = self._connect() if create else self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        """إغلاق الاتصالات الخاملة"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class SqliteLedger:
+    """تخزين الأوراق في SQLite بجداول تطابق أعمدة الأوراق وفهارس على التاريخ والطرف والحالة؛
+    التقارير والرسوم والتدقيق تُنفذ كاستعلامات بدل المسح الكامل في pandas"""
+
+    def __init__(self, path=SQLITE_PATH, pool_size=SQLITE_POOL_SIZE):
+        self.path = path
+        self.pool = SqlitePool(path, pool_size)
+        self._ready = False
+        self._lock = threading.Lock()
+        # الورقة ← (آخر rowid، عدد الصفوف، BalanceIndex أو AnomalyIndex أو FigureCache)
+        self._balances = {}
+        self._anomalies = {}
+        self._figures = {}
+        self._balances_lock = threading.Lock()
+
+    def open(self, path):
+        """توجيه الدفتر إلى ملف قاعدة آخر (مثلًا من واجهة الأوامر أو القياس)"""
+        with self._lock:
+            self.pool.close()
+            self.path = path
+            self.pool = SqlitePool(path, self.pool.size)
+            self._ready = False
+            self._balances.clear()
+            self._anomalies.clear()
+            self._figures.clear()
+
+    def paths(self):
+        return [self.path, self.path + "-wal"]
+
+    def ensure_schema(self, migrate=True):
+        """إنشاء الجداول والفهارس عند أول استخدام، مع ترحيل ملفات CSV الموجودة مرة واحدة"""
+        with self._lock:
+            if self._ready:
+                return
+            with self.pool.connection() as conn, conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS _meta (key TEXT PRIMARY KEY, value TEXT)")
+                for sheet_name, columns in SHEET_COLUMNS.items():
+                    definitions = ", ".join(
+                        f"{quote_identifier(c)} {'REAL' if c in AMOUNT_COLUMNS else 'INTEGER' if c == 'العدد' else 'TEXT'}" for c in columns
+                    )
+                    conn.execute(f"CREATE TABLE IF NOT EXISTS {quote_identifier(sheet_name)} ({definitions})")
+                    # أعمدة أضيفت للأوراق بعد إنشاء القاعدة (مثل العملة)
+                    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({quote_identifier(sheet_name)})")}
+                    for column in columns:
+                        if column not in existing:
+                            conn.execute(f"ALTER TABLE {quote_identifier(sheet_name)} ADD COLUMN {quote_identifier(column)} TEXT")
+                    for column in ("التاريخ", PARTY_COLUMNS.get(sheet_name), "الحالة", "الاسم"):
+                        if column in columns:
+                            conn.execute(
+                                f"CREATE INDEX IF NOT EXISTS {quote_identifier(f'idx_{sheet_name}_{column}')} "
+                                f"ON {quote_identifier(sheet_name)} ({quote_identifier(column)})"
+                            )
+                migrated = conn.execute("SELECT value FROM _meta WHERE key = 'csv_migrated'").fetchone()
+            if migrate and not migrated:
+                self.migrate_from_csv()
+            self._ready = True
+
+    def migrate_from_csv(self):
+        """ترحيل لمرة واحدة: لقطات CSV مع ذيل السجل الإلحاقي إلى الجداول الفارغة"""
+        counts = {}
+        for sheet_name in SHEET_COLUMNS:
+            try:
+                df = ledger_journal.read(sheet_name)
+            except FileNotFoundError:
+                continue
+            with self.pool.connection() as conn:
+                existing = conn.execute(f"SELECT COUNT(*) FROM {quote_identifier(sheet_name)}").fetchone()[0]
+            if existing == 0 and not df.empty:
+                if "المبلغ" in df.columns:
+                    df['المبلغ'] = pd.to_numeric(df['المبلغ'], errors='coerce')
+                self._insert(sheet_name, df)
+                counts[sheet_name] = len(df)
+        with self.pool.connection() as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO _meta (key, value) VALUES ('csv_migrated', ?)", (json.dumps(counts, ensure_ascii=False),))
+        return counts
+
+    def columns(self, sheet_name):
+        return SHEET_COLUMNS[sheet_name]
+
+    def read(self, sheet_name):
+        self.ensure_schema()
+        columns = ", ".join(quote_identifier(c) for c in self.columns(sheet_name))
+        with self.pool.connection() as conn:
+            return pd.read_sql_query(f"SELECT {columns} FROM {quote_identifier(sheet_name)} ORDER BY rowid", conn)
+
+    def append(self, sheet_name, record):
+        self.append_frame(sheet_name, pd.DataFrame([record]))
+
+    def append_frame(self, sheet_name, df):
+        """إدراج دفعة صفوف في معاملة واحدة"""
+        self.ensure_schema()
+        self._insert(sheet_name, df)
+
+    def append_frames(self, frames):
+        """إدراج دفعات لعدة جداول في معاملة واحدة (مثل القيد وأسطر يوميته): تُكتب كلها أو لا شيء"""
+        self.ensure_schema()
+        with self.pool.connection() as conn, conn:
+            for sheet_name, df in frames.items():
+                self._insert_rows(conn, sheet_name, df)
+
+    def _insert(self, sheet_name, df):
+        with self.pool.connection() as conn, conn:
+            self._insert_rows(conn, sheet_name, df)
+
+    def _insert_rows(self, conn, sheet_name, df):
+        if df.empty:
+            return
+        columns = self.columns(sheet_name)
+        frame = storage_frame(df.reindex(columns=columns))
+        rows = frame.astype(object).where(frame.notna(), None).itertuples(index=False, name=None)
+        placeholders = ", ".join("?" for _ in columns)
+        names = ", ".join(quote_identifier(c) for c in columns)
+        conn.executemany(f"INSERT INTO {quote_identifier(sheet_name)} ({names}) VALUES ({placeholders})", rows)
+
+    def replace(self, sheet_name, df):
+        """استبدال محتوى الجدول كاملًا"""
+        self.ensure_schema()
+        with self.pool.connection() as conn, conn:
+            conn.execute(f"DELETE FROM {quote_identifier(sheet_name)}")
+        self._insert(sheet_name, df)
+        with self._balances_lock:
+            self._balances.pop(sheet_name, None)
+            self._anomalies.pop(sheet_name, None)
+            self._figures.pop(sheet_name, None)
+
+    def query(self, sql, params=()):
+        self.ensure_schema()
+        with self.pool.connection() as conn:
+            return pd.read_sql_query(sql, conn, params=params)
+
+    def scalar(self, sql, params=()):
+        self.ensure_schema()
+        with self.pool.connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def count(self, sheet_name):
+        return self.scalar(f"SELECT COUNT(*) FROM {quote_identifier(sheet_name)}")[0]
+
+    def rollup(self, sheet_name, granularity="M", start=None, end=None):
+        """مجاميع المبالغ وعدد القيود لكل فترة (ضمن النطاق إن حُدد) محسوبة داخل SQLite"""
+        day = sql_day()
+        period = {
+            "D": day,
+            "W": f"date({day}, '-' || strftime('%w', {day}) || ' days')",
+            "M": f"substr({day}, 1, 7)",
+            "Y": f"substr({day}, 1, 4)",
+        }[granularity]
+        amount = quote_identifier('المبلغ')
+        where, params = self._day_range(start, end)
+        return self.query(
+            f"SELECT {period} AS 'الفترة', "
+            f"SUM(CASE WHEN typeof({amount}) IN ('integer', 'real') THEN {amount} ELSE 0 END) AS 'المبلغ', "
+            f"COUNT(*) AS 'العدد' FROM {quote_identifier(sheet_name)} "
+            f"WHERE {where} GROUP BY 1 ORDER BY 1",
+            params
+        )
+
+    @staticmethod
+    def _day_range(start=None, end=None):
+        day = sql_day()
+        where, params = [f"{day} IS NOT NULL"], []
+        if start is not None:
+            where.append(f"{day} >= ?")
+            params.append(pd.Timestamp(start).strftime("%Y-%m-%d"))
+        if end is not None:
+            where.append(f"{day} <= ?")
+            params.append(pd.Timestamp(end).strftime("%Y-%m-%d"))
+        return " AND ".join(where), tuple(params)
+
+    def chart_bounds(self, sheet_name):
+        """أول يوم وآخر يوم في الورقة (أو None)"""
+        day = sql_day()
+        first, last = self.scalar(f"SELECT MIN({day}), MAX({day}) FROM {quote_identifier(sheet_name)}")
+        return (pd.Timestamp(first), pd.Timestamp(last)) if first else None
+
+    def chart_points(self, sheet_name, start=None, end=None, budget=None):
+        """(إطار التاريخ والمبلغ لكل قيد في النطاق، عدد قيود النطاق)؛ إن تجاوز العدد ميزانية النقاط
+        قُلّص داخل القاعدة إلى أدنى وأعلى مبلغ في كل شريحة زمنية فلا يعود إلا بضعة آلاف صف"""
+        budget = budget or CHART_POINT_BUDGET
+        day, amount, table = sql_day(), quote_identifier('المبلغ'), quote_identifier(sheet_name)
+        where, params = self._day_range(start, end)
+        where += f" AND typeof({amount}) IN ('integer', 'real')"
+        count, first, last = self.scalar(f"SELECT COUNT(*), MIN({day}), MAX({day}) FROM {table} WHERE {where}", params)
+        if count <= budget:
+            points = self.query(f"SELECT {day} AS 'التاريخ', {amount} AS 'المبلغ' FROM {table} WHERE {where} ORDER BY 1", params)
+        else:
+            first = pd.Timestamp(first)
+            span = (pd.Timestamp(last) - first).days + 1
+            bucket = f"CAST((julianday({day}) - julianday(?)) * {max(budget // 2, 1)} / {span} AS INTEGER)"
+            # في SQLite يعيد MIN/MAX المنفرد بقية أعمدة الصف الذي حقق القيمة
+            points = pd.concat([
+                self.query(
+                    f"SELECT {day} AS 'التاريخ', {extreme}({amount}) AS 'المبلغ' FROM {table} WHERE {where} GROUP BY {bucket}",
+                    params + (first.strftime("%Y-%m-%d"),)
+                )
+                for extreme in ("MIN", "MAX")
+            ]).drop_duplicates().sort_values('التاريخ', kind='stable')
+        points['التاريخ'] = pd.to_datetime(points['التاريخ'])
+        points['المبلغ'] = points['المبلغ'].astype(float)
+        return points.reset_index(drop=True), int(count)
+
+    def figure_cache(self, sheet_name):
+        """ذاكرة الرسوم للورقة؛ تُستبدل بذاكرة فارغة متى تغيّر آخر rowid أو عدد الصفوف"""
+        last_rowid, count = self.scalar(f"SELECT MAX(rowid), COUNT(*) FROM {quote_identifier(sheet_name)}")
+        token = (last_rowid or 0, count or 0)
+        with self._balances_lock:
+            cached = self._figures.get(sheet_name)
+            if cached is None or cached[0] != token:
+                cached = (token, FigureCache())
+                self._figures[sheet_name] = cached
+            return cached[1]
+
+    def balances(self, sheet_name):
+        """فهرس أرصدة الورقة: يُبنى بتجميع واحد داخل القاعدة، ثم لا يُجمّع بعدها إلا ما أُدرج بعد آخر rowid"""
+        table = quote_identifier(sheet_name)
+        with self._balances_lock:
+            last_rowid, count = self.scalar(f"SELECT MAX(rowid), COUNT(*) FROM {table}")
+            last_rowid, count = last_rowid or 0, count or 0
+            cached = self._balances.get(sheet_name)
+            if cached is not None and (cached[0], cached[1]) == (last_rowid, count):
+                return cached[2]
+            if cached is not None and last_rowid >= cached[0] and count > cached[1]:
+                grouped = self._balance_groups(sheet_name, cached[0])
+                if cached[1] + int(grouped["count"].sum()) == count:
+                    cached[2]._merge(grouped)
+                    self._balances[sheet_name] = (last_rowid, count, cached[2])
+                    return cached[2]
+            # حذف أو استبدال من عملية أخرى: إعادة البناء بالكامل
+            index = BalanceIndex.from_aggregates(self._balance_groups(sheet_name), PARTY_COLUMNS[sheet_name])
+            self._balances[sheet_name] = (last_rowid, count, index)
+            return index
+
+    def anomalies(self, sheet_name):
+        """فهرس الشذوذ للورقة: يُبنى من أعمدة المبلغ والطرف والتاريخ مرة، ثم لا يُقرأ إلا ما أُدرج بعد آخر rowid"""
+        table = quote_identifier(sheet_name)
+        with self._balances_lock:
+            last_rowid, count = self.scalar(f"SELECT MAX(rowid), COUNT(*) FROM {table}")
+            last_rowid, count = last_rowid or 0, count or 0
+            cached = self._anomalies.get(sheet_name)
+            if cached is not None and (cached[0], cached[1]) == (last_rowid, count):
+                return cached[2]
+            if cached is not None and last_rowid >= cached[0] and count > cached[1]:
+                rows = self._anomaly_rows(sheet_name, cached[0])
+                if cached[1] + len(rows) == count:
+                    cached[2].add_frame(rows, ids=rows.pop("rid").to_numpy())
+                    self._anomalies[sheet_name] = (last_rowid, count, cached[2])
+                    return cached[2]
+            rows = self._anomaly_rows(sheet_name)
+            index = AnomalyIndex(rows, PARTY_COLUMNS[sheet_name], ids=rows.pop("rid").to_numpy())
+            self._anomalies[sheet_name] = (last_rowid, count, index)
+            return index
+
+    def _anomaly_rows(self, sheet_name, after_rowid=0):
+        columns = [c for c in ("التاريخ", PARTY_COLUMNS[sheet_name], "المبلغ", "العملة") if c in self.columns(sheet_name)]
+        return self.query(
+            f"SELECT rowid AS rid, {', '.join(quote_identifier(c) for c in columns)} FROM {quote_identifier(sheet_name)} "
+            f"WHERE rowid > ? ORDER BY rowid", (after_rowid,)
+        )
+
+    def journal_totals(self):
+        """مجاميع أسطر اليومية لكل (يوم، حساب، عملة) بالهللات محسوبة داخل القاعدة، بشكل journal_totals"""
+        debit, credit, tax = (f"COALESCE({quote_identifier(c)}, 0)" for c in ("مدين", "دائن", "الضريبة"))
+        minor = lambda expression: f"CAST(ROUND(({expression}) * {MINOR_UNITS}) AS INTEGER)"
+        frame = self.query(
+            f"SELECT {sql_day()} AS day, COALESCE({quote_identifier('الحساب')}, '') AS account, "
+            f"COALESCE(NULLIF({quote_identifier('العملة')}, ''), ?) AS currency, "
+            f"SUM({minor(debit)}) AS debit, SUM({minor(credit)}) AS credit, SUM({minor(tax)}) AS tax, "
+            f"SUM(CASE WHEN {tax} <> 0 THEN {minor(f'{debit} + {credit}')} ELSE 0 END) AS taxable, COUNT(*) AS count "
+            f"FROM {quote_identifier(JOURNAL_SHEET)} GROUP BY 1, 2, 3",
+            (BASE_CURRENCY,)
+        )
+        frame.columns = ["التاريخ", "الحساب", "العملة"] + JOURNAL_TOTALS
+        frame["التاريخ"] = as_dates(frame["التاريخ"])
+        return frame
+
+    def _balance_groups(self, sheet_name, after_rowid=0):
+        amount, status = quote_identifier('المبلغ'), quote_identifier('الحالة')
+        currency = f"COALESCE(NULLIF({quote_identifier('العملة')}, ''), ?)" if "العملة" in self.columns(sheet_name) else "?"
+        is_open = f"({status} IS ?)"
+        return self.query(
+            f"SELECT COALESCE({quote_identifier(PARTY_COLUMNS[sheet_name])}, '') AS party, {currency} AS currency, "
+            f"CASE WHEN {is_open} THEN {sql_day()} END AS day, {is_open} AS open, "
+            f"SUM(CASE WHEN typeof({amount}) IN ('integer', 'real') THEN CAST(ROUND({amount} * {MINOR_UNITS}) AS INTEGER) END) AS amount, "
+            f"COUNT(*) AS count FROM {quote_identifier(sheet_name)} WHERE rowid > ? GROUP BY 1, 2, 3, 4",
+            (BASE_CURRENCY, OPEN_STATUS, OPEN_STATUS, after_rowid)
+        )
+
+
+# قاعدة واحدة ومجموعة اتصالات واحدة لكل العملية
+sqlite_ledger = SqliteLedger()
+
+
+def sheet_paths(sheet_name):
+    """الملفات التي يُبنى منها محتوى الورقة حسب نمط التخزين"""
+    if STORAGE_MODE == "journal":
+        return ledger_journal.paths(sheet_name)
+    if STORAGE_MODE == "sqlite":
+        return sqlite_ledger.paths()
+    return [f"{sheet_name}.csv"]
+
+
+def stage_csv(df, path):
+    """كتابة الإطار إلى ملف مؤقت بجوار path (مع fsync)؛ يعيد دالة تستبدل به path ذريًا"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".csv.tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8-sig", newline="") as f:
+            storage_frame(df).to_csv(f, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return lambda: os.replace(tmp_path, path)
+
+
+def write_csv(df, path):
+    """كتابة ورقة CSV ذريًا: انقطاع أثناء الكتابة يترك الملف السابق كما هو لا ملفًا مبتورًا"""
+    stage_csv(df, path)()
+
+
+def append_csv(df, path):
+    """إلحاق صفوف بنهاية ملف CSV موجود بترتيب أعمدته دون إعادة كتابته (مع fsync)، فكلفة الدفعة تتبع حجمها
+    لا حجم الورقة؛ يعيد False إن لم يوجد الملف أو اختلفت أعمدته أو لم ينته بسطر كامل"""
+    try:
+        with open(path, "rb") as f:
+            header = f.readline().decode("utf-8-sig").rstrip("\r\n")
+            f.seek(-1, os.SEEK_END)
+            complete = f.read(1) == b"\n"
+    except (OSError, UnicodeDecodeError):
+        return False
+    columns = pd.read_csv(io.StringIO(header + "\n"), nrows=0).columns.tolist() if header else []
+    if not complete or sorted(columns) != sorted(df.columns):
+        return False
+    with open(path, "a", encoding="utf-8", newline="") as f:
+        storage_frame(df[columns]).to_csv(f, index=False, header=False)
+        f.flush()
+        os.fsync(f.fileno())
+    return True
+
+
+def append_rows(sheet_name, df):
+    """كتابة صفوف جديدة إلى القرص مباشرة حسب نمط التخزين (للسكربتات دون جلسة)"""
+    if STORAGE_MODE == "journal":
+        ledger_journal.append_frame(sheet_name, df)
+    elif STORAGE_MODE == "sqlite":
+        sqlite_ledger.append_frame(sheet_name, df)
+    else:
+        # الكتابات المؤجلة تُنجز أولًا حتى لا تُقرأ الورقة من القرص دونها
+        sheet_writer.flush()
+        path = f"{sheet_name}.csv"
+        if not append_csv(df, path):
+            current = storage_frame(read_sheet(sheet_name))
+            combined = pd.concat([current, storage_frame(df)], ignore_index=True) if not current.empty else storage_frame(df)
+            write_csv(combined, path)
+    ledger_cache.invalidate(sheet_name)
+
+
+def append_frames(frames):
+    """كتابة دفعات عدة أوراق (مثل القيود وأسطر يوميتها) حسب نمط التخزين: كتابة دائمة واحدة في نمطي journal وsqlite"""
+    frames = {sheet_name: df for sheet_name, df in frames.items() if not df.empty}
+    if STORAGE_MODE == "journal":
+        ledger_journal.append_frames(frames)
+    elif STORAGE_MODE == "sqlite":
+        sqlite_ledger.append_frames(frames)
+    else:
+        for sheet_name, df in frames.items():
+            append_rows(sheet_name, df)
+        return
+    for sheet_name in frames:
+        ledger_cache.invalidate(sheet_name)
+
+
+def replace_rows(sheet_name, df):
+    """استبدال محتوى الورقة على القرص كاملًا حسب نمط التخزين (للسكربتات دون جلسة)"""
+    if STORAGE_MODE == "journal":
+        ledger_journal.replace(sheet_name, df)
+    elif STORAGE_MODE == "sqlite":
+        sqlite_ledger.replace(sheet_name, df)
+    else:
+        sheet_writer.flush()
+        write_csv(df, f"{sheet_name}.csv")
+    ledger_cache.invalidate(sheet_name)
+
+
+def read_sheet(sheet_name):
+    """قراءة ورقة من القرص وتحويلها إلى الأنواع المعتمدة (typed_frame)"""
+    try:
+        if STORAGE_MODE == "journal":
+            df = ledger_journal.read(sheet_name)
+        elif STORAGE_MODE == "sqlite":
+            df = sqlite_ledger.read(sheet_name)
+        else:
+            df = pd.read_csv(f"{sheet_name}.csv", encoding='utf-8-sig')
+    except FileNotFoundError:
+        # لا يوجد ملف بعد — ورقة فارغة بالأعمدة المعتادة
+        return typed_frame(pd.DataFrame(columns=SHEET_COLUMNS.get(sheet_name)))
+    return typed_frame(df)
+
+
+# -------------------------
+# أنواع الأعمدة
+# -------------------------
+def as_dates(values):
+    """عمود التاريخ كـ datetime64؛ لا يُعاد تحليل عمود محوّل مسبقًا"""
+    values = pd.Series(values) if not isinstance(values, pd.Series) else values
+    if pd.api.types.is_datetime64_dtype(values.dtype):
+        return values
+    return pd.to_datetime(values.astype(object), errors='coerce', format='ISO8601')
+
+
+def as_amounts(values):
+    """عمود المبلغ كـ float64؛ لا يُعاد تحويل عمود رقمي مسبقًا"""
+    values = pd.Series(values) if not isinstance(values, pd.Series) else values
+    if pd.api.types.is_float_dtype(values.dtype):
+        return values
+    return pd.to_numeric(values, errors='coerce').astype(float)
+
+
+def as_labels(values, default=""):
+    """عمود نصي (فئوي أو object) كقيم object مع ملء الفارغ بالقيمة الافتراضية"""
+    values = pd.Series(values, dtype="object") if not isinstance(values, pd.Series) else values.astype(object)
+    return values.where(values.notna() & values.ne(""), default)
+
+
+def factorize_labels(values, default=""):
+    """(رموز صحيحة، القيم) لعمود نصي بعد ملء الفارغ بالقيمة الافتراضية؛
+    العمود الفئوي تُستخدم رموزه مباشرة دون تحويله إلى نصوص"""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        uniques = values.cat.categories.astype(object)
+        uniques = pd.Index(uniques.where(uniques != "", default).tolist() + [default], dtype=object)
+        codes = values.cat.codes.to_numpy().astype(np.int64)
+        return np.where(codes < 0, len(uniques) - 1, codes), uniques
+    codes, uniques = pd.factorize(as_labels(values, default))
+    return codes, pd.Index(uniques, dtype=object)
+
+
+def to_minor_units(amounts):
+    """المبالغ كأعداد صحيحة من الهللات (int64) لجمع دقيق؛ المبلغ المفقود يُعد صفرًا"""
+    values = np.asarray(amounts, dtype=float) * MINOR_UNITS
+    return np.rint(np.nan_to_num(values)).astype(np.int64)
+
+
+def typed_frame(df):
+    """فرض أنواع الأعمدة المعتمدة على إطار (عند التحميل والإدراج):
+    التاريخ datetime64، المبلغ float64 مقرب للهللة، والأطراف والنوع والحالة والعملة فئوية"""
+    df = df.copy(deep=False)
+    for column in df.columns:
+        if column in DATE_COLUMNS:
+            df[column] = as_dates(df[column])
+        elif column in AMOUNT_COLUMNS:
+            df[column] = as_amounts(df[column]).round(2)
+        elif column in CATEGORY_COLUMNS and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype("category")
+    return df
+
+
+def storage_frame(df):
+    """عكس typed_frame للكتابة على القرص: التواريخ نصوص YYYY-MM-DD (مع الوقت إن وُجد) والفئات نصوص"""
+    df = df.copy(deep=False)
+    for column in df.columns:
+        dtype = df[column].dtype
+        if pd.api.types.is_datetime64_dtype(dtype):
+            dates = df[column]
+            values = dates.to_numpy(dtype="datetime64[s]")
+            days = values.astype("datetime64[D]")
+            # np.datetime_as_string أسرع كثيرًا من dt.strftime، والوقت لا يُكتب إلا إن وُجد
+            with_time = bool((values[~np.isnat(values)] != days[~np.isnat(days)]).any())
+            text = pd.Series(np.datetime_as_string(values if with_time else days), index=df.index, dtype=object)
+            if with_time:
+                text = text.str.replace("T", " ", regex=False)
+            df[column] = text.where(dates.notna(), None)
+        elif isinstance(dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(object)
+    return df
+
+
+def concat_frames(parts):
+    """دمج أطر مطبوعة مع توحيد فئات الأعمدة الفئوية، حتى لا يعيدها pd.concat إلى object"""
+    parts = [p for p in parts if not p.empty] or parts[:1]
+    if len(parts) == 1:
+        return parts[0]
+    parts = [p.copy(deep=False) for p in parts]
+    for column in parts[0].columns:
+        if not all(isinstance(p[column].dtype, pd.CategoricalDtype) for p in parts):
+            continue
+        categories = parts[0][column].cat.categories
+        for p in parts[1:]:
+            categories = categories.append(p[column].cat.categories.difference(categories))
+        # الجزء الأول (الأكبر عادة) تُضاف إليه الفئات الجديدة في آخرها دون إعادة ترميز صفوفه
+        new = categories.difference(parts[0][column].cat.categories, sort=False)
+        if len(new):
+            parts[0][column] = parts[0][column].cat.add_categories(new)
+        for p in parts[1:]:
+            p[column] = p[column].cat.set_categories(categories)
+    return pd.concat(parts, ignore_index=True)
+
+
+# -------------------------
+# مخزن الإدراج
+# -------------------------
+class SheetBuffer:
+    """مخزن إدراج لورقة واحدة: الصف الجديد يُلحق بقوائم عمودية بكلفة ثابتة،
+    ولا يُبنى DataFrame إلا عند طلبه من تقرير أو رسم؛ كل ما يدخله يُحوّل إلى الأنواع المعتمدة (typed_frame)"""
+
+    def __init__(self, columns=None, df=None):
+        if df is None:
+            df = pd.DataFrame(columns=columns)
+        # أعمدة الورقة المعتمدة مع أعمدة الملف الإضافية؛ ملف قديم ينقصه عمود لا يُسقطه من الصفوف الجديدة
+        self.columns = list(columns or []) + [c for c in df.columns if c not in (columns or [])]
+        self._frame = typed_frame(df.reindex(columns=self.columns))
+        self._chunks = []
+        self._rows = {c: [] for c in self.columns}
+        self._row_count = 0
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._frame) + sum(len(c) for c in self._chunks) + self._row_count
+
+    def append(self, record):
+        """إلحاق صف واحد بكلفة ثابتة (مستهلكة)"""
+        with self._lock:
+            for c in self.columns:
+                self._rows[c].append(record.get(c))
+            self._row_count += 1
+            for index in self._indexes.values():
+                index.add_record(record)
+
+    def extend(self, df):
+        """إلحاق دفعة صفوف جاهزة كقطعة واحدة"""
+        if df is None or df.empty:
+            return
+        with self._lock:
+            self._flush_rows()
+            chunk = typed_frame(df.reindex(columns=self.columns))
+            self._chunks.append(chunk)
+            for index in self._indexes.values():
+                index.add_frame(chunk)
+
+    def frame(self):
+        """تجسيد الورقة كـ DataFrame؛ الإطار المعاد لا يتغير بإدراجات لاحقة"""
+        with self._lock:
+            return self._materialise()
+
+    def index(self, key, factory):
+        """فهرس مشتق من الورقة: يُبنى بمسح واحد عند أول طلب ثم يُحدّث مع كل إدراج دون مسح جديد"""
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None:
+                index = factory(self._materialise())
+                self._indexes[key] = index
+            return index
+
+    def _materialise(self):
+        self._flush_rows()
+        if self._chunks:
+            self._frame = concat_frames([self._frame] + self._chunks)
+            self._chunks = []
+        return self._frame
+
+    def _flush_rows(self):
+        if self._row_count:
+            self._chunks.append(typed_frame(pd.DataFrame(self._rows, columns=self.columns)))
+            self._rows = {c: [] for c in self.columns}
+            self._row_count = 0
+
+
+# -------------------------
+# فهرس المجاميع الزمنية
+# -------------------------
+# الدقة الزمنية ← (رمز الفترة، عنوان المحور، وصف الرسم)
+GRANULARITIES = {
+    "يومي": ("D", "اليوم", "اليومية"),
+    "أسبوعي": ("W", "الأسبوع", "الأسبوعية"),
+    "شهري": ("M", "الشهر", "الشهرية"),
+    "سنوي": ("Y", "السنة", "السنوية"),
+}
+
+
+class RollupIndex:
+    """مجموع المبالغ (بالهللات) وعدد القيود لكل يوم، يُحدّث تدريجيًا مع كل إدراج؛
+    السلاسل الأسبوعية والشهرية والسنوية تُشتق من جدول الأيام دون مسح الصفوف"""
+
+    def __init__(self, df, date_column="التاريخ", amount_column="المبلغ"):
+        self.date_column = date_column
+        self.amount_column = amount_column
+        self._daily = {}
+        self._lock = threading.Lock()
+        self.add_frame(df)
+
+    def add_frame(self, df):
+        if df is None or df.empty or self.date_column not in df.columns:
+            return
+        dates = as_dates(df[self.date_column])
+        amounts = pd.Series(to_minor_units(as_amounts(df[self.amount_column])) if self.amount_column in df.columns else 0, index=df.index)
+        valid = dates.notna()
+        grouped = amounts[valid].groupby(dates[valid].dt.normalize()).agg(['sum', 'count'])
+        with self._lock:
+            for day, total, count in zip(grouped.index, grouped['sum'].tolist(), grouped['count'].tolist()):
+                entry = self._daily.setdefault(day, [0, 0])
+                entry[0] += total
+                entry[1] += count
+
+    def add_record(self, record):
+        day = pd.to_datetime(record.get(self.date_column), errors='coerce')
+        if pd.isna(day):
+            return
+        amount = to_minor_units([pd.to_numeric(record.get(self.amount_column), errors='coerce')])[0]
+        with self._lock:
+            entry = self._daily.setdefault(day.normalize(), [0, 0])
+            entry[0] += int(amount)
+            entry[1] += 1
+
+    @staticmethod
+    def empty():
+        return pd.DataFrame({'الفترة': pd.Series(dtype=object), 'المبلغ': pd.Series(dtype=float), 'العدد': pd.Series(dtype='int64')})
+
+    def bounds(self):
+        """أول يوم وآخر يوم في الورقة (أو None)"""
+        with self._lock:
+            return (min(self._daily), max(self._daily)) if self._daily else None
+
+    def series(self, granularity="M", start=None, end=None):
+        """إطار (الفترة، المبلغ، العدد) بالدقة المطلوبة ضمن النطاق، بكلفة تتناسب مع عدد الأيام لا الصفوف"""
+        start = pd.Timestamp(start).normalize() if start is not None else None
+        end = pd.Timestamp(end).normalize() if end is not None else None
+        with self._lock:
+            days = sorted(
+                (day, entry) for day, entry in self._daily.items()
+                if (start is None or day >= start) and (end is None or day <= end)
+            )
+        if not days:
+            return self.empty()
+        daily = pd.DataFrame(
+            [(total / MINOR_UNITS, count) for _, (total, count) in days],
+            index=pd.DatetimeIndex([day for day, _ in days]),
+            columns=['المبلغ', 'العدد']
+        )
+        if granularity == "D":
+            labels = daily.index.strftime("%Y-%m-%d")
+        elif granularity == "W":
+            # الأسبوع من الأحد إلى السبت، ويُعرض بتاريخ بدايته
+            labels = daily.index.to_period('W-SAT').start_time.strftime("%Y-%m-%d")
+        else:
+            labels = daily.index.to_period(granularity).astype(str)
+        rolled = daily.groupby(labels, sort=True).sum()
+        rolled.index.name = 'الفترة'
+        return rolled.reset_index()
+
+
+# -------------------------
+# الرسوم القابلة للتوسع
+# -------------------------
+# أقصى عدد نقاط يُرسل إلى المتصفح لكل سلسلة (قرابة عرض الرسم بالبكسل مرتين)
+CHART_POINT_BUDGET = int(os.environ.get("ACCOUNTING_CHART_POINTS", "2000"))
+# فوق هذا العدد تُرسم السلسلة بـ WebGL (Scattergl) بدل SVG
+CHART_WEBGL_MIN_POINTS = 500
+CHART_CACHE_SIZE = 32
+AUTO_GRANULARITY = "تلقائي"
+TRANSACTION_GRANULARITY = "كل قيد"
+# دقتا صفحة التحليل الإضافيتان: اختيار أدق دقة تسعها ميزانية النقاط، أو نقطة لكل قيد
+CHART_GRANULARITIES = {
+    AUTO_GRANULARITY: ("auto", "التاريخ", "حسب النطاق"),
+    TRANSACTION_GRANULARITY: ("T", "التاريخ", "لكل قيد"),
+    **GRANULARITIES,
+}
+# رمز الدقة ← اسمها المعروض
+GRANULARITY_LABELS = {spec[0]: label for label, spec in CHART_GRANULARITIES.items()}
+# متوسط طول الفترة بالأيام لكل دقة
+PERIOD_DAYS = {"D": 1, "W": 7, "M": 30.44, "Y": 365.25}
+
+
+def decimate(x, y, budget=None):
+    """فهارس نقاط تحفظ شكل السلسلة ضمن ميزانية النقاط (M4): تُقسم محور x إلى شرائح متساوية،
+    ويُبقى من كل شريحة أول نقطة وآخرها وأدناها وأعلاها، فلا تضيع القمم التي تقع في بكسل واحد"""
+    budget = budget or CHART_POINT_BUDGET
+    y = np.asarray(y)
+    n = len(y)
+    if n <= budget:
+        return np.arange(n)
+    x = np.asarray(x).astype('float64')
+    edges = np.searchsorted(x, np.linspace(x[0], x[-1], max(budget // 4, 1) + 1)[1:-1], side='left')
+    starts = np.unique(np.concatenate(([0], edges)))
+    starts = starts[starts < n]
+    sizes = np.diff(np.append(starts, n))
+    bucket = np.repeat(np.arange(len(starts)), sizes)
+    keep = [starts, starts + sizes - 1]
+    for extreme in (np.minimum, np.maximum):
+        hits = np.flatnonzero(y == extreme.reduceat(y, starts)[bucket])
+        keep.append(hits[np.unique(bucket[hits], return_index=True)[1]])
+    return np.unique(np.concatenate(keep))
+
+
+def chart_granularity(first, last, rows, budget=None):
+    """أدق دقة تبقى بها نقاط النطاق ضمن الميزانية: كل قيد إن وسعته، وإلا أقصر فترة يسع عدد فتراتها"""
+    budget = budget or CHART_POINT_BUDGET
+    if rows <= budget:
+        return "T"
+    days = (pd.Timestamp(last) - pd.Timestamp(first)).days + 1
+    return next((code for code, length in PERIOD_DAYS.items() if days / length <= budget), "Y")
+
+
+_figure_generations = itertools.count()
+
+
+class FigureCache:
+    """ذاكرة LRU للرسوم الجاهزة بمفتاح (النطاق، الدقة، ...)؛ مالكها يفرغها عند أي إدراج في ورقته.
+    generation رقم فريد يتغير مع كل تفريغ، فيصلح جزءًا من مفتاح رسم يجمع أكثر من ورقة"""
+
+    def __init__(self, size=CHART_CACHE_SIZE):
+        self.size = size
+        self.generation = next(_figure_generations)
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, build):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+        value = build()
+        with self._lock:
+            self.misses += 1
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.generation = next(_figure_generations)
+
+
+class ChartIndex:
+    """تاريخ كل قيد ومبلغه (بالهللات) كمصفوفتين مرتبتين زمنيًا لعرض "كل قيد" بالبحث الثنائي،
+    مع ذاكرة الرسوم الجاهزة للورقة التي تُفرغ مع كل إدراج"""
+
+    def __init__(self, df, date_column="التاريخ", amount_column="المبلغ"):
+        self.date_column = date_column
+        self.amount_column = amount_column
+        self.figures = FigureCache()
+        self._times = np.empty(0, dtype='int64')
+        self._amounts = np.empty(0, dtype='int64')
+        self._chunks = []
+        self._lock = threading.Lock()
+        self.add_frame(df)
+
+    def add_frame(self, df):
+        if df is None or df.empty or self.date_column not in df.columns or self.amount_column not in df.columns:
+            return
+        dates = as_dates(df[self.date_column])
+        valid = dates.notna().to_numpy()
+        times = dates.to_numpy()[valid].astype('datetime64[ns]').astype('int64')
+        amounts = to_minor_units(as_amounts(df[self.amount_column]))[valid]
+        self._append(times, amounts)
+
+    def add_record(self, record):
+        day = pd.to_datetime(record.get(self.date_column), errors='coerce')
+        if pd.isna(day):
+            return
+        amount = to_minor_units([pd.to_numeric(record.get(self.amount_column), errors='coerce')])
+        self._append(np.array([day.value], dtype='int64'), amount)
+
+    def _append(self, times, amounts):
+        with self._lock:
+            self._chunks.append((times, np.asarray(amounts, dtype='int64')))
+        self.figures.clear()
+
+    def _arrays(self):
+        with self._lock:
+            if self._chunks:
+                # الدمج مؤجل حتى أول رسم؛ الترتيب المستقر سريع على سلسلة شبه مرتبة
+                times = np.concatenate([self._times] + [t for t, _ in self._chunks])
+                amounts = np.concatenate([self._amounts] + [a for _, a in self._chunks])
+                order = np.argsort(times, kind='stable')
+                self._times, self._amounts = times[order], amounts[order]
+                self._chunks = []
+            return self._times, self._amounts
+
+    def points(self, start=None, end=None, budget=None):
+        """(إطار التاريخ والمبلغ لكل قيد في النطاق مقلّصًا إلى الميزانية، عدد قيود النطاق)"""
+        times, amounts = self._arrays()
+        lo = np.searchsorted(times, pd.Timestamp(start).normalize().value, side='left') if start is not None else 0
+        hi = np.searchsorted(times, (pd.Timestamp(end).normalize() + pd.Timedelta(days=1)).value, side='left') if end is not None else len(times)
+        times, amounts = times[lo:hi], amounts[lo:hi]
+        keep = decimate(times, amounts, budget)
+        frame = pd.DataFrame({'التاريخ': pd.to_datetime(times[keep]), 'المبلغ': amounts[keep] / MINOR_UNITS})
+        return frame, int(hi - lo)
+
+
+# -------------------------
+# فهرس التقارير
+# -------------------------
+# عمود الطرف المستخدم في تصفية التقارير
+REPORT_PARTY_COLUMNS = dict(PARTY_COLUMNS, **{"العملاء": "الاسم", "الموردين": "الاسم"})
+REPORT_PAGE_SIZES = [25, 50, 100, 500]
+
+
+class ReportIndex:
+    """أعمدة التصفية محوّلة مسبقًا إلى مصفوفات (تاريخ، مبلغ بالهللات، رمز الطرف، رمز الحالة) بنفس ترتيب صفوف الورقة؛
+    تُلحق تدريجيًا مع كل إدراج، والتصفية والمجاميع تعمل عليها دون نسخ الورقة أو إعادة تحويلها"""
+
+    def __init__(self, df, party_column=None):
+        self.party_column = party_column
+        self.has_dates = "التاريخ" in df.columns
+        self.has_amounts = "المبلغ" in df.columns
+        self.has_status = "الحالة" in df.columns
+        self._party_codes = {}
+        self._status_codes = {}
+        self._chunks = []
+        self._arrays = None
+        self._lock = threading.Lock()
+        self.add_frame(df)
+
+    @staticmethod
+    def _encode(values, codes):
+        labels, uniques = factorize_labels(values)
+        uniques = uniques.astype(str)
+        mapping = np.array([codes.setdefault(u, len(codes)) for u in uniques], dtype=np.int64)
+        return mapping[labels] if len(uniques) else np.zeros(len(labels), dtype=np.int64)
+
+    def _column(self, df, name):
+        return df[name] if name and name in df.columns else pd.Series("", index=df.index, dtype="object")
+
+    def add_frame(self, df):
+        if df is None or df.empty:
+            return
+        dates = as_dates(df["التاريخ"]).to_numpy(dtype="datetime64[ns]") if self.has_dates else None
+        amounts = to_minor_units(as_amounts(df["المبلغ"])) if self.has_amounts else None
+        with self._lock:
+            parties = self._encode(self._column(df, self.party_column), self._party_codes)
+            statuses = self._encode(self._column(df, "الحالة"), self._status_codes)
+            self._chunks.append((dates, amounts, parties, statuses))
+
+    def add_record(self, record):
+        self.add_frame(pd.DataFrame([record]))
+
+    def _compact(self):
+        # دمج القطع المتراكمة في مصفوفات واحدة (مرة واحدة لكل دفعة إدراجات)
+        if self._chunks:
+            parts = ([self._arrays] if self._arrays else []) + self._chunks
+            self._arrays = tuple(
+                None if parts[0][i] is None else np.concatenate([p[i] for p in parts])
+                for i in range(4)
+            )
+            self._chunks = []
+        return self._arrays
+
+    def select(self, start=None, end=None, party=None, status=None):
+        """مواقع الصفوف المطابقة للمرشحات"""
+        with self._lock:
+            arrays = self._compact()
+            if arrays is None:
+                return np.array([], dtype=np.int64)
+            dates, _, parties, statuses = arrays
+            mask = np.ones(len(parties), dtype=bool)
+            if dates is not None and start is not None:
+                mask &= dates >= np.datetime64(pd.Timestamp(start))
+            if dates is not None and end is not None:
+                mask &= dates < np.datetime64(pd.Timestamp(end) + pd.Timedelta(days=1))
+            if party is not None:
+                mask &= parties == self._party_codes.get(party, -1)
+            if status is not None:
+                mask &= statuses == self._status_codes.get(status, -1)
+        return np.flatnonzero(mask)
+
+    def total(self, positions):
+        with self._lock:
+            arrays = self._compact()
+        if arrays is None or arrays[1] is None:
+            return 0.0
+        return int(arrays[1][positions].sum()) / MINOR_UNITS
+
+    def date_bounds(self):
+        with self._lock:
+            arrays = self._compact()
+        if arrays is None or arrays[0] is None or np.isnat(arrays[0]).all():
+            return None
+        dates = arrays[0]
+        valid = dates[~np.isnat(dates)]
+        return pd.Timestamp(valid.min()).date(), pd.Timestamp(valid.max()).date()
+
+    def parties(self):
+        with self._lock:
+            return sorted(p for p in self._party_codes if p)
+
+    def statuses(self):
+        with self._lock:
+            return sorted(s for s in self._status_codes if s)
+
+
+class BufferReport:
+    """مصدر تقرير من المخزن المشترك في الذاكرة عبر ReportIndex؛ التحديد هو مواقع الصفوف"""
+
+    def __init__(self, buffer, party_column=None):
+        self.buffer = buffer
+        self.index = buffer.index("report", lambda df: ReportIndex(df, party_column))
+        self.party_column = party_column
+        self.has_status = self.index.has_status
+
+    def date_bounds(self):
+        return self.index.date_bounds()
+
+    def parties(self):
+        return self.index.parties()
+
+    def statuses(self):
+        return self.index.statuses()
+
+    def select(self, **filters):
+        return self.index.select(**filters)
+
+    def count(self, selection):
+        return len(selection)
+
+    def total(self, selection):
+        return self.index.total(selection)
+
+    def rows(self, selection, offset=0, limit=None):
+        end = None if limit is None else offset + limit
+        return self.buffer.frame().iloc[selection[offset:end]]
+
+    def totals_by_currency(self, selection):
+        """مجموع المبالغ المحددة لكل عملة"""
+        frame = self.buffer.frame()
+        if "العملة" not in frame.columns or "المبلغ" not in frame.columns:
+            return {BASE_CURRENCY: self.total(selection)}
+        selected = frame.iloc[selection]
+        halalas = pd.Series(to_minor_units(as_amounts(selected["المبلغ"])), index=selected.index)
+        totals = halalas.groupby(as_labels(selected["العملة"], BASE_CURRENCY)).sum()
+        return {currency: int(total) / MINOR_UNITS for currency, total in totals.items()}
+
+
+class SqliteReport:
+    """مصدر تقرير من SQLite: المرشحات والمجاميع والصفحات تُنفذ كاستعلامات على الفهارس؛
+    التحديد هو شرط WHERE مع معاملاته"""
+
+    def __init__(self, store, sheet_name, party_column=None):
+        self.store = store
+        self.table = quote_identifier(sheet_name)
+        self.columns = SHEET_COLUMNS[sheet_name]
+        self.party_column = party_column if party_column in self.columns else None
+        self.has_dates = "التاريخ" in self.columns
+        self.has_amounts = "المبلغ" in self.columns
+        self.has_status = "الحالة" in self.columns
+
+    def date_bounds(self):
+        if not self.has_dates:
+            return None
+        low, high = self.store.scalar(f"SELECT MIN({sql_day()}), MAX({sql_day()}) FROM {self.table}")
+        if low is None:
+            return None
+        return pd.Timestamp(low).date(), pd.Timestamp(high).date()
+
+    def _distinct(self, column):
+        column = quote_identifier(column)
+        values = self.store.query(f"SELECT DISTINCT {column} AS v FROM {self.table} WHERE {column} IS NOT NULL AND {column} != '' ORDER BY 1")
+        return values["v"].astype(str).tolist()
+
+    def parties(self):
+        return self._distinct(self.party_column) if self.party_column else []
+
+    def statuses(self):
+        return self._distinct("الحالة") if self.has_status else []
+
+    def select(self, start=None, end=None, party=None, status=None):
+        # المقارنة على النص الخام حتى يُستخدم فهرس التاريخ (التواريخ محفوظة بصيغة YYYY-MM-DD)
+        clauses, params = [], []
+        if self.has_dates and start is not None:
+            clauses.append(f"{quote_identifier('التاريخ')} >= ?")
+            params.append(pd.Timestamp(start).strftime("%Y-%m-%d"))
+        if self.has_dates and end is not None:
+            clauses.append(f"{quote_identifier('التاريخ')} < ?")
+            params.append((pd.Timestamp(end) + pd.Timedelta(days=1)).strftime("%Y-%m-%d"))
+        if party is not None and self.party_column:
+            clauses.append(f"{quote_identifier(self.party_column)} = ?")
+            params.append(party)
+        if status is not None and self.has_status:
+            clauses.append(f"{quote_identifier('الحالة')} = ?")
+            params.append(status)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), tuple(params)
+
+    def count(self, selection):
+        where, params = selection
+        return self.store.scalar(f"SELECT COUNT(*) FROM {self.table}{where}", params)[0]
+
+    def total(self, selection):
+        if not self.has_amounts:
+            return 0.0
+        where, params = selection
+        amount = quote_identifier('المبلغ')
+        total = self.store.scalar(
+            f"SELECT SUM(CASE WHEN typeof({amount}) IN ('integer', 'real') THEN {amount} END) FROM {self.table}{where}", params
+        )[0]
+        return float(total or 0.0)
+
+    def totals_by_currency(self, selection):
+        if not self.has_amounts:
+            return {}
+        if "العملة" not in self.columns:
+            return {BASE_CURRENCY: self.total(selection)}
+        where, params = selection
+        amount, currency = quote_identifier('المبلغ'), quote_identifier('العملة')
+        totals = self.store.query(
+            f"SELECT COALESCE(NULLIF({currency}, ''), ?) AS c, "
+            f"SUM(CASE WHEN typeof({amount}) IN ('integer', 'real') THEN {amount} END) AS t "
+            f"FROM {self.table}{where} GROUP BY 1", (BASE_CURRENCY,) + params
+        )
+        return dict(zip(totals["c"], totals["t"].fillna(0.0)))
+
+    def rows(self, selection, offset=0, limit=None):
+        where, params = selection
+        columns = ", ".join(quote_identifier(c) for c in self.columns)
+        return self.store.query(
+            f"SELECT {columns} FROM {self.table}{where} ORDER BY rowid LIMIT ? OFFSET ?",
+            params + (-1 if limit is None else limit, offset)
+        )
+
+
+class Ledger(MutableMapping):
+    """عرض الجلسة للدفتر المشترك: القراءة تمر إلى مخازن العملية دون نسخ، وأي تعديل محلي
+    (إسناد ورقة كاملة) يبقى نسخة خاصة بالجلسة إلى أن يُعتمد عبر commit (نسخ عند الكتابة)"""
+
+    def __init__(self, store):
+        self._store = store
+        self._local = {}
+
+    def buffer(self, sheet_name):
+        local = self._local.get(sheet_name)
+        return local if local is not None else self._store.get(sheet_name)
+
+    def __getitem__(self, sheet_name):
+        if sheet_name not in SHEET_COLUMNS and sheet_name not in self._local:
+            raise KeyError(sheet_name)
+        return self.buffer(sheet_name).frame()
+
+    def __setitem__(self, sheet_name, value):
+        if not isinstance(value, SheetBuffer):
+            value = SheetBuffer(SHEET_COLUMNS.get(sheet_name), value)
+        self._local[sheet_name] = value
+
+    def __delitem__(self, sheet_name):
+        del self._local[sheet_name]
+
+    def __iter__(self):
+        return iter(list(SHEET_COLUMNS) + [s for s in self._local if s not in SHEET_COLUMNS])
+
+    def __len__(self):
+        return len(set(SHEET_COLUMNS) | set(self._local))
+
+    def dirty(self):
+        """الأوراق المعدلة محليًا ولم تُعتمد بعد"""
+        return list(self._local)
+
+    def commit(self, sheet_name, write):
+        """اعتماد النسخة المحلية: الكتابة والنشر في المخزن المشترك يتمان تحت قفل واحد"""
+        buffer = self._local.get(sheet_name)
+        if buffer is None:
+            return
+        self._store.commit(sheet_name, buffer, write=lambda: write(buffer.frame()))
+        del self._local[sheet_name]
+
+    def discard(self, sheet_name=None):
+        """التراجع عن التعديلات المحلية والعودة إلى النسخة المشتركة"""
+        if sheet_name is None:
+            self._local.clear()
+        else:
+            self._local.pop(sheet_name, None)
+
+
+# -------------------------
+# ذاكرة الأوراق المشتركة
+# -------------------------
+class LedgerCache:
+    """المخزن المشترك للدفتر: مخزن إدراج واحد لكل ورقة لكل العملية (لا نسخة لكل جلسة)؛
+    لا تُعاد قراءة ورقة إلا إذا تغيّرت بصمة ملفاتها، وكل الكتابات تمر تحت قفل واحد بالتتابع"""
+
+    def __init__(self, loader, paths):
+        self._loader = loader
+        self._paths = paths
+        self._lock = threading.RLock()
+        self._entries = {}
+
+    def signature(self, sheet_name):
+        return file_signature(self._paths(sheet_name))
+
+    def get(self, sheet_name):
+        """إرجاع مخزن الورقة، أو قراءتها من جديد إن تغيّرت ملفاتها"""
+        signature = self.signature(sheet_name)
+        with self._lock:
+            entry = self._entries.get(sheet_name)
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+        buffer = SheetBuffer(SHEET_COLUMNS.get(sheet_name), self._loader(sheet_name))
+        with self._lock:
+            self._entries[sheet_name] = (signature, buffer)
+        return buffer
+
+    def _current(self, sheet_name):
+        # المخزن المحمّل إن كان مطابقًا للقرص، دون تحميله إن لم يكن موجودًا
+        entry = self._entries.get(sheet_name)
+        if entry is not None and entry[0] == self.signature(sheet_name):
+            return entry[1]
+        self._entries.pop(sheet_name, None)
+        return None
+
+    def append(self, sheet_name, record, write, durable=True):
+        """كتابة قيد من هذه العملية ثم إلحاقه بالمخزن المشترك دون إعادة قراءة الملف؛
+        الكتابة الدائمة (durable) لا تحمّل ورقة غير محمّلة أصلًا، فستُقرأ من القرص عند أول طلب"""
+        with self._lock:
+            buffer = self._current(sheet_name) if durable else self.get(sheet_name)
+            write()
+            if buffer is None:
+                return None
+            buffer.append(record)
+            self._entries[sheet_name] = (self.signature(sheet_name), buffer)
+        return buffer
+
+    def extend(self, sheet_name, df, write, durable=True):
+        """مثل append لكن لدفعة صفوف كاملة"""
+        with self._lock:
+            buffer = self._current(sheet_name) if durable else self.get(sheet_name)
+            write()
+            if buffer is None:
+                return None
+            buffer.extend(df)
+            self._entries[sheet_name] = (self.signature(sheet_name), buffer)
+        return buffer
+
+    def extend_many(self, frames, write, durable=True):
+        """مثل extend لدفعات عدة أوراق بكتابة واحدة (مثل القيد وأسطر يوميته في معاملة واحدة)"""
+        with self._lock:
+            buffers = {sheet_name: self._current(sheet_name) if durable else self.get(sheet_name) for sheet_name in frames}
+            write()
+            for sheet_name, df in frames.items():
+                buffer = buffers[sheet_name]
+                if buffer is not None:
+                    buffer.extend(df)
+                    self._entries[sheet_name] = (self.signature(sheet_name), buffer)
+        return buffers
+
+    def commit(self, sheet_name, buffer, write):
+        """كتابة محتوى الورقة كاملًا واعتماد المخزن كنسخة مطابقة للقرص"""
+        with self._lock:
+            write()
+            self._entries[sheet_name] = (self.signature(sheet_name), buffer)
+
+    def persist(self, sheet_name, stage):
+        """كتابة لقطة المخزن المحمّل للورقة دون حجز القفل أثناء التحويل والكتابة: stage(df) تكتب ملفًا مؤقتًا
+        وتعيد دالة الاستبدال، التي تُنفذ تحت القفل مع تحديث البصمة. يعيد عدد الصفوف المكتوبة أو None"""
+        with self._lock:
+            entry = self._entries.get(sheet_name)
+        if entry is None:
+            return None
+        df = entry[1].frame()
+        replace = stage(df)
+        with self._lock:
+            before = self.signature(sheet_name)
+            replace()
+            self.resign(sheet_name, before, self.signature(sheet_name))
+        return len(df)
+
+    def resign(self, sheet_name, before, after):
+        """تحديث البصمة بعد تبديل ملفات لا يغيّر المحتوى (مثل طي السجل)"""
+        with self._lock:
+            entry = self._entries.get(sheet_name)
+            if entry is not None and entry[0] == before:
+                self._entries[sheet_name] = (after, entry[1])
+
+    def invalidate(self, sheet_name=None):
+        with self._lock:
+            if sheet_name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(sheet_name, None)
+
+
+# ذاكرة واحدة لكل العملية: كل إعادة تشغيل للسكربت تأخذ الأطر الجاهزة منها
+ledger_cache = LedgerCache(read_sheet, sheet_paths)
+ledger_journal.listeners.append(ledger_cache.resign)
+
+
+# -------------------------
+# الكتابة المؤجلة (write-behind)
+# -------------------------
+class WriteBehind:
+    """طابور كتابة مؤجلة بخيط خلفي واحد: الإدراج يُلحق بالمخزن المشترك ويعود فورًا، والورقة تُكتب بعد مهلة delay
+    من أول تعديل فيها، فتُجمع تعديلات الدفعة المتتالية في كتابة واحدة، ولا يُكتب إلا ما تغيّر"""
+
+    def __init__(self, write, delay=WRITE_BEHIND_DELAY):
+        self._write = write
+        self.delay = delay
+        self._cond = threading.Condition()
+        # الورقة ← وقت أول تعديل لم يُكتب بعد (بترتيب الإدراج)
+        self._queued = {}
+        self._running = None
+        self._thread = None
+        self.errors = {}
+        self.writes = 0
+        self.coalesced = 0
+
+    def schedule(self, sheet_name):
+        """إدراج الورقة في الطابور؛ إن كانت فيه أصلًا يُضم التعديل إلى الكتابة المنتظرة"""
+        with self._cond:
+            if sheet_name in self._queued:
+                self.coalesced += 1
+            else:
+                self._queued[sheet_name] = time.monotonic()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def pending(self):
+        """الأوراق التي لم تُكتب تعديلاتها بعد (المنتظرة والجارية)"""
+        with self._cond:
+            return list(self._queued) + ([self._running] if self._running and self._running not in self._queued else [])
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # كاتب واحد في كل لحظة (الخيط الخلفي أو flush)
+                while not self._queued or self._running is not None:
+                    self._cond.wait()
+                sheet_name, queued_at = next(iter(self._queued.items()))
+                remaining = queued_at + self.delay - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                del self._queued[sheet_name]
+                self._running = sheet_name
+            self._write_one(sheet_name)
+
+    def _write_one(self, sheet_name):
+        error = "انقطعت الكتابة"
+        try:
+            with metrics.span("write_behind") as span:
+                span["rows"] = self._write(sheet_name)
+            error = None
+        except Exception as e:
+            # تبقى التعديلات في الذاكرة ويُعاد إدراج الورقة مع التعديل التالي أو flush
+            error = str(e)
+        finally:
+            # الأخطاء تتغير تحت القفل نفسه الذي يقرؤها فيه flush والواجهة
+            with self._cond:
+                if error is None:
+                    self.errors.pop(sheet_name, None)
+                    self.writes += 1
+                else:
+                    self.errors[sheet_name] = error
+                self._running = None
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """كتابة كل ما في الطابور الآن في الخيط المستدعي (مع إعادة محاولة الأوراق التي فشلت كتابتها)،
+        بعد انتظار الكتابة الجارية. يعيد True إن لم يبق شيء معلق"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            for sheet_name in list(self.errors):
+                self._queued.setdefault(sheet_name, time.monotonic())
+        while True:
+            with self._cond:
+                while self._running is not None:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                if not self._queued:
+                    return not self.errors
+                sheet_name = next(iter(self._queued))
+                del self._queued[sheet_name]
+                self._running = sheet_name
+            self._write_one(sheet_name)
+
+
+def persist_sheet(sheet_name):
+    """كتابة ورقة نمط csv من المخزن المشترك إلى ملفها ذريًا"""
+    return ledger_cache.persist(sheet_name, lambda df: stage_csv(df, f"{sheet_name}.csv"))
+
+
+# طابور واحد لكل العملية؛ ما بقي فيه يُكتب عند الخروج
+sheet_writer = WriteBehind(persist_sheet)
+atexit.register(sheet_writer.flush)
+
+
+def report_source(sheet_name, buffer=None):
+    """مصدر تقرير الورقة: استعلامات SQLite في نمط sqlite، وإلا فهرس المخزن في الذاكرة"""
+    party_column = REPORT_PARTY_COLUMNS.get(sheet_name)
+    if buffer is None and STORAGE_MODE == "sqlite" and sheet_name in SHEET_COLUMNS:
+        return SqliteReport(sqlite_ledger, sheet_name, party_column)
+    return BufferReport(buffer if buffer is not None else ledger_cache.get(sheet_name), party_column)
+
+
+# -------------------------
+# أسعار العملات
+# -------------------------
+CURRENCY_NAMES = {
+    "SAR": "ريال سعودي", "USD": "دولار أمريكي", "EUR": "يورو", "AED": "درهم إماراتي",
+    "KWD": "دينار كويتي", "BHD": "دينار بحريني", "QAR": "ريال قطري", "OMR": "ريال عماني",
+    "EGP": "جنيه مصري", "GBP": "جنيه إسترليني",
+}
+# كلمات تدل على العملة في نص المعاملة (أطول التطابقات أولًا)
+CURRENCY_PATTERNS = [
+    ("USD", r"دولار|USD|\$"), ("EUR", r"يورو|EUR|€"), ("AED", r"درهم|AED"),
+    ("KWD", r"دينار كويتي|KWD"), ("BHD", r"دينار بحريني|BHD"), ("QAR", r"ريال قطري|QAR"),
+    ("OMR", r"ريال عماني|OMR"), ("EGP", r"جنيه مصري|EGP"), ("GBP", r"إسترليني|GBP|£"),
+]
+# مزود الأسعار: عنوان يعيد JSON فيه "rates" (وحدات كل عملة مقابل وحدة واحدة من العملة الأساسية)
+RATES_URL = os.environ.get("ACCOUNTING_RATES_URL", "https://open.er-api.com/v6/latest/{base}")
+RATES_TTL = float(os.environ.get("ACCOUNTING_RATES_TTL", "3600"))
+RATES_TIMEOUT = float(os.environ.get("ACCOUNTING_RATES_TIMEOUT", "10"))
+# مهلة قبل إعادة المحاولة بعد فشل الجلب (ثوانٍ)
+RATES_RETRY = float(os.environ.get("ACCOUNTING_RATES_RETRY", "60"))
+
+
+def detect_currency(text, default=BASE_CURRENCY):
+    """رمز العملة المذكورة في نص المعاملة، أو العملة الأساسية"""
+    for code, pattern in CURRENCY_PATTERNS:
+        if re.search(pattern, str(text)):
+            return code
+    return default
+
+
+async def fetch_json(url, timeout=RATES_TIMEOUT):
+    """طلب GET لا يحجز حلقة asyncio: requests (التحويلات والتحقق من اكتمال الرد) في المنفذ الافتراضي للحلقة"""
+    import asyncio
+    import requests
+
+    def get():
+        response = requests.get(url, timeout=timeout, headers={"Accept": "application/json", "User-Agent": "accounting-ai"})
+        response.raise_for_status()
+        return response.json()
+
+    return await asyncio.get_running_loop().run_in_executor(None, get)
+
+
+class CurrencyRates:
+    """أسعار الصرف مقابل العملة الأساسية مع ذاكرة بمدة صلاحية (TTL).
+    القراءة لا تنتظر الشبكة أبدًا: عند انتهاء الصلاحية تُعاد الأسعار القديمة ويُحدّث في الخلفية
+    (stale-while-revalidate) داخل حلقة asyncio تعمل في خيط مستقل"""
+
+    def __init__(self, url=RATES_URL, base=BASE_CURRENCY, ttl=RATES_TTL, timeout=RATES_TIMEOUT, retry=RATES_RETRY):
+        self.url = url
+        self.base = base
+        self.ttl = ttl
+        self.timeout = timeout
+        self.retry = retry
+        # قيمة وحدة واحدة من كل عملة بالعملة الأساسية
+        self._to_base = {base: 1.0}
+        self.fetched_at = None
+        self.last_error = None
+        self.failed_at = None
+        self._pending = None
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _event_loop(self):
+        import asyncio
+
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="currency-rates", daemon=True).start()
+            return self._loop
+
+    def expired(self):
+        return self.fetched_at is None or time.time() - self.fetched_at >= self.ttl
+
+    def backing_off(self):
+        # بعد فشل الجلب لا يُعاد المحاولة مع كل إعادة رسم، بل بعد retry ثانية (RATES_RETRY افتراضيًا)
+        return self.failed_at is not None and time.time() - self.failed_at < self.retry
+
+    def refresh(self):
+        """بدء تحديث في الخلفية (مرة واحدة في كل وقت)؛ يعيد Future يمكن انتظاره في السكربتات"""
+        import asyncio
+
+        loop = self._event_loop()
+        with self._lock:
+            if self._pending is None or self._pending.done():
+                self._pending = asyncio.run_coroutine_threadsafe(self._refresh(), loop)
+            return self._pending
+
+    async def _refresh(self):
+        try:
+            payload = await fetch_json(self.url.format(base=self.base), self.timeout)
+            rates = payload.get("rates") or payload.get("conversion_rates") or {}
+            to_base = {code: 1.0 / float(rate) for code, rate in rates.items() if float(rate) > 0}
+            to_base[self.base] = 1.0
+            with self._lock:
+                self._to_base = to_base
+                self.fetched_at = time.time()
+                self.last_error = None
+            return to_base
+        except Exception as e:
+            with self._lock:
+                self.last_error = str(e) or type(e).__name__
+                self.failed_at = time.time()
+            raise
+
+    def rates(self):
+        """نسخة من الأسعار الحالية دون انتظار، مع تحديث خلفي إن انتهت صلاحيتها"""
+        if self.expired() and not self.backing_off():
+            self.refresh()
+        with self._lock:
+            return dict(self._to_base)
+
+    def set_rates(self, to_base, fetched_at=None):
+        """تعيين أسعار يدويًا (للاختبار أو العمل دون اتصال)"""
+        with self._lock:
+            self._to_base = dict(to_base, **{self.base: 1.0})
+            self.fetched_at = fetched_at if fetched_at is not None else time.time()
+
+    def status(self):
+        with self._lock:
+            return {
+                "base": self.base,
+                "currencies": len(self._to_base),
+                "fetched_at": datetime.fromtimestamp(self.fetched_at) if self.fetched_at else None,
+                "stale": self.expired(),
+                "refreshing": self._pending is not None and not self._pending.done(),
+                "error": self.last_error,
+            }
+
+
+def conversion_factors(currencies, rates, base=BASE_CURRENCY):
+    """معامل التحويل للعملة الأساسية لكل صف، محسوب مرة لكل عملة فريدة (NaN لعملة بلا سعر)"""
+    codes, uniques = pd.factorize(as_labels(currencies, base))
+    factors = np.array([rates.get(code, np.nan) for code in uniques], dtype=float)
+    return factors[codes] if len(uniques) else np.ones(len(codes))
+
+
+def convert_to_base(df, rates, base=BASE_CURRENCY, amount_column="المبلغ", currency_column="العملة"):
+    """المبالغ بالعملة الأساسية كعمود واحد؛ الصفوف بلا عملة تُعد بالعملة الأساسية"""
+    amounts = as_amounts(df[amount_column])
+    if currency_column not in df.columns:
+        return amounts
+    return amounts * conversion_factors(df[currency_column], rates, base)
+
+
+def totals_in_base(totals_by_currency, rates, base=BASE_CURRENCY):
+    """(الإجمالي بالعملة الأساسية، العملات التي لا سعر لها) من مجاميع كل عملة"""
+    total, missing = 0.0, []
+    for code, amount in totals_by_currency.items():
+        code = code or base
+        if code in rates:
+            total += amount * rates[code]
+        else:
+            missing.append(code)
+    return total, missing
+
+
+# أسعار واحدة مشتركة لكل الجلسات
+currency_rates = CurrencyRates()
+
+
+# -------------------------
+# أرصدة الأطراف وأعمار الذمم
+# -------------------------
+# الحالة التي يُعد فيها القيد مفتوحًا (غير مسدد)؛ أي حالة أخرى تُعد تسوية
+OPEN_STATUS = "معلقة"
+# سجل الأطراف ← ورقة المعاملات التي تُحسب منها أرصدته
+REGISTRY_SHEETS = {"العملاء": "المبيعات", "الموردين": "المشتريات"}
+# حدود فئات الأعمار بالأيام: 0-30، 31-60، 61-90، أكثر من 90
+AGING_EDGES = [30, 60, 90]
+AGING_LABELS = ["0-30 يومًا", "31-60 يومًا", "61-90 يومًا", "أكثر من 90 يومًا"]
+
+
+class BalanceIndex:
+    """أرصدة كل طرف في جدول تجزئة: (الطرف، العملة) ← المفتوح والمسدد (بالهللات) وعدد القيود، حسب الحالة؛
+    القيود المفتوحة محفوظة أيضًا مجمعة حسب (الطرف، العملة، اليوم) لتقرير الأعمار، واليوم عدد أيام منذ 1970.
+    يُبنى بتجميع متجه واحد عند التحميل ويُحدّث بكلفة ثابتة مع كل إدراج"""
+
+    # يوم القيود المفتوحة التي لا تاريخ صالحًا لها
+    UNDATED = -(2 ** 63)
+
+    def __init__(self, df, party_column):
+        self.party_column = party_column
+        self._totals = {}
+        self._open_days = {}
+        self._currencies = {}
+        self._lock = threading.Lock()
+        self.add_frame(df)
+
+    @classmethod
+    def from_aggregates(cls, grouped, party_column):
+        """بناء الفهرس من مجاميع جاهزة (الطرف، العملة، اليوم، مفتوح، المبلغ، العدد)، مثل ناتج GROUP BY في SQLite"""
+        index = cls(None, party_column)
+        index._merge(grouped)
+        return index
+
+    def add_frame(self, df):
+        if df is None or df.empty or self.party_column not in df.columns:
+            return
+        # التجميع على رموز صحيحة (الطرف، العملة) ثم تُعاد الأسماء لكل مجموعة فقط
+        parties, party_names = factorize_labels(df[self.party_column])
+        currencies, currency_names = (
+            factorize_labels(df["العملة"], BASE_CURRENCY) if "العملة" in df.columns
+            else (np.zeros(len(df), dtype=np.int64), pd.Index([BASE_CURRENCY], dtype=object))
+        )
+        is_open = df["الحالة"].eq(OPEN_STATUS).to_numpy() if "الحالة" in df.columns else np.zeros(len(df), dtype=bool)
+        # أيام القيود المسددة لا تلزم؛ توحيدها يقلّص عدد المجموعات
+        days = as_dates(df["التاريخ"]).to_numpy(dtype="datetime64[D]").astype(np.int64)
+        days = np.where(is_open, days, self.UNDATED)
+        keys = pd.DataFrame({
+            "party": parties, "currency": currencies, "day": days, "open": is_open,
+            "amount": to_minor_units(as_amounts(df["المبلغ"])),
+        })
+        grouped = keys.groupby(["party", "currency", "day", "open"], sort=False)["amount"].agg(["sum", "size"]).reset_index()
+        grouped["party"] = party_names.astype(str)[grouped["party"].to_numpy()]
+        grouped["currency"] = currency_names[grouped["currency"].to_numpy()]
+        self._merge(grouped.rename(columns={"sum": "amount", "size": "count"}))
+
+    def _merge(self, grouped):
+        grouped = grouped.assign(
+            open=grouped["open"].astype(bool),
+            amount=pd.to_numeric(grouped["amount"], errors='coerce').fillna(0).astype("int64"),
+            count=grouped["count"].astype("int64"),
+        )
+        # المجاميع لكل (طرف، عملة) تُجمع أولًا فلا يمر الدمج بالجدول إلا مرة لكل زوج
+        totals = grouped.groupby(["party", "currency", "open"], sort=False)[["amount", "count"]].sum()
+        open_days = grouped[grouped["open"]]
+        day_keys = zip(open_days["party"].tolist(), open_days["currency"].tolist(), self._day_numbers(open_days["day"]))
+        with self._lock:
+            for (party, currency, is_open), amount, count in zip(totals.index, totals["amount"].tolist(), totals["count"].tolist()):
+                self._add(party, currency, None, is_open, amount, count)
+            for key, amount in zip(day_keys, open_days["amount"].tolist()):
+                self._open_days[key] = self._open_days.get(key, 0) + amount
+
+    @classmethod
+    def _day_numbers(cls, days):
+        # أيام كأعداد صحيحة، سواء جاءت أعدادًا (من add_frame) أو نصوص تواريخ (من SQLite)
+        if pd.api.types.is_integer_dtype(days.dtype):
+            return days.tolist()
+        dates = as_dates(days)
+        numbers = dates.to_numpy(dtype="datetime64[D]").astype(np.int64)
+        return np.where(dates.isna().to_numpy(), cls.UNDATED, numbers).tolist()
+
+    def _add(self, party, currency, day, is_open, amount, count):
+        entry = self._totals.get((party, currency))
+        if entry is None:
+            entry = self._totals[(party, currency)] = [0, 0, 0, 0]
+            self._currencies.setdefault(party, set()).add(currency)
+        if is_open:
+            entry[0] += amount
+            entry[1] += count
+            if day is not None:
+                self._open_days[(party, currency, day)] = self._open_days.get((party, currency, day), 0) + amount
+        else:
+            entry[2] += amount
+            entry[3] += count
+
+    def add_record(self, record):
+        party = record.get(self.party_column)
+        amount = to_minor_units([pd.to_numeric(record.get("المبلغ"), errors='coerce')])[0]
+        is_open = record.get("الحالة") == OPEN_STATUS
+        day = pd.to_datetime(record.get("التاريخ"), errors='coerce')
+        day = self.UNDATED if pd.isna(day) else int(np.datetime64(day, "D").astype(np.int64))
+        with self._lock:
+            self._add("" if party is None else str(party), record.get("العملة") or BASE_CURRENCY, day, is_open, int(amount), 1)
+
+    def balance(self, party, rates=None):
+        """(المفتوح، المسدد) لطرف واحد بالعملة الأساسية، دون مسح القيود"""
+        rates = rates or {BASE_CURRENCY: 1.0}
+        open_total = settled_total = 0.0
+        with self._lock:
+            for currency in self._currencies.get(party, ()):
+                factor = rates.get(currency)
+                if factor is not None:
+                    entry = self._totals[(party, currency)]
+                    open_total += entry[0] / MINOR_UNITS * factor
+                    settled_total += entry[2] / MINOR_UNITS * factor
+        return open_total, settled_total
+
+    def balances(self, rates=None):
+        """إطار بأرصدة كل الأطراف بالعملة الأساسية، بكلفة تتناسب مع عدد الأطراف لا القيود"""
+        rates = rates or {BASE_CURRENCY: 1.0}
+        with self._lock:
+            items = list(self._totals.items())
+        if not items:
+            return pd.DataFrame(columns=["الطرف", "المفتوح", "المسدد", "الإجمالي", "قيود مفتوحة"])
+        (parties, currencies), values = zip(*[key for key, _ in items]), np.array([v for _, v in items], dtype=np.int64)
+        factors = conversion_factors(currencies, rates)
+        frame = pd.DataFrame({
+            "الطرف": parties,
+            "المفتوح": values[:, 0] / MINOR_UNITS * factors,
+            "المسدد": values[:, 2] / MINOR_UNITS * factors,
+            "قيود مفتوحة": values[:, 1],
+        }).groupby("الطرف", sort=False).sum(min_count=1).fillna({"المفتوح": 0.0, "المسدد": 0.0})
+        frame.insert(2, "الإجمالي", frame["المفتوح"] + frame["المسدد"])
+        return frame.reset_index().sort_values("المفتوح", ascending=False, ignore_index=True)
+
+    def aging(self, today=None, rates=None):
+        """الرصيد المفتوح لكل طرف موزعًا على فئات الأعمار (AGING_LABELS) حسب عمر القيد اليوم؛
+        العمل على مجاميع (الطرف، العملة، اليوم) لا على القيود نفسها"""
+        rates = rates or {BASE_CURRENCY: 1.0}
+        today = int(np.datetime64(pd.Timestamp(today or datetime.now()), "D").astype(np.int64))
+        with self._lock:
+            items = [(key, amount) for key, amount in self._open_days.items() if amount]
+        columns = ["الطرف"] + AGING_LABELS + ["بلا تاريخ", "الإجمالي"]
+        if not items:
+            return pd.DataFrame(columns=["الطرف"] + AGING_LABELS + ["الإجمالي"])
+        keys, amounts = zip(*items)
+        parties, currencies, days = zip(*keys)
+        amounts = np.asarray(amounts, dtype=np.int64) / MINOR_UNITS * conversion_factors(currencies, rates)
+        days = np.asarray(days, dtype=np.int64)
+        undated = days == self.UNDATED
+        # الأعمار السالبة (قيود بتاريخ لاحق) تُعد ضمن الفئة الأولى
+        ages = np.where(undated, 0, today - np.where(undated, 0, days))
+        buckets = np.where(undated, len(AGING_LABELS), np.searchsorted(AGING_EDGES, ages, side="left"))
+        labels = np.array(AGING_LABELS + ["بلا تاريخ"], dtype=object)[buckets]
+        table = (
+            pd.DataFrame({"الطرف": parties, "الفئة": labels, "المبلغ": amounts})
+            .pivot_table(index="الطرف", columns="الفئة", values="المبلغ", aggfunc="sum", fill_value=0.0)
+            .reindex(columns=AGING_LABELS + ["بلا تاريخ"], fill_value=0.0)
+        )
+        if not table["بلا تاريخ"].any():
+            columns.remove("بلا تاريخ")
+        table["الإجمالي"] = table.sum(axis=1)
+        table.columns.name = None
+        return table.reset_index()[columns].sort_values("الإجمالي", ascending=False, ignore_index=True)
+
+    def missing_rates(self, rates):
+        """العملات التي لها أرصدة ولا سعر صرف لها بعد"""
+        with self._lock:
+            currencies = {currency for _, currency in self._totals}
+        return sorted(currencies - set(rates or {BASE_CURRENCY: 1.0}))
+
+
+def balance_index(sheet_name, buffer=None):
+    """فهرس أرصدة الورقة: من SQLite في نمط sqlite، وإلا من مخزن الورقة في الذاكرة"""
+    party_column = PARTY_COLUMNS.get(sheet_name)
+    if buffer is None and STORAGE_MODE == "sqlite":
+        return sqlite_ledger.balances(sheet_name)
+    buffer = buffer if buffer is not None else ledger_cache.get(sheet_name)
+    return buffer.index("balances", lambda df: BalanceIndex(df, party_column))
+
+
+def registry_with_balances(registry, balances):
+    """نسخة من سجل العملاء أو الموردين بعمود الرصيد محسوبًا من الأرصدة المفتوحة،
+    مع ربط الأسماء بعد توحيدها (normalize_party_names)"""
+    registry = registry.copy()
+    if registry.empty:
+        return registry
+    open_by_name = pd.Series(balances["المفتوح"].to_numpy(), index=normalize_party_names(balances["الطرف"]).to_numpy())
+    open_by_name = open_by_name.groupby(level=0).sum()
+    registry["الرصيد"] = normalize_party_names(registry["الاسم"]).map(open_by_name).fillna(0.0).round(2).to_numpy()
+    return registry
+
+
+# -------------------------
+# اليومية العامة والقوائم المالية
+# -------------------------
+# ورقة أسطر القيود المزدوجة للفترة المفتوحة، وورقة المجاميع اليومية للفترات المقفلة
+JOURNAL_SHEET = "القيود"
+CLOSED_SHEET = "الأرصدة المقفلة"
+# ورقة المعاملات ← (الحساب المدين، الحساب الدائن، حساب الضريبة، جهة الضريبة)؛
+# الضريبة في جهة الحساب الصافي: دائنة في المبيعات (مخرجات) ومدينة في المشتريات (مدخلات)
+POSTING_RULES = {
+    "المبيعات": ("حساب المدينين", "إيرادات المبيعات", "ضريبة المخرجات", "دائن"),
+    "المشتريات": ("المشتريات", "حساب الدائنين", "ضريبة المدخلات", "مدين"),
+    "المصروفات": ("مصروفات عامة", "البنك", None, None),
+}
+# الحساب ← نوعه في ميزان المراجعة وقائمة الدخل؛ غيرها يُستنتج من بداية الاسم (account_types)
+ACCOUNT_TYPES = {
+    "البنك": "أصول", "الصندوق": "أصول", "حساب المدينين": "أصول", "ضريبة المدخلات": "أصول",
+    "حساب الدائنين": "خصوم", "ضريبة المخرجات": "خصوم",
+    "رأس المال": "حقوق الملكية",
+    "إيرادات المبيعات": "إيرادات",
+    "المشتريات": "مصروفات", "مصروفات عامة": "مصروفات",
+}
+ACCOUNT_TYPE_ORDER = ["أصول", "خصوم", "حقوق الملكية", "إيرادات", "مصروفات", "أخرى"]
+# مجلد أسطر الفترات المقفلة (ملف CSV لكل إقفال)؛ لا يُقرأ عند التحميل ولا في التقارير
+JOURNAL_ARCHIVE_DIR = os.environ.get("ACCOUNTING_JOURNAL_ARCHIVE_DIR", "journal_archive")
+# أعمدة المجاميع اليومية (بالهللات) في JournalIndex ولقطات الإقفال
+JOURNAL_TOTALS = ["مدين", "دائن", "الضريبة", "الخاضع", "العدد"]
+
+
+def new_entry_ids(count):
+    """أرقام قيود فريدة لدفعة: بادئة من الوقت وبايتين عشوائيين، ثم رقم تسلسلي داخل الدفعة"""
+    prefix = f"{datetime.now():%Y%m%d%H%M%S}-{os.urandom(2).hex()}-"
+    return (prefix + pd.RangeIndex(1, count + 1).astype(str)).to_numpy(dtype=object)
+
+
+def journal_lines(sheet_name, df, vat=None, accounts=None, entry_ids=None):
+    """أسطر اليومية المزدوجة لصفوف ورقة معاملات، قيد متوازن لكل صف:
+    الحساب الإجمالي بالمبلغ مع الضريبة، والحساب الصافي بالمبلغ وعليه وسم الضريبة، وسطر حساب الضريبة إن وُجدت.
+    vat مبالغ الضريبة (افتراضيًا VAT_RATE من المبلغ لأوراق الضريبة)، وaccounts (مدين، دائن) يحل محل حسابي القاعدة"""
+    debit_account, credit_account, vat_account, vat_side = POSTING_RULES[sheet_name]
+    if accounts:
+        debit_account, credit_account = accounts[0] or debit_account, accounts[1] or credit_account
+    count = len(df)
+    net = to_minor_units(as_amounts(df["المبلغ"]))
+    if vat_account is None:
+        tax = np.zeros(count, dtype=np.int64)
+    elif vat is None:
+        tax = np.rint(net * VAT_RATE).astype(np.int64)
+    else:
+        tax = to_minor_units(vat)
+    zeros = np.zeros(count, dtype=np.int64)
+    # (الحساب، مدين، دائن، وسم الضريبة) لكل دور في القيد
+    if vat_side == "دائن":
+        roles = [(debit_account, net + tax, zeros, zeros), (credit_account, zeros, net, tax), (vat_account, zeros, tax, zeros)]
+    elif vat_side == "مدين":
+        roles = [(debit_account, net, zeros, tax), (vat_account, tax, zeros, zeros), (credit_account, zeros, net + tax, zeros)]
+    else:
+        roles = [(debit_account, net, zeros, zeros), (credit_account, zeros, net, zeros)]
+    # الأسطر مرتبة قيدًا قيدًا: (صف، دور) ← مصفوفات بشكل (عدد الصفوف، عدد الأدوار) مسطحة
+    stack = lambda values: np.stack(values, axis=1).ravel()
+    ids = np.asarray(entry_ids, dtype=object) if entry_ids is not None else new_entry_ids(count)
+    currency = as_labels(df["العملة"], BASE_CURRENCY).to_numpy() if "العملة" in df.columns else np.full(count, BASE_CURRENCY, dtype=object)
+    lines = pd.DataFrame({
+        "رقم القيد": np.repeat(ids, len(roles)),
+        "التاريخ": np.repeat(as_dates(df["التاريخ"]).to_numpy(), len(roles)),
+        "الحساب": stack([np.full(count, account, dtype=object) for account, _, _, _ in roles]),
+        "مدين": stack([debit for _, debit, _, _ in roles]) / MINOR_UNITS,
+        "دائن": stack([credit for _, _, credit, _ in roles]) / MINOR_UNITS,
+        "الضريبة": stack([flag for _, _, _, flag in roles]) / MINOR_UNITS,
+        "العملة": np.repeat(currency, len(roles)),
+        "الوصف": np.repeat(as_labels(df["الوصف"]).to_numpy() if "الوصف" in df.columns else "", len(roles)),
+    }, columns=SHEET_COLUMNS[JOURNAL_SHEET])
+    if vat_account is not None:
+        # سطر حساب الضريبة يُحذف من القيود بلا ضريبة
+        is_vat_line = np.tile([account == vat_account for account, _, _, _ in roles], count)
+        lines = lines[~(is_vat_line & np.repeat(tax == 0, len(roles)))].reset_index(drop=True)
+    return lines
+
+
+def journal_for_frames(frames):
+    """أسطر اليومية لكل أوراق المعاملات في frames (مثل ناتج الاستيراد المجمّع) كإطار واحد"""
+    parts = [journal_lines(sheet_name, df) for sheet_name, df in frames.items() if sheet_name in POSTING_RULES and len(df)]
+    return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=SHEET_COLUMNS[JOURNAL_SHEET])
+
+
+def account_types(accounts):
+    """نوع كل حساب من ACCOUNT_TYPES، وإلا من بداية اسمه (إيرادات، مصروفات)، وإلا "أخرى"؛ لكل اسم فريد مرة واحدة"""
+    codes, uniques = pd.factorize(as_labels(accounts))
+    types = np.array([
+        ACCOUNT_TYPES.get(name) or (
+            "إيرادات" if name.startswith("إيراد") else "مصروفات" if name.startswith(("مصروف", "مصاريف", "تكلفة")) else "أخرى"
+        ) for name in uniques
+    ], dtype=object)
+    return types[codes] if len(uniques) else np.array([], dtype=object)
+
+
+def journal_totals(df):
+    """مجاميع أسطر اليومية لكل (يوم، حساب، عملة) بالهللات (JOURNAL_TOTALS)؛ الخاضع مجموع أسطر عليها وسم ضريبة"""
+    if df.empty:
+        return pd.DataFrame({column: [] for column in ["التاريخ", "الحساب", "العملة"] + JOURNAL_TOTALS})
+    accounts, account_names = factorize_labels(df["الحساب"])
+    currencies, currency_names = factorize_labels(df["العملة"], BASE_CURRENCY)
+    debit, credit, tax = (to_minor_units(as_amounts(df[column])) for column in ("مدين", "دائن", "الضريبة"))
+    keys = pd.DataFrame({
+        "day": as_dates(df["التاريخ"]).to_numpy(dtype="datetime64[D]").astype(np.int64),
+        "account": accounts, "currency": currencies,
+        "مدين": debit, "دائن": credit, "الضريبة": tax,
+        "الخاضع": np.where(tax != 0, debit + credit, 0), "العدد": 1,
+    })
+    grouped = keys.groupby(["day", "account", "currency"], sort=False).sum().reset_index()
+    days = grouped.pop("day").to_numpy()
+    grouped.insert(0, "التاريخ", pd.to_datetime(np.where(days == BalanceIndex.UNDATED, np.datetime64("NaT"), days.astype("datetime64[D]"))))
+    grouped["account"] = account_names[grouped["account"].to_numpy()]
+    grouped["currency"] = currency_names[grouped["currency"].to_numpy()]
+    return grouped.rename(columns={"account": "الحساب", "currency": "العملة"})
+
+
+class JournalIndex:
+    """مجاميع اليومية لكل (يوم، حساب، عملة) بالهللات في جدول تجزئة؛ يُبنى بتجميع متجه واحد عند التحميل
+    ويُحدّث مع كل إدراج، فلا تمسح القوائم المالية أسطر القيود عند كل طلب"""
+
+    def __init__(self, df):
+        self._totals = {}
+        self._lock = threading.Lock()
+        self.add_frame(df)
+
+    def add_frame(self, df):
+        if df is None or df.empty:
+            return
+        grouped = journal_totals(df)
+        keys = zip(grouped["التاريخ"].tolist(), grouped["الحساب"].tolist(), grouped["العملة"].tolist())
+        values = grouped[JOURNAL_TOTALS].to_numpy(dtype=np.int64).tolist()
+        with self._lock:
+            for key, row in zip(keys, values):
+                entry = self._totals.get(key)
+                if entry is None:
+                    self._totals[key] = row
+                else:
+                    for i, value in enumerate(row):
+                        entry[i] += value
+
+    def add_record(self, record):
+        self.add_frame(pd.DataFrame([record]))
+
+    def frame(self):
+        with self._lock:
+            items = list(self._totals.items())
+        if not items:
+            return journal_totals(pd.DataFrame())
+        keys, values = zip(*items)
+        frame = pd.DataFrame(list(keys), columns=["التاريخ", "الحساب", "العملة"])
+        frame[JOURNAL_TOTALS] = np.array(values, dtype=np.int64)
+        frame["التاريخ"] = pd.to_datetime(frame["التاريخ"])
+        return frame
+
+
+def closed_snapshot():
+    """لقطات الفترات المقفلة كمجاميع يومية بالهللات، مع تاريخ آخر إقفال (أو None)"""
+    snapshot = ledger_cache.get(CLOSED_SHEET).frame()
+    if snapshot.empty:
+        return journal_totals(pd.DataFrame()), None
+    through = as_dates(snapshot["مقفلة حتى"]).max()
+    totals = snapshot[snapshot["الحساب"].notna()]
+    frame = pd.DataFrame({
+        "التاريخ": as_dates(totals["التاريخ"]).to_numpy(),
+        "الحساب": as_labels(totals["الحساب"]).to_numpy(),
+        "العملة": as_labels(totals["العملة"], BASE_CURRENCY).to_numpy(),
+    })
+    for column in JOURNAL_TOTALS:
+        values = totals[column].to_numpy(dtype=float)
+        frame[column] = to_minor_units(values) if column != "العدد" else np.nan_to_num(values).astype(np.int64)
+    return frame, through
+
+
+def closed_through():
+    """آخر تاريخ مقفل، أو None إن لم تُقفل أي فترة"""
+    snapshot = ledger_cache.get(CLOSED_SHEET).frame()
+    return None if snapshot.empty else as_dates(snapshot["مقفلة حتى"]).max()
+
+
+def check_open_period(dates):
+    """رفض الكتابة بتاريخ داخل فترة مقفلة (ValueError)"""
+    through = closed_through()
+    if through is not None and (as_dates(dates) <= through).any():
+        raise ValueError(f"الفترة حتى {through:%Y-%m-%d} مقفلة؛ لا تُضاف إليها قيود")
+
+
+def journal_daily(buffer=None):
+    """المجاميع اليومية لكل التاريخ: لقطات الفترات المقفلة مع الفترة المفتوحة
+    (من SQLite في نمط sqlite، وإلا من فهرس مخزن اليومية في الذاكرة)"""
+    closed, _ = closed_snapshot()
+    if buffer is None and STORAGE_MODE == "sqlite":
+        current = sqlite_ledger.journal_totals()
+    else:
+        buffer = buffer if buffer is not None else ledger_cache.get(JOURNAL_SHEET)
+        current = buffer.index("journal", JournalIndex).frame()
+    return concat_frames([closed, current]) if not closed.empty else current
+
+
+class FinancialStatements:
+    """ميزان المراجعة وقائمة الدخل وإقرار ضريبة القيمة المضافة لأي فترة، محسوبة بعمليات متجهة على
+    المجاميع اليومية (journal_daily) لا على أسطر القيود، بالعملة الأساسية"""
+
+    def __init__(self, daily, rates=None):
+        factors = conversion_factors(daily["العملة"], rates or {BASE_CURRENCY: 1.0})
+        known = ~np.isnan(factors)
+        self.missing_rates = sorted(set(as_labels(daily["العملة"], BASE_CURRENCY)[~known]))
+        daily = daily[known]
+        factors = factors[known]
+        self.daily = pd.DataFrame({
+            "التاريخ": as_dates(daily["التاريخ"]).to_numpy(),
+            "الحساب": as_labels(daily["الحساب"]).to_numpy(),
+            "النوع": account_types(daily["الحساب"]),
+        })
+        for column in JOURNAL_TOTALS[:-1]:
+            self.daily[column] = daily[column].to_numpy(dtype=np.int64) / MINOR_UNITS * factors
+        self.daily["العدد"] = daily["العدد"].to_numpy(dtype=np.int64)
+
+    def _between(self, start=None, end=None):
+        dates = self.daily["التاريخ"]
+        mask = np.ones(len(dates), dtype=bool)
+        if start is not None:
+            mask &= (dates >= pd.Timestamp(start)).to_numpy()
+        if end is not None:
+            mask &= (dates <= pd.Timestamp(end)).to_numpy()
+        return mask
+
+    def trial_balance(self, start=None, end=None):
+        """لكل حساب: الرصيد الافتتاحي قبل start، وحركة الفترة مدينًا ودائنًا، والرصيد الختامي (المدين موجب)"""
+        daily = self.daily
+        opening = daily[(daily["التاريخ"] < pd.Timestamp(start)).to_numpy()] if start is not None else daily.iloc[:0]
+        period = daily[self._between(start, end)]
+        table = pd.concat([
+            (opening["مدين"] - opening["دائن"]).groupby([opening["الحساب"], opening["النوع"]]).sum().rename("رصيد افتتاحي"),
+            period.groupby(["الحساب", "النوع"])[["مدين", "دائن"]].sum(),
+        ], axis=1).fillna(0.0)
+        table["رصيد ختامي"] = table["رصيد افتتاحي"] + table["مدين"] - table["دائن"]
+        table = table.reset_index()
+        table["ترتيب"] = table["النوع"].map({name: i for i, name in enumerate(ACCOUNT_TYPE_ORDER)})
+        return table.sort_values(["ترتيب", "الحساب"], ignore_index=True).drop(columns="ترتيب").round(2)
+
+    def income_statement(self, start=None, end=None):
+        """الإيرادات (دائن - مدين) والمصروفات (مدين - دائن) لكل حساب، مع الإجماليات وصافي الربح"""
+        period = self.daily[self._between(start, end)]
+        net = (period["دائن"] - period["مدين"]).groupby([period["النوع"], period["الحساب"]]).sum()
+        revenue = net.get("إيرادات", pd.Series(dtype=float))
+        expenses = -net.get("مصروفات", pd.Series(dtype=float))
+        rows = [("الإيرادات", account, amount) for account, amount in revenue.items()]
+        rows.append(("الإيرادات", "إجمالي الإيرادات", revenue.sum()))
+        rows += [("المصروفات", account, amount) for account, amount in expenses.items()]
+        rows.append(("المصروفات", "إجمالي المصروفات", expenses.sum()))
+        rows.append(("النتيجة", "صافي الربح" if revenue.sum() >= expenses.sum() else "صافي الخسارة", revenue.sum() - expenses.sum()))
+        return pd.DataFrame(rows, columns=["القسم", "البند", "المبلغ"]).round(2)
+
+    def vat_return(self, start=None, end=None):
+        """إقرار ضريبة القيمة المضافة للفترة: المبيعات والمشتريات الخاضعة للنسبة الأساسية وضريبتها، وصافي المستحق؛
+        الضريبة على حسابات الإيرادات مخرجات وعلى غيرها مدخلات"""
+        period = self.daily[self._between(start, end)]
+        is_output = (period["النوع"] == "إيرادات").to_numpy()
+        output, inputs = period[is_output], period[~is_output]
+        rate = f"{VAT_RATE:.0%}"
+        return pd.DataFrame([
+            (f"المبيعات الخاضعة للنسبة الأساسية ({rate})", output["الخاضع"].sum(), output["الضريبة"].sum()),
+            (f"المشتريات الخاضعة للنسبة الأساسية ({rate})", inputs["الخاضع"].sum(), inputs["الضريبة"].sum()),
+            ("صافي الضريبة المستحقة", output["الخاضع"].sum() - inputs["الخاضع"].sum(), output["الضريبة"].sum() - inputs["الضريبة"].sum()),
+        ], columns=["البند", "المبلغ الخاضع", "الضريبة"]).round(2)
+
+
+def close_period(through):
+    """إقفال الفترة حتى through: مجاميعها اليومية تُلحق بلقطات الإقفال، وأسطرها تُنقل إلى ملف في JOURNAL_ARCHIVE_DIR
+    وتُحذف من ورقة القيود، فلا تمسح التقارير بعدها إلا الفترة المفتوحة. يعيد عدد الأسطر المقفلة"""
+    through = pd.Timestamp(through).normalize()
+    previous = closed_through()
+    if previous is not None and through <= previous:
+        raise ValueError(f"الفترة مقفلة أصلًا حتى {previous:%Y-%m-%d}")
+    journal = ledger_cache.get(JOURNAL_SHEET).frame()
+    is_closed = (as_dates(journal["التاريخ"]) <= through).to_numpy()
+    closed = journal[is_closed]
+    snapshot = journal_totals(closed)
+    for column in JOURNAL_TOTALS[:-1]:
+        snapshot[column] = snapshot[column] / MINOR_UNITS
+    if snapshot.empty:
+        # سطر إقفال بلا حساب يحفظ تاريخ الإقفال لفترة بلا قيود
+        snapshot = pd.DataFrame([{"التاريخ": through, "الحساب": None, "العملة": None, **{c: 0 for c in JOURNAL_TOTALS}}])
+    snapshot.insert(0, "مقفلة حتى", through)
+    if len(closed):
+        os.makedirs(JOURNAL_ARCHIVE_DIR, exist_ok=True)
+        archive = os.path.join(JOURNAL_ARCHIVE_DIR, f"{JOURNAL_SHEET}_حتى_{through:%Y-%m-%d}.csv")
+        storage_frame(closed).to_csv(archive, index=False, encoding='utf-8-sig')
+    # اللقطة تُكتب قبل حذف الأسطر: انقطاع بينهما يترك الأسطر مكررة في الأرشيف لا مفقودة
+    append_rows(CLOSED_SHEET, snapshot[SHEET_COLUMNS[CLOSED_SHEET]])
+    if len(closed):
+        replace_rows(JOURNAL_SHEET, journal[~is_closed])
+    return len(closed)
+
+
+def rebuild_journal(data):
+    """أسطر اليومية من أوراق المعاملات الحالية (للبيانات المدخلة قبل اليومية)، بعد آخر تاريخ مقفل فقط"""
+    through = closed_through()
+    frames = {}
+    for sheet_name in POSTING_RULES:
+        df = data[sheet_name]
+        if through is not None:
+            df = df[(as_dates(df["التاريخ"]) > through).to_numpy()]
+        frames[sheet_name] = df
+    return journal_for_frames(frames)
+
+
+# -------------------------
+# قيد المعاملة المحلل
+# -------------------------
+# نوع المعاملة ← (الورقة، عمود الطرف، الطرف الافتراضي)
+TRANSACTION_SHEETS = {
+    "بيع": ("المبيعات", "العميل", "عميل"),
+    "شراء": ("المشتريات", "المورد", "مورد"),
+}
+
+
+@dataclass(slots=True)
+class Transaction:
+    """قيد معاملة محلل ينتقل من المحلل إلى الدفتر مباشرة؛ نص المعاينة يُبنى منه للعرض فقط"""
+    transaction_type: str
+    amount: float
+    date: str
+    description: str = ""
+    currency: str = BASE_CURRENCY
+    party: str = ""
+    account_debit: str = ""
+    account_credit: str = ""
+    vat_amount: float = 0.0
+    invoice_number: str = ""
+    due_date: str = ""
+    items: tuple = ()
+
+    def sheet_row(self):
+        """(الورقة، الصف) المقابلان للقيد، أو None إن لم يكن له ورقة"""
+        target = TRANSACTION_SHEETS.get(self.transaction_type)
+        if target is None:
+            return None
+        sheet_name, party_column, default_party = target
+        return sheet_name, {
+            "التاريخ": self.date,
+            party_column: self.party or default_party,
+            "المبلغ": float(self.amount),
+            "الوصف": self.description,
+            "الحالة": "معلقة",
+            "العملة": self.currency
+        }
+
+    def journal_lines(self):
+        """أسطر اليومية المزدوجة للقيد بحساباته وضريبته كما حُللت من النص، أو None إن لم يكن له ورقة"""
+        row = self.sheet_row()
+        if row is None:
+            return None
+        sheet_name, record = row
+        return journal_lines(sheet_name, pd.DataFrame([record]), vat=[self.vat_amount],
+                             accounts=(self.account_debit, self.account_credit))
+
+    def preview(self):
+        """نص المعاينة المعروض للمستخدم"""
+        if self.transaction_type == "بيع":
+            lines = ["=== معاملة بيع ==="]
+        elif self.transaction_type == "شراء":
+            lines = ["=== معاملة شراء ==="]
+        else:
+            lines = ["=== معاملة محاسبية ==="]
+        for field in self.__slots__:
+            value = getattr(self, field)
+            if value in ("", (), None):
+                continue
+            if field == "items":
+                lines.append(f"{field}:")
+                for item in value:
+                    for ik, iv in item.items():
+                        lines.append(f"  {ik}: {iv}")
+                    lines.append("")
+            elif field == "currency":
+                lines.append(f"{field}: {CURRENCY_NAMES.get(value, value)}")
+            else:
+                lines.append(f"{field}: {value}")
+        return "\n".join(lines)
+
+
+# -------------------------
+# تحليل النص (محاكاة ChatGPT)
+# -------------------------
+def extract_amount(text):
+    """استخراج أول رقم يظهر في النص كعدد"""
+    try:
+        nums = re.findall(r'\d+\.\d+|\d+', str(text))
+        if nums:
+            return float(nums[0])
+    except Exception:
+        pass
+    return 0.0
+
+
+def parse_transaction_text(text):
+    """تصنيف نص معاملة واحدة إلى قيد (بيع، شراء، أو عام)"""
+    amount = extract_amount(text)
+    currency = detect_currency(text)
+    today = datetime.now().strftime("%Y-%m-%d")
+    if "بيع" in text or "مبيعات" in text:
+        return Transaction(
+            transaction_type="بيع",
+            amount=amount,
+            date=today,
+            description=text,
+            currency=currency,
+            account_debit="حساب المدينين",
+            account_credit="إيرادات المبيعات",
+            vat_amount=round(amount * VAT_RATE, 2)
+        )
+    if "شراء" in text or "مشتريات" in text:
+        return Transaction(
+            transaction_type="شراء",
+            amount=amount,
+            date=today,
+            description=text,
+            currency=currency,
+            account_debit="المشتريات",
+            account_credit="حساب الدائنين",
+            vat_amount=round(amount * VAT_RATE, 2)
+        )
+    # افتراضي
+    return Transaction(
+        transaction_type="عام",
+        amount=amount,
+        date=today,
+        description=text,
+        currency=currency,
+        account_debit="مصروفات عامة",
+        account_credit="البنك",
+        vat_amount=0.0
+    )
+
+
+def parse_invoice_text(text):
+    """قيد شراء من نص فاتورة ممسوحة ضوئيًا"""
+    amount = extract_amount(text)
+    return Transaction(
+        transaction_type="شراء",
+        amount=amount,
+        date=datetime.now().strftime("%Y-%m-%d"),
+        currency=detect_currency(text),
+        party="شركة المعدات المتحدة",
+        account_debit="المشتريات",
+        account_credit="حساب الدائنين",
+        vat_amount=round(amount * VAT_RATE, 2),
+        invoice_number=f"INV-{datetime.now().strftime('%Y%m%d')}-001",
+        due_date=(datetime.now() + timedelta(days=30)).strftime("%Y-%m-%d"),
+        items=(
+            {"description": "طابعة ليزر", "quantity": 2, "unit_price": 1200.00, "total": 2400.00},
+            {"description": "حبر طابعة", "quantity": 5, "unit_price": 170.00, "total": 850.00}
+        )
+    )
+
+
+# -------------------------
+# ذاكرة التحليل
+# -------------------------
+PARSE_CACHE_SIZE = int(os.environ.get("ACCOUNTING_PARSE_CACHE_SIZE", "2048"))
+# ملف JSON لحفظ الذاكرة بين التشغيلات؛ فارغ = في الذاكرة فقط
+PARSE_CACHE_PATH = os.environ.get("ACCOUNTING_PARSE_CACHE_PATH", "")
+# مهلة تجميع حفظ الملف (ثوانٍ): التحليلات الجديدة خلالها تُحفظ بكتابة واحدة في الخلفية لا مع كل نقرة
+PARSE_CACHE_SAVE_DELAY = float(os.environ.get("ACCOUNTING_PARSE_CACHE_SAVE_DELAY", "5"))
+
+
+def normalize_parse_text(text):
+    """مفتاح ذاكرة التحليل: المسافات موحدة وكل عدد (بأي أرقام) يصبح #،
+    فتتطابق الفواتير الشهرية المتكررة التي لا يختلف فيها إلا المبلغ والتاريخ والرقم"""
+    return re.sub(r"\s+", " ", re.sub(r"\d+(?:\.\d+)?", "#", str(text))).strip()
+
+
+def rebind_transaction(template, source, parsed_on, text, today=None):
+    """قيد من قالب في الذاكرة مع ما يُستمد من النص الجديد نفسه: المبلغ وضريبته بنسبتها في القالب،
+    والوصف إن كان نص المصدر، والتواريخ التي ختمها المحلل بيوم التحليل تُزاح إلى اليوم.
+    الحقول الرقمية الأخرى من نص المصدر لا تُنقل: رقم الفاتورة يُعاد ختمه باليوم إن كان مختومًا بيوم التحليل
+    وإلا يُفرغ، والبنود (كمياتها وأسعارها لا تطابق المبلغ الجديد) تُفرغ"""
+    amount = extract_amount(text)
+    vat_rate = template.vat_amount / template.amount if template.amount else 0.0
+    today = today or datetime.now().strftime("%Y-%m-%d")
+    fields = {
+        "amount": amount,
+        "vat_amount": round(amount * vat_rate, 2),
+        "description": text if template.description == source else template.description,
+        "items": (),
+    }
+    stamp = parsed_on.replace("-", "")
+    if template.invoice_number and stamp in template.invoice_number:
+        fields["invoice_number"] = template.invoice_number.replace(stamp, today.replace("-", ""))
+    elif re.search(r"\d", template.invoice_number):
+        fields["invoice_number"] = ""
+    if template.date == parsed_on and today != parsed_on:
+        shift = datetime.strptime(today, "%Y-%m-%d") - datetime.strptime(parsed_on, "%Y-%m-%d")
+        fields["date"] = today
+        if template.due_date:
+            fields["due_date"] = (datetime.strptime(template.due_date, "%Y-%m-%d") + shift).strftime("%Y-%m-%d")
+    return dataclasses.replace(template, **fields)
+
+
+class ParseCache:
+    """ذاكرة LRU محدودة لنتائج المحلل (نموذج اللغة لاحقًا) بمفتاح النوع والنص المطبّع،
+    فلا يُستدعى المحلل إلا لمدخل جديد فعلًا؛ تُحفظ اختياريًا في ملف JSON بالخلفية بعد save_delay ثانية
+    من أول تحليل جديد لم يُحفظ (WriteBehind)، وما بقي يُحفظ عند الخروج"""
+
+    def __init__(self, size=PARSE_CACHE_SIZE, path=PARSE_CACHE_PATH, save_delay=PARSE_CACHE_SAVE_DELAY):
+        self.size = size
+        self.path = path
+        self._writer = WriteBehind(lambda _: self.save() and len(self), delay=save_delay)
+        self.hits = 0
+        self.misses = 0
+        # المفتاح ← (القالب، نص المصدر، يوم التحليل)
+        self._items = OrderedDict()
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        self._load()
+        with self._lock:
+            return len(self._items)
+
+    def parse(self, kind, text, parser):
+        """نتيجة parser(text) من الذاكرة إن سبق تحليل نص مطابق بعد التطبيع، وإلا تحليل جديد يُحفظ"""
+        key = f"{kind}:{normalize_parse_text(text)}"
+        self._load()
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+        if entry is not None:
+            return rebind_transaction(*entry, text)
+        transaction = parser(text)
+        with self._lock:
+            self.misses += 1
+            self._items[key] = (transaction, text, datetime.now().strftime("%Y-%m-%d"))
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+        if self.path:
+            # الذاكرة تبقى صالحة في العملية حتى إن تعذر الحفظ؛ الخطأ في self._writer.errors
+            self._writer.schedule("parse_cache")
+        return transaction
+
+    def flush(self, timeout=None):
+        """حفظ التحليلات الجديدة المنتظرة الآن؛ يعيد True إن لم يبق شيء معلق"""
+        return self._writer.flush(timeout)
+
+    def stats(self):
+        self._load()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._items), "size": self.size, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = 0
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def save(self, path=None):
+        """كتابة ذرية للذاكرة بترتيب الاستخدام (الأقدم أولًا)"""
+        path = path or self.path
+        with self._lock:
+            entries = [
+                {"key": key, "source": source, "parsed_on": parsed_on, "result": dataclasses.asdict(template)}
+                for key, (template, source, parsed_on) in self._items.items()
+            ]
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".json.tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        return path
+
+    def _load(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            if not self.path or not os.path.exists(self.path):
+                return
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    entries = json.load(f)
+                for entry in entries[-self.size:]:
+                    result = dict(entry["result"], items=tuple(entry["result"].get("items", ())))
+                    self._items[entry["key"]] = (Transaction(**result), entry["source"], entry["parsed_on"])
+            except (OSError, ValueError, KeyError, TypeError):
+                # ملف تالف أو من إصدار آخر: نبدأ بذاكرة فارغة
+                self._items.clear()
+
+
+parse_cache = ParseCache()
+atexit.register(parse_cache.flush)
+
+
+# -------------------------
+# الاستيراد النصي المجمّع
+# -------------------------
+BATCH_IMPORT_CHUNK_SIZE = 50_000
+
+
+def iter_line_chunks(stream, chunk_size=BATCH_IMPORT_CHUNK_SIZE):
+    """قراءة ملف أسطر على دفعات ثابتة الحجم دون تحميله كاملًا"""
+    wrapped = not isinstance(stream, io.TextIOBase)
+    reader = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace') if wrapped else stream
+    try:
+        chunk = []
+        for line in reader:
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    finally:
+        if wrapped:
+            # فصل الغلاف حتى لا يُغلق الملف المرفوع الأصلي
+            reader.detach()
+
+
+def parse_transactions_batch(lines, today=None):
+    """نسخة متجهة من parse_transaction_text: تصنيف الأسطر واستخراج المبلغ وحساب الضريبة عموديًا"""
+    text = pd.Series(lines, dtype="object").astype(str).str.strip()
+    text = text[text != ""].reset_index(drop=True)
+    is_sale = text.str.contains("بيع|مبيعات", regex=True)
+    is_purchase = ~is_sale & text.str.contains("شراء|مشتريات", regex=True)
+    # أول رقم في السطر كما في extract_amount
+    amount = pd.to_numeric(text.str.extract(r'(\d+\.\d+|\d+)', expand=False), errors='coerce').fillna(0.0)
+    return pd.DataFrame({
+        "transaction_type": np.select([is_sale, is_purchase], ["بيع", "شراء"], default="عام"),
+        "amount": amount,
+        "date": today or datetime.now().strftime("%Y-%m-%d"),
+        "description": text,
+        "vat_amount": (amount * VAT_RATE).round(2).where(is_sale | is_purchase, 0.0),
+        "currency": np.select(
+            [text.str.contains(pattern, regex=True) for _, pattern in CURRENCY_PATTERNS],
+            [code for code, _ in CURRENCY_PATTERNS], default=BASE_CURRENCY
+        ) if len(text) else np.array([], dtype=object),
+    })
+
+
+def batch_to_sheets(parsed):
+    """توزيع المعاملات المحللة على أوراق الدفتر بأعمدتها المعتادة"""
+    frames = {}
+    for ttype, (sheet_name, party_column, party) in TRANSACTION_SHEETS.items():
+        rows = parsed[parsed["transaction_type"] == ttype]
+        frames[sheet_name] = pd.DataFrame({
+            "التاريخ": rows["date"].to_numpy(),
+            party_column: party,
+            "المبلغ": rows["amount"].to_numpy(),
+            "الوصف": rows["description"].to_numpy(),
+            "الحالة": "معلقة",
+            "العملة": rows["currency"].to_numpy(),
+        }, columns=SHEET_COLUMNS[sheet_name])
+    return frames
+
+
+def import_transaction_lines(stream, chunk_size=BATCH_IMPORT_CHUNK_SIZE, progress=None):
+    """تحليل ملف أسطر معاملات على دفعات؛ يعيد (أطر الأوراق مع أسطر اليومية، الإحصاءات) دون كتابة شيء.
+    progress(عدد الأسطر المعالجة) يُستدعى بعد كل دفعة"""
+    collected = {sheet_name: [] for sheet_name, _, _ in TRANSACTION_SHEETS.values()}
+    collected[JOURNAL_SHEET] = []
+    stats = {"total": 0, "unclassified": 0, "vat_total": 0.0}
+    for chunk in iter_line_chunks(stream, chunk_size):
+        parsed = parse_transactions_batch(chunk)
+        stats["total"] += len(parsed)
+        stats["unclassified"] += int((parsed["transaction_type"] == "عام").sum())
+        stats["vat_total"] += float(parsed["vat_amount"].sum())
+        sheets = batch_to_sheets(parsed)
+        for ttype, (sheet_name, _, _) in TRANSACTION_SHEETS.items():
+            collected[sheet_name].append(sheets[sheet_name])
+            # أسطر اليومية بضريبة كل سطر كما حُللت
+            vat = parsed.loc[parsed["transaction_type"] == ttype, "vat_amount"].to_numpy()
+            collected[JOURNAL_SHEET].append(journal_lines(sheet_name, sheets[sheet_name], vat=vat))
+        if progress is not None:
+            progress(stats["total"])
+    frames = {
+        sheet_name: pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+        for sheet_name, parts in collected.items() if parts
+    }
+    return frames, stats
+
+
+# -------------------------
+# استيراد الدفاتر التاريخية
+# -------------------------
+# صفوف كل دفعة تُقرأ من الملف؛ ذروة الذاكرة تتبع حجم الدفعة وعدد العمليات لا حجم الملف
+LEDGER_IMPORT_CHUNK_SIZE = int(os.environ.get("ACCOUNTING_IMPORT_CHUNK_SIZE", "100000"))
+LEDGER_IMPORT_WORKERS = int(os.environ.get("ACCOUNTING_IMPORT_WORKERS", str(min(4, os.cpu_count() or 1))))
+# الأوراق التي تُستورد من أنظمة أخرى (اليومية تُبنى من المعاملات)
+LEDGER_IMPORT_SHEETS = [s for s in SHEET_COLUMNS if s not in ("القيود", "الأرصدة المقفلة")]
+# عمود الورقة ← أسماء الأعمدة المقبولة في ملفات الأنظمة الأخرى (بأحرف صغيرة)
+LEDGER_HEADERS = {
+    "التاريخ": ["التاريخ", "تاريخ الفاتورة", "تاريخ القيد", "date", "invoice date", "transaction date", "posting date"],
+    "العميل": ["العميل", "اسم العميل", "customer", "client", "customer name", "bill to"],
+    "المورد": ["المورد", "اسم المورد", "supplier", "vendor", "supplier name", "vendor name"],
+    "النوع": ["النوع", "نوع المصروف", "البند", "type", "category", "expense type", "account"],
+    "المبلغ": ["المبلغ", "القيمة", "الإجمالي", "amount", "total", "value", "net amount"],
+    "الوصف": ["الوصف", "البيان", "التفاصيل", "description", "memo", "details", "narrative"],
+    "الحالة": ["الحالة", "status", "state"],
+    "العملة": ["العملة", "currency", "currency code", "ccy"],
+    "الاسم": ["الاسم", "name", "customer name", "supplier name", "vendor name"],
+    "البريد": ["البريد", "البريد الإلكتروني", "email", "e-mail", "mail"],
+    "الهاتف": ["الهاتف", "الجوال", "phone", "mobile", "telephone"],
+    "الرصيد": ["الرصيد", "balance", "opening balance"],
+}
+# الأعمدة التي لا يُستورد ملف دونها
+LEDGER_REQUIRED_COLUMNS = {"العملاء": ["الاسم"], "الموردين": ["الاسم"]}
+LEDGER_REQUIRED_DEFAULT = ["التاريخ", "المبلغ"]
+# عمودا ملف الصفوف المرفوضة بعد أعمدة الملف الأصلية
+REJECT_LINE_COLUMN = "رقم السطر"
+REJECT_REASON_COLUMN = "سبب الرفض"
+
+
+def ledger_column_map(headers, sheet_name):
+    """عنوان العمود في الملف ← عمود الورقة؛ الأعمدة غير المعروفة تُهمل. ValueError إن غاب عمود لازم"""
+    columns = SHEET_COLUMNS[sheet_name]
+    aliases = {alias.casefold(): column for column in columns for alias in LEDGER_HEADERS.get(column, [column])}
+    mapping = {}
+    for header in headers:
+        column = aliases.get(str(header).strip().casefold())
+        if column and column not in mapping.values():
+            mapping[header] = column
+    missing = [c for c in LEDGER_REQUIRED_COLUMNS.get(sheet_name, LEDGER_REQUIRED_DEFAULT) if c not in mapping.values()]
+    if missing:
+        raise ValueError(f"أعمدة لازمة غير موجودة في الملف: {'، '.join(missing)} (الأعمدة: {'، '.join(map(str, headers))})")
+    return mapping
+
+
+def currency_code(value):
+    """رمز العملة من قيمة عمود العملة (رمز أو اسم أو علامة)، أو None إن لم تُعرف؛ الفارغ هو العملة الأساسية"""
+    text = str(value).strip()
+    if not text:
+        return BASE_CURRENCY
+    if text.upper() in CURRENCY_NAMES:
+        return text.upper()
+    names = {name: code for code, name in CURRENCY_NAMES.items()}
+    return names.get(text) or detect_currency(text, default=None)
+
+
+def iter_ledger_chunks(source, name="", chunk_size=LEDGER_IMPORT_CHUNK_SIZE, excel_sheet=None):
+    """قراءة ملف CSV أو XLSX (مسار أو ملف ثنائي مفتوح) على دفعات ثابتة الحجم دون تحميله كاملًا.
+    CSV يُقرأ بأنواع صريحة (كل الأعمدة نصوص، والفارغ يبقى نصًا فارغًا)؛ XLSX يُقرأ صفًا صفًا بوضع القراءة فقط"""
+    name = name or str(source if isinstance(source, (str, os.PathLike)) else getattr(source, "name", ""))
+    if name.lower().endswith((".xlsx", ".xlsm")):
+        yield from _iter_excel_chunks(source, chunk_size, excel_sheet)
+        return
+    opened = isinstance(source, (str, os.PathLike))
+    stream = open(source, "rb") if opened else source
+    try:
+        # فاصل منقوطة إن خلا منه السطر الأول من الفواصل (الشائع مع الفاصلة العشرية)
+        first = stream.readline().decode("utf-8-sig", errors="replace")
+        stream.seek(0)
+        sep = ";" if ";" in first and "," not in first else ","
+        reader = pd.read_csv(stream, dtype=str, keep_default_na=False, skipinitialspace=True, sep=sep,
+                             encoding="utf-8-sig", encoding_errors="replace", chunksize=chunk_size)
+        with reader:
+            yield from reader
+    finally:
+        if opened:
+            stream.close()
+
+
+def _iter_excel_chunks(source, chunk_size, excel_sheet=None):
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[excel_sheet] if excel_sheet else workbook.active
+        rows = worksheet.iter_rows(values_only=True)
+        headers = next(rows, None)
+        if headers is None:
+            return
+        headers = [str(h) if h is not None else f"عمود {i + 1}" for i, h in enumerate(headers)]
+        width = len(headers)
+        chunk = []
+        for row in rows:
+            if all(value is None or value == "" for value in row):
+                continue
+            # الخلايا الفارغة نصوص فارغة كما في CSV، والصف القصير يُكمل بها
+            values = ["" if value is None else value for value in row[:width]]
+            chunk.append(values + [""] * (width - len(values)))
+            if len(chunk) >= chunk_size:
+                yield pd.DataFrame(chunk, columns=headers, dtype=object)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=headers, dtype=object)
+    finally:
+        workbook.close()
+
+
+def validate_ledger_chunk(sheet_name, chunk, mapping, first_line=2, closed=None):
+    """تحقق دفعة وتوحيدها على مخطط الورقة (يُنفذ في عملية عاملة): يعيد (الصفوف المقبولة بالأنواع المعتمدة،
+    الصفوف المرفوضة بأعمدتها الأصلية مع رقم السطر في الملف وسبب الرفض)؛ لا يُحوّل أي مبلغ تالف إلى NaN بصمت"""
+    columns = SHEET_COLUMNS[sheet_name]
+    mapped = chunk[list(mapping)].rename(columns=mapping).reindex(columns=columns)
+    text = {c: mapped[c].fillna("").astype(str).str.strip() for c in columns if c not in ("التاريخ", "المبلغ", "الرصيد")}
+    reasons = []
+    out = {}
+    if "التاريخ" in columns:
+        dates = _statement_dates(mapped["التاريخ"].where(mapped["التاريخ"].ne(""))).reset_index(drop=True)
+        reasons.append((dates.isna().to_numpy(), "تاريخ غير صالح"))
+        if closed is not None:
+            reasons.append(((dates <= closed).to_numpy(), f"ضمن فترة مقفلة حتى {closed:%Y-%m-%d}"))
+        out["التاريخ"] = dates
+    if "المبلغ" in columns:
+        amounts = _statement_amounts(mapped["المبلغ"].where(mapped["المبلغ"].ne(""))).round(2).reset_index(drop=True)
+        reasons.append((amounts.isna().to_numpy(), "مبلغ غير صالح"))
+        out["المبلغ"] = amounts
+    if "الرصيد" in columns:
+        raw = mapped["الرصيد"].fillna("").astype(str).str.strip().reset_index(drop=True)
+        balances = _statement_amounts(raw.where(raw.ne(""))).round(2)
+        reasons.append(((balances.isna() & raw.ne("")).to_numpy(), "رصيد غير صالح"))
+        out["الرصيد"] = balances.fillna(0.0)
+    if "الاسم" in columns:
+        reasons.append((text["الاسم"].eq("").to_numpy(), "اسم فارغ"))
+    if "العملة" in columns:
+        # القيم المميزة قليلة: تُحوّل مرة لكل قيمة لا لكل صف
+        codes = text["العملة"].map({value: currency_code(value) for value in text["العملة"].unique()})
+        reasons.append((codes.isna().to_numpy(), "عملة غير معروفة"))
+        text["العملة"] = codes
+    if "الحالة" in columns:
+        text["الحالة"] = text["الحالة"].where(text["الحالة"].ne(""), OPEN_STATUS)
+    party = PARTY_COLUMNS.get(sheet_name)
+    default_party = next((p for s, c, p in TRANSACTION_SHEETS.values() if s == sheet_name), "")
+    if party and default_party:
+        text[party] = text[party].where(text[party].ne(""), default_party)
+
+    # أول سبب رفض لكل صف
+    count = len(mapped)
+    reason = np.select([mask for mask, _ in reasons], [label for _, label in reasons], default="") if reasons else np.full(count, "")
+    bad = reason != ""
+    good = pd.DataFrame({c: out[c] if c in out else text[c].reset_index(drop=True) for c in columns})[~bad]
+    rejected = chunk.reset_index(drop=True)[bad].copy()
+    rejected.insert(0, REJECT_LINE_COLUMN, np.arange(first_line, first_line + count)[bad])
+    rejected[REJECT_REASON_COLUMN] = reason[bad]
+    return typed_frame(good.reset_index(drop=True)), rejected
+
+
+def import_ledger_file(source, sheet_name, name="", write=None, rejects_path=None, chunk_size=LEDGER_IMPORT_CHUNK_SIZE,
+                       workers=LEDGER_IMPORT_WORKERS, excel_sheet=None, progress=None):
+    """استيراد ملف دفتر من نظام آخر إلى ورقة: القراءة على دفعات في هذه العملية، والتحقق والتوحيد في مجموعة عمليات
+    بعدد محدود من الدفعات قيد المعالجة، ثم write({الورقة: الإطار}) لكل دفعة مقبولة بترتيب الملف (مع أسطر اليومية
+    لأوراق المعاملات في الكتابة نفسها) وإلحاق المرفوض بملف CSV جانبي. progress(الإحصاءات) يُستدعى بعد كل دفعة"""
+    write = write or append_frames
+    if sheet_name not in LEDGER_IMPORT_SHEETS:
+        raise ValueError(f"لا يمكن الاستيراد إلى {sheet_name} (المتاح: {'، '.join(LEDGER_IMPORT_SHEETS)})")
+    closed = closed_through() if sheet_name in POSTING_RULES else None
+    stats = {"rows": 0, "imported": 0, "rejected": 0, "chunks": 0, "rejects_path": None, "reasons": {}}
+    executor = None
+    # الدفعة الأولى تنتظر حتى تظهر الثانية: الملف الأصغر من دفعة يُتحقق منه في هذه العملية دون تشغيل العمليات
+    held = None
+    pending = []
+
+    def consume(result):
+        good, rejected = result
+        if not good.empty:
+            frames = {sheet_name: good}
+            if sheet_name in POSTING_RULES:
+                frames[JOURNAL_SHEET] = journal_lines(sheet_name, good)
+            write(frames)
+        if not rejected.empty:
+            path = rejects_path or f"{sheet_name}.rejected.csv"
+            # الملف الجانبي يُنشأ من جديد مع أول دفعة فيها مرفوض في هذا الاستيراد
+            rejected.to_csv(path, mode="a" if stats["rejects_path"] else "w", header=not stats["rejects_path"],
+                            index=False, encoding="utf-8-sig" if not stats["rejects_path"] else "utf-8")
+            stats["rejects_path"] = path
+            for reason, count in rejected[REJECT_REASON_COLUMN].value_counts().items():
+                stats["reasons"][reason] = stats["reasons"].get(reason, 0) + int(count)
+        stats["imported"] += len(good)
+        stats["rejected"] += len(rejected)
+        stats["chunks"] += 1
+        if progress is not None:
+            progress(dict(stats))
+
+    try:
+        mapping = None
+        line = 2
+        for chunk in iter_ledger_chunks(source, name, chunk_size, excel_sheet):
+            if mapping is None:
+                mapping = ledger_column_map(list(chunk.columns), sheet_name)
+            stats["rows"] += len(chunk)
+            job = (sheet_name, chunk, mapping, line, closed)
+            line += len(chunk)
+            del chunk
+            if workers <= 1:
+                consume(validate_ledger_chunk(*job))
+                continue
+            if held is None and executor is None:
+                held = job
+                continue
+            if executor is None:
+                executor = process_pool(workers)
+                pending.append(executor.submit(validate_ledger_chunk, *held))
+                held = None
+            pending.append(executor.submit(validate_ledger_chunk, *job))
+            del job
+            # لا تبقى في الذاكرة إلا دفعات بقدر العمليات وواحدة تنتظر؛ الكتابة بترتيب الملف
+            while len(pending) > workers:
+                consume(pending.pop(0).result())
+        if held is not None:
+            consume(validate_ledger_chunk(*held))
+        while pending:
+            consume(pending.pop(0).result())
+    finally:
+        for future in pending:
+            future.cancel()
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+    return stats
+
+
+# -------------------------
+# كشف الشذوذ الإحصائي
+# -------------------------
+# عتبة الدرجة المعيارية المتينة |z| للمبلغ الشاذ (Iglewicz-Hoaglin)
+ANOMALY_Z_THRESHOLD = float(os.environ.get("ACCOUNTING_ANOMALY_Z", "3.5"))
+# أقل عدد قيود للطرف قبل تقييم مبالغه مقابل خط أساسه
+ANOMALY_MIN_HISTORY = 20
+# مدى لوغاريتم المبلغ (للأساس 10) وعرض فئة المدرج التكراري: من 0.01 إلى مليار، بدقة نحو 5%
+ANOMALY_LOG_RANGE = (-2.0, 9.0)
+ANOMALY_BIN_WIDTH = 0.02
+# احتمال كل رقم أول (1-9) حسب قانون بنفورد
+BENFORD_PROBABILITIES = [math.log10(1 + 1 / digit) for digit in range(1, 10)]
+# أقل عدد قيود لاختبار بنفورد، وحد عدم المطابقة لمتوسط الانحراف المطلق للرقم الأول (Nigrini)
+BENFORD_MIN_ROWS = 100
+BENFORD_MAD_THRESHOLD = 0.015
+# القيمة الحرجة لكاي تربيع بثماني درجات حرية (p = 0.001): الانحراف في العينات الصغيرة يلزم أن يكون دالًا أيضًا
+BENFORD_CHI2_CRITICAL = 26.12
+# نافذة معدل التكرار اليومي السابق بالأيام، وأقل عدد قيود في اليوم ومضاعف المعدل لعد اليوم طفرة
+ANOMALY_WINDOW_DAYS = 30
+ANOMALY_SPIKE_MIN = 5
+ANOMALY_SPIKE_FACTOR = 4
+
+
+class AnomalyIndex:
+    """خطوط أساس إحصائية لكل (طرف، عملة) في ورقة، تُحدّث تراكميًا مع كل إدراج دون مسح الورقة:
+    مدرج تكراري للوغاريتم المبلغ (للوسيط والانحراف المطلق الوسيط)، وعدد كل رقم أول (بنفورد)، وعدد القيود لكل يوم.
+    كل دفعة جديدة تُقيّم بالدرجة المعيارية المتينة مقابل خط الأساس قبلها ثم تُضاف إليه، فلا يمر التدقيق
+    اللاحق إلا بما أُدرج بعده؛ البناء الأول يقيّم كل الصفوف مقابل التاريخ كاملًا"""
+
+    BINS = int(round((ANOMALY_LOG_RANGE[1] - ANOMALY_LOG_RANGE[0]) / ANOMALY_BIN_WIDTH))
+    # مفتاح (مجموعة، يوم) كعدد صحيح واحد؛ الإزاحة تبقي الأيام السابقة لعام 1970 موجبة
+    DAY_SPAN = 2 ** 32
+    DAY_OFFSET = 2 ** 31
+
+    def __init__(self, df, party_column, ids=None):
+        self.party_column = party_column
+        self.rows = 0
+        self._codes = {}
+        self._keys = []
+        self._hist = np.zeros((0, self.BINS), dtype=np.int32)
+        self._digits = np.zeros((0, 9), dtype=np.int64)
+        self._days = []
+        # المجموعات التي تغيّرت أيامها منذ آخر حساب للطفرات، وطفرات كل مجموعة (اليوم، العدد، المعدل السابق)
+        self._stale = set()
+        self._spikes = {}
+        self._outliers = []
+        self._lock = threading.Lock()
+        self._add(df, ids, initial=True)
+
+    def add_frame(self, df, ids=None):
+        self._add(df, ids)
+
+    def add_record(self, record):
+        self._add(pd.DataFrame([record]), None)
+
+    def _group_codes(self, df):
+        # رموز المجموعات الفريدة في الدفعة فقط تمر بجدول التجزئة
+        parties, party_names = factorize_labels(df[self.party_column]) if self.party_column in df.columns else (
+            np.zeros(len(df), dtype=np.int64), pd.Index([""], dtype=object))
+        currencies, currency_names = factorize_labels(df["العملة"], BASE_CURRENCY) if "العملة" in df.columns else (
+            np.zeros(len(df), dtype=np.int64), pd.Index([BASE_CURRENCY], dtype=object))
+        pairs, uniques = pd.factorize(parties * len(currency_names) + currencies)
+        codes = np.empty(len(uniques), dtype=np.int64)
+        for i, pair in enumerate(uniques.tolist()):
+            key = (str(party_names[pair // len(currency_names)]), str(currency_names[pair % len(currency_names)]))
+            code = self._codes.get(key)
+            if code is None:
+                code = self._codes[key] = len(self._keys)
+                self._keys.append(key)
+                self._days.append({})
+            codes[i] = code
+        if len(self._keys) > len(self._hist):
+            # سعة مضاعفة حتى لا تُنسخ المصفوفات مع كل طرف جديد
+            grow = max(len(self._keys), 2 * len(self._hist)) - len(self._hist)
+            self._hist = np.vstack([self._hist, np.zeros((grow, self.BINS), dtype=np.int32)])
+            self._digits = np.vstack([self._digits, np.zeros((grow, 9), dtype=np.int64)])
+        return codes[pairs]
+
+    def _add(self, df, ids, initial=False):
+        if df is None or df.empty:
+            return
+        with self._lock:
+            n = len(df)
+            ids = np.arange(self.rows, self.rows + n) if ids is None else np.asarray(ids, dtype=np.int64)
+            self.rows += n
+            codes = self._group_codes(df)
+            amounts = np.abs(as_amounts(df["المبلغ"]).to_numpy()) if "المبلغ" in df.columns else np.full(n, np.nan)
+            valid = amounts > 0
+            valued = codes[valid]
+            logs = np.log10(amounts[valid])
+            bins = np.clip(((logs - ANOMALY_LOG_RANGE[0]) / ANOMALY_BIN_WIDTH).astype(np.int64), 0, self.BINS - 1)
+            groups, local = np.unique(valued, return_inverse=True)
+            if not initial and len(groups):
+                # تقييم الدفعة مقابل خط الأساس قبل إضافتها
+                self._score(groups, local, logs, ids[valid], amounts[valid])
+            counts = np.bincount(local * self.BINS + bins, minlength=len(groups) * self.BINS)
+            self._hist[groups] += counts.reshape(len(groups), self.BINS).astype(np.int32)
+            digits = self._first_digits(amounts[valid])
+            self._digits[groups] += np.bincount(local * 9 + digits - 1, minlength=len(groups) * 9).reshape(len(groups), 9)
+            if initial and len(groups):
+                self._score(groups, local, logs, ids[valid], amounts[valid])
+            self._count_days(codes, df)
+
+    @staticmethod
+    def _first_digits(amounts):
+        # الرقم الأول من الهللات بأعداد صحيحة، مع تصحيح خطأ التقريب في log10 عند قوى العشرة
+        minor = np.maximum(to_minor_units(amounts), 1)
+        power = 10 ** np.floor(np.log10(minor)).astype(np.int64)
+        power = np.where(minor // power >= 10, power * 10, power)
+        power = np.where(minor // power == 0, power // 10, power)
+        return (minor // power).astype(np.int64)
+
+    @staticmethod
+    def _median_bins(hist):
+        """رقم فئة الوسيط في كل صف من مدرج تكراري (الوسيط الأدنى عند العدد الزوجي)"""
+        cumulative = hist.cumsum(axis=1)
+        return (cumulative < (cumulative[:, -1:] / 2)).sum(axis=1)
+
+    def _score(self, groups, local, logs, ids, amounts):
+        """الدرجة المعيارية المتينة 0.6745 (x - الوسيط) / الانحراف المطلق الوسيط على لوغاريتم المبلغ، لكل مجموعة"""
+        hist = self._hist[groups]
+        median = self._median_bins(hist)
+        distance = np.abs(np.arange(self.BINS) - median[:, None])
+        spread = np.bincount(
+            (np.arange(len(groups))[:, None] * self.BINS + distance).ravel(), weights=hist.ravel(), minlength=hist.size
+        ).reshape(hist.shape)
+        # انحراف لا يقل عن فئة واحدة، فالطرف الذي يكرر مبلغًا واحدًا لا يجعل كل فرق طفيف شاذًا
+        mad = np.maximum(self._median_bins(spread), 1) * ANOMALY_BIN_WIDTH
+        center = ANOMALY_LOG_RANGE[0] + (median + 0.5) * ANOMALY_BIN_WIDTH
+        z = 0.6745 * (logs - center[local]) / mad[local]
+        flagged = (hist.sum(axis=1)[local] >= ANOMALY_MIN_HISTORY) & (np.abs(z) > ANOMALY_Z_THRESHOLD)
+        if flagged.any():
+            self._outliers.append(pd.DataFrame({
+                "id": ids[flagged], "group": groups[local[flagged]], "amount": amounts[flagged],
+                "z": z[flagged], "median": 10 ** center[local[flagged]],
+            }))
+
+    def _count_days(self, codes, df):
+        if "التاريخ" not in df.columns:
+            return
+        dates = as_dates(df["التاريخ"])
+        dated = dates.notna().to_numpy()
+        days = dates.to_numpy(dtype="datetime64[D]")[dated].astype(np.int64)
+        keys, counts = np.unique(codes[dated] * self.DAY_SPAN + days + self.DAY_OFFSET, return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            group, day = divmod(key, self.DAY_SPAN)
+            table = self._days[group]
+            table[day] = table.get(day, 0) + count
+            self._stale.add(group)
+
+    def _refresh_spikes(self):
+        """إعادة حساب الطفرات للمجموعات التي تغيّرت أيامها فقط: عدد كل يوم مقابل معدل النافذة السابقة له"""
+        groups = sorted(self._stale)
+        self._stale.clear()
+        if not groups:
+            return
+        keys = np.fromiter((g * self.DAY_SPAN + day for g in groups for day in self._days[g]), dtype=np.int64)
+        counts = np.fromiter((c for g in groups for c in self._days[g].values()), dtype=np.int64, count=len(keys))
+        order = np.argsort(keys)
+        keys, counts = keys[order], counts[order]
+        group_of = keys // self.DAY_SPAN
+        days = keys % self.DAY_SPAN
+        cumulative = np.concatenate([[0], np.cumsum(counts)])
+        start = np.searchsorted(keys, keys - ANOMALY_WINDOW_DAYS, side="left")
+        rate = (cumulative[:-1] - cumulative[start]) / ANOMALY_WINDOW_DAYS
+        # لا يُحكم على طرف قبل أن تكتمل له نافذة كاملة من التاريخ
+        history = days - days[np.searchsorted(group_of, group_of, side="left")]
+        flagged = (
+            (history >= ANOMALY_WINDOW_DAYS) & (counts >= ANOMALY_SPIKE_MIN)
+            & (counts >= ANOMALY_SPIKE_FACTOR * np.maximum(rate, 1.0))
+        )
+        for group in groups:
+            self._spikes.pop(group, None)
+        for group, day, count, previous in zip(group_of[flagged].tolist(), (days[flagged] - self.DAY_OFFSET).tolist(),
+                                               counts[flagged].tolist(), rate[flagged].tolist()):
+            self._spikes.setdefault(group, []).append((day, count, previous))
+
+    def _labels(self, groups):
+        keys = [self._keys[g] for g in groups]
+        return [k[0] for k in keys], [k[1] for k in keys]
+
+    def outliers(self):
+        """القيود ذات المبالغ الشاذة مرتبة حسب |z|: (id، الطرف، العملة، المبلغ، z، الوسيط)"""
+        with self._lock:
+            parts = list(self._outliers)
+        if not parts:
+            return pd.DataFrame(columns=["id", self.party_column, "العملة", "المبلغ", "z", "الوسيط"])
+        table = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+        table = table.iloc[np.argsort(-np.abs(table["z"].to_numpy()), kind="stable")].reset_index(drop=True)
+        parties, currencies = self._labels(table["group"].tolist())
+        return pd.DataFrame({
+            "id": table["id"].to_numpy(), self.party_column: parties, "العملة": currencies,
+            "المبلغ": table["amount"].to_numpy(), "z": table["z"].to_numpy(), "الوسيط": table["median"].to_numpy(),
+        })
+
+    def benford(self):
+        """متوسط الانحراف المطلق وكاي تربيع لتوزيع الرقم الأول عن بنفورد لكل مجموعة فيها BENFORD_MIN_ROWS قيدًا
+        على الأقل، وللورقة كلها ("الكل")، مرتبًا تنازليًا"""
+        with self._lock:
+            digits = self._digits[:len(self._keys)].copy()
+            parties, currencies = self._labels(range(len(self._keys)))
+        digits = np.vstack([digits, digits.sum(axis=0, keepdims=True)])
+        parties.append("الكل")
+        currencies.append("")
+        totals = digits.sum(axis=1)
+        shares = digits / np.maximum(totals, 1)[:, None]
+        expected = np.array(BENFORD_PROBABILITIES)
+        excess = shares - expected
+        eligible = totals >= BENFORD_MIN_ROWS
+        table = pd.DataFrame({
+            self.party_column: np.array(parties, dtype=object)[eligible],
+            "العملة": np.array(currencies, dtype=object)[eligible],
+            "العدد": totals[eligible],
+            "متوسط الانحراف": np.abs(excess).mean(axis=1)[eligible],
+            "كاي تربيع": (totals[:, None] * excess ** 2 / expected).sum(axis=1)[eligible],
+            "الرقم الأكثر زيادة": excess.argmax(axis=1)[eligible] + 1,
+        })
+        return table.sort_values("متوسط الانحراف", ascending=False, ignore_index=True)
+
+    def spikes(self):
+        """الأيام التي قفز فيها عدد قيود الطرف عن معدله في النافذة السابقة، الأحدث أولًا"""
+        with self._lock:
+            self._refresh_spikes()
+            rows = [(group, day, count, previous) for group, items in self._spikes.items() for day, count, previous in items]
+            parties, currencies = self._labels([row[0] for row in rows])
+        table = pd.DataFrame({
+            self.party_column: parties, "العملة": currencies,
+            "التاريخ": pd.to_datetime(np.array([row[1] for row in rows], dtype="datetime64[D]")),
+            "العدد": np.array([row[2] for row in rows], dtype=np.int64),
+            "المعدل اليومي السابق": np.round([row[3] for row in rows], 2),
+        })
+        return table.sort_values(["التاريخ", "العدد"], ascending=False, ignore_index=True)
+
+
+def anomaly_index(sheet_name, buffer=None):
+    """فهرس الشذوذ للورقة: من صفوف SQLite الجديدة فقط في نمط sqlite، وإلا من مخزن الورقة في الذاكرة"""
+    party_column = PARTY_COLUMNS.get(sheet_name)
+    if buffer is None and STORAGE_MODE == "sqlite":
+        return sqlite_ledger.anomalies(sheet_name)
+    buffer = buffer if buffer is not None else ledger_cache.get(sheet_name)
+    return buffer.index("anomalies", lambda df: AnomalyIndex(df, party_column))
+
+
+# -------------------------
+# محرك التدقيق
+# -------------------------
+# الورقة ← ورقة السجل الذي يجب أن يكون الطرف مسجلًا فيه
+PARTY_REGISTRIES = {"المبيعات": "العملاء", "المشتريات": "الموردين"}
+# عدد الأيام التي يُعد بعدها القيد المعلق عالقًا
+PENDING_STALE_DAYS = 30
+# أنماط التدقيق: فحوصات القواعد على كل الصفوف، أو كشف الشذوذ من خطوط الأساس التراكمية (AnomalyIndex)
+AUDIT_MODES = {"rules": "قواعد التحقق", "anomalies": "كشف الشذوذ الإحصائي"}
+
+
+def normalize_party_names(values):
+    """توحيد أسماء الأطراف للمطابقة التقريبية (المسافات، التشكيل، الهمزات، التاء المربوطة)؛
+    يُطبق على القيم الفريدة فقط ثم يُعاد توزيعه"""
+    codes, uniques = pd.factorize(pd.Series(values, dtype="object").fillna("").astype(str))
+    normalized = _normalize_unique_names(uniques)
+    return pd.Series(normalized.to_numpy()[codes] if len(uniques) else [], index=getattr(values, "index", None), dtype="object")
+
+
+def _normalize_unique_names(uniques):
+    return (
+        pd.Series(uniques, dtype="object")
+        .str.strip()
+        .str.replace(r'\s+', ' ', regex=True)
+        .str.replace(r'[\u064B-\u0652\u0640]', '', regex=True)
+        .str.replace(r'[أإآ]', 'ا', regex=True)
+        .str.replace('ة', 'ه', regex=False)
+        .str.replace('ى', 'ي', regex=False)
+        .str.casefold()
+    )
+
+
+class AuditEngine:
+    """فحوصات تدقيق متجهة على كل الأوراق، مع قياس زمن كل فحص"""
+
+    def __init__(self, today=None, stale_days=PENDING_STALE_DAYS, sample_size=20, mode="rules"):
+        self.today = pd.Timestamp(today or datetime.now()).normalize()
+        self.stale_days = stale_days
+        self.sample_size = sample_size
+        self.mode = mode
+
+    def run(self, data):
+        """تشغيل كل الفحوصات وإرجاع نتائج بالشكل الذي يعرضه display_audit_results"""
+        timings = {}
+        issues = []
+        started = time.perf_counter()
+
+        t = time.perf_counter()
+        if self.mode == "anomalies":
+            # خطوط الأساس تُحدّث بالصفوف الجديدة فقط؛ الفحوصات بعدها تقرأ المجاميع لا الأوراق
+            prepared = self.anomaly_indexes(data)
+            timings["تحديث خطوط الأساس"] = time.perf_counter() - t
+            checks = [
+                ("المبالغ الشاذة", lambda p: self.check_outliers(p, data)),
+                ("قانون بنفورد", self.check_benford),
+                ("طفرات التكرار", self.check_spikes),
+            ]
+            rows = sum(index.rows for index in prepared.values())
+        else:
+            prepared = self.prepare(data)
+            timings["تهيئة الأعمدة"] = time.perf_counter() - t
+            checks = [
+                ("التواريخ", self.check_dates),
+                ("المبالغ", self.check_amounts),
+                ("القيود المكررة", self.check_duplicates),
+                ("الأطراف غير المسجلة", lambda p: self.check_parties(p, data)),
+                ("القيود المعلقة", self.check_pending),
+            ]
+            rows = sum(p["rows"] for p in prepared.values())
+
+        for name, check in checks:
+            t = time.perf_counter()
+            issues.extend(check(prepared))
+            timings[name] = time.perf_counter() - t
+
+        timings["الإجمالي"] = time.perf_counter() - started
+        return {
+            "status": "تم التدقيق" + ("" if issues else " — لم تُكتشف مشكلات"),
+            "issues_found": issues,
+            "recommendations": self._recommendations(issues),
+            "timings": timings,
+            "rows_checked": rows,
+        }
+
+    def prepare(self, data):
+        return {
+            sheet_name: self._prepare(data[sheet_name], PARTY_COLUMNS[sheet_name])
+            for sheet_name in PARTY_COLUMNS if sheet_name in data
+        }
+
+    def _prepare(self, df, party_column):
+        n = len(df)
+        raw_amounts = df["المبلغ"] if "المبلغ" in df.columns else pd.Series([None] * n, index=df.index)
+        party = df[party_column] if party_column in df.columns else pd.Series("", index=df.index, dtype="object")
+        # ترميز الأطراف كأعداد صحيحة: الاسم الأصلي والاسم الموحد، حتى تتم المقارنات والتجزئة على أعداد لا نصوص
+        party_codes, uniques = pd.factorize(as_labels(party).astype(str))
+        normalized_uniques = _normalize_unique_names(uniques)
+        normalized_codes, normalized_names = pd.factorize(normalized_uniques)
+        return {
+            "frame": df,
+            "rows": n,
+            "dates": as_dates(df["التاريخ"]) if "التاريخ" in df.columns else pd.Series(pd.NaT, index=df.index),
+            "amounts": as_amounts(raw_amounts),
+            "party": party,
+            "party_codes": party_codes,
+            "normalized_codes": normalized_codes[party_codes] if len(uniques) else party_codes,
+            "normalized_names": normalized_names,
+            "status": df["الحالة"] if "الحالة" in df.columns else pd.Series("", index=df.index, dtype="object"),
+        }
+
+    def _issue(self, kind, sheet_name, mask, description, suggestion, frame):
+        count = int(mask.sum())
+        if not count:
+            return []
+        return [{
+            "type": kind,
+            "sheet": sheet_name,
+            "count": count,
+            "description": f"{sheet_name}: {count:,} {description}",
+            "suggestion": suggestion,
+            "sample": frame.iloc[np.flatnonzero(mask.to_numpy())[:self.sample_size]],
+        }]
+
+    def check_dates(self, prepared):
+        issues = []
+        for sheet_name, p in prepared.items():
+            issues += self._issue("تاريخ غير صالح", sheet_name, p["dates"].isna(),
+                                  "قيد بتاريخ مفقود أو غير قابل للقراءة", "تصحيح التاريخ بصيغة YYYY-MM-DD", p["frame"])
+            issues += self._issue("تاريخ مستقبلي", sheet_name, p["dates"] > self.today,
+                                  "قيد بتاريخ لاحق لتاريخ اليوم", "التحقق من تاريخ القيد أو تأجيله", p["frame"])
+        return issues
+
+    def check_amounts(self, prepared):
+        issues = []
+        for sheet_name, p in prepared.items():
+            issues += self._issue("مبلغ غير رقمي", sheet_name, p["amounts"].isna(),
+                                  "قيد بمبلغ مفقود أو غير رقمي", "إدخال المبلغ كرقم", p["frame"])
+            issues += self._issue("مبلغ سالب", sheet_name, p["amounts"] < 0,
+                                  "قيد بمبلغ سالب", "استخدام قيد عكسي بدل المبلغ السالب", p["frame"])
+        return issues
+
+    def check_duplicates(self, prepared):
+        """المكرر التام: نفس (التاريخ، الطرف، المبلغ)؛ شبه المكرر: نفس التاريخ والمبلغ المقرّب مع اسم طرف موحد"""
+        issues = []
+        for sheet_name, p in prepared.items():
+            if p["frame"].empty:
+                continue
+            exact_key = pd.util.hash_pandas_object(pd.DataFrame({
+                "date": p["dates"], "party": p["party_codes"], "amount": p["amounts"]
+            }, index=p["frame"].index), index=False)
+            exact = exact_key.duplicated(keep=False)
+            near_key = pd.util.hash_pandas_object(pd.DataFrame({
+                "date": p["dates"], "party": p["normalized_codes"], "amount": p["amounts"].round(0)
+            }, index=p["frame"].index), index=False)
+            near = near_key.duplicated(keep=False) & ~exact
+            issues += self._issue("قيد مكرر", sheet_name, exact,
+                                  "قيد يتكرر بنفس التاريخ والطرف والمبلغ", "حذف التكرار أو توثيق سببه", p["frame"])
+            issues += self._issue("قيد شبه مكرر", sheet_name, near,
+                                  "قيد يشبه قيدًا آخر (نفس التاريخ والمبلغ تقريبًا واسم طرف متقارب)", "مراجعة القيود المتشابهة", p["frame"])
+        return issues
+
+    def check_parties(self, prepared, data):
+        issues = []
+        for sheet_name, registry in PARTY_REGISTRIES.items():
+            if sheet_name not in prepared or registry not in data:
+                continue
+            p = prepared[sheet_name]
+            registered = data[registry]
+            names = set(normalize_party_names(registered["الاسم"])) if "الاسم" in registered.columns else set()
+            known = np.fromiter((name in names for name in p["normalized_names"]), dtype=bool, count=len(p["normalized_names"]))
+            missing = pd.Series(~known[p["normalized_codes"]] if len(known) else np.ones(len(p["frame"]), dtype=bool), index=p["frame"].index)
+            unique_missing = p["party"][missing].nunique()
+            issues += self._issue("طرف غير مسجل", sheet_name, missing,
+                                  f"قيد لأطراف غير موجودة في {registry} ({unique_missing:,} طرف)",
+                                  f"إضافة الأطراف إلى ورقة {registry}", p["frame"])
+        return issues
+
+    def check_pending(self, prepared):
+        issues = []
+        cutoff = self.today - pd.Timedelta(days=self.stale_days)
+        for sheet_name, p in prepared.items():
+            stale = (p["status"] == "معلقة") & (p["dates"] < cutoff)
+            issues += self._issue("قيد معلق", sheet_name, stale,
+                                  f"قيد بحالة \"معلقة\" منذ أكثر من {self.stale_days} يومًا",
+                                  "متابعة التحصيل/السداد أو إغلاق القيد", p["frame"])
+        return issues
+
+    def anomaly_indexes(self, data):
+        return {
+            sheet_name: anomaly_index(sheet_name, data.buffer(sheet_name) if isinstance(data, Ledger)
+                                      else SheetBuffer(SHEET_COLUMNS[sheet_name], data[sheet_name]))
+            for sheet_name in PARTY_COLUMNS if sheet_name in data
+        }
+
+    def _rows_by_id(self, sheet_name, data, ids):
+        """صفوف الورقة بأرقامها في فهرس الشذوذ (ترتيبها في المخزن) وبنفس الترتيب"""
+        return data[sheet_name].iloc[ids].reset_index(drop=True)
+
+    def _table_issue(self, kind, sheet_name, count, description, suggestion, sample):
+        if not count:
+            return []
+        return [{
+            "type": kind,
+            "sheet": sheet_name,
+            "count": count,
+            "description": f"{sheet_name}: {count:,} {description}",
+            "suggestion": suggestion,
+            "sample": sample,
+        }]
+
+    def check_outliers(self, indexes, data):
+        issues = []
+        for sheet_name, index in indexes.items():
+            outliers = index.outliers()
+            if outliers.empty:
+                continue
+            top = outliers.head(self.sample_size)
+            sample = self._rows_by_id(sheet_name, data, top["id"].tolist())
+            sample["الدرجة المعيارية"] = top["z"].round(2).to_numpy()
+            sample["المبلغ المعتاد"] = top["الوسيط"].round(2).to_numpy()
+            issues += self._table_issue("مبلغ شاذ", sheet_name, len(outliers),
+                                        f"قيد بمبلغ بعيد عن المعتاد لطرفه (درجة معيارية متينة تتجاوز {ANOMALY_Z_THRESHOLD:g})",
+                                        "مراجعة المستندات المؤيدة للقيود ذات المبالغ غير المعتادة", sample)
+        return issues
+
+    def check_benford(self, indexes):
+        issues = []
+        for sheet_name, index in indexes.items():
+            table = index.benford()
+            flagged = table[(table["متوسط الانحراف"] > BENFORD_MAD_THRESHOLD) & (table["كاي تربيع"] > BENFORD_CHI2_CRITICAL)]
+            issues += self._table_issue("انحراف عن بنفورد", sheet_name, len(flagged),
+                                        "طرف يخالف توزيع الرقم الأول في مبالغه قانون بنفورد",
+                                        "فحص مبالغ هذه الأطراف بحثًا عن أرقام مقرّبة أو مختلقة أو مجزأة تحت حد الاعتماد",
+                                        flagged.head(self.sample_size).round(4))
+        return issues
+
+    def check_spikes(self, indexes):
+        issues = []
+        for sheet_name, index in indexes.items():
+            table = index.spikes()
+            issues += self._table_issue("طفرة تكرار", sheet_name, len(table),
+                                        f"يوم بلغ فيه عدد قيود الطرف {ANOMALY_SPIKE_FACTOR} أضعاف معدله اليومي في {ANOMALY_WINDOW_DAYS} يومًا سابقة",
+                                        "التحقق من قيود هذه الأيام (إدخال مكرر أو تجزئة معاملة واحدة)",
+                                        table.head(self.sample_size))
+        return issues
+
+    @staticmethod
+    def _recommendations(issues):
+        kinds = {issue["type"] for issue in issues}
+        recommendations = []
+        if kinds & {"تاريخ غير صالح", "تاريخ مستقبلي", "مبلغ غير رقمي", "مبلغ سالب"}:
+            recommendations.append("تفعيل التحقق من الحقول عند الإدخال والاستيراد")
+        if kinds & {"قيد مكرر", "قيد شبه مكرر"}:
+            recommendations.append("مراجعة إجراءات الإدخال لتفادي تكرار القيود")
+        if "طرف غير مسجل" in kinds:
+            recommendations.append("استكمال بيانات العملاء والموردين")
+        if "قيد معلق" in kinds:
+            recommendations.append("جدولة متابعة دورية للقيود المعلقة")
+        if kinds & {"مبلغ شاذ", "انحراف عن بنفورد", "طفرة تكرار"}:
+            recommendations.append("مراجعة القيود غير المعتادة مع مستنداتها، ووضع حد اعتماد للمبالغ الكبيرة")
+        return recommendations
+
+
+class SqliteAuditEngine(AuditEngine):
+    """نفس فحوصات AuditEngine منفذة كاستعلامات على قاعدة SQLite دون تحميل الأوراق في الذاكرة؛
+    الأسماء الموحدة تُحسب مرة لكل طرف فريد في جداول مؤقتة على الاتصال نفسه"""
+
+    def __init__(self, store=None, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store or sqlite_ledger
+
+    def anomaly_indexes(self, conn):
+        return {sheet_name: self.store.anomalies(sheet_name) for sheet_name in PARTY_COLUMNS}
+
+    def _rows_by_id(self, sheet_name, conn, ids):
+        columns = ", ".join(quote_identifier(c) for c in SHEET_COLUMNS[sheet_name])
+        rows = pd.read_sql_query(
+            f"SELECT rowid AS rid, {columns} FROM {quote_identifier(sheet_name)} WHERE rowid IN ({', '.join('?' * len(ids))})",
+            conn, params=[int(i) for i in ids]
+        )
+        return rows.set_index("rid").reindex(ids).reset_index(drop=True)
+
+    def run(self, data=None):
+        self.store.ensure_schema()
+        with self.store.pool.connection() as conn:
+            try:
+                return super().run(conn)
+            finally:
+                conn.execute("DROP TABLE IF EXISTS temp.party_norm")
+                conn.execute("DROP TABLE IF EXISTS temp.registry_norm")
+
+    def prepare(self, conn):
+        # جدول مؤقت (الاسم الأصلي ← الاسم الموحد) لكل الأطراف في أوراق المعاملات والسجلات
+        names = set()
+        for sheet_name, column in list(PARTY_COLUMNS.items()) + [(r, "الاسم") for r in PARTY_REGISTRIES.values()]:
+            names.update(
+                row[0] for row in conn.execute(f"SELECT DISTINCT {quote_identifier(column)} FROM {quote_identifier(sheet_name)}")
+                if row[0] is not None
+            )
+        names = sorted(str(n) for n in names)
+        conn.execute("DROP TABLE IF EXISTS temp.party_norm")
+        conn.execute("CREATE TEMP TABLE party_norm (party TEXT PRIMARY KEY, norm TEXT)")
+        conn.executemany("INSERT INTO temp.party_norm VALUES (?, ?)", zip(names, _normalize_unique_names(names).tolist()))
+        return {
+            sheet_name: {
+                "conn": conn,
+                "table": quote_identifier(sheet_name),
+                "party": quote_identifier(column),
+                "rows": conn.execute(f"SELECT COUNT(*) FROM {quote_identifier(sheet_name)}").fetchone()[0],
+            }
+            for sheet_name, column in PARTY_COLUMNS.items()
+        }
+
+    def _sql_issue(self, kind, sheet_name, p, where, description, suggestion, params=()):
+        conn, table = p["conn"], p["table"]
+        count = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE {where}", params).fetchone()[0]
+        if not count:
+            return []
+        columns = ", ".join(quote_identifier(c) for c in SHEET_COLUMNS[sheet_name])
+        sample = pd.read_sql_query(
+            f"SELECT {columns} FROM {table} WHERE {where} ORDER BY rowid LIMIT ?", conn, params=tuple(params) + (self.sample_size,)
+        )
+        return [{
+            "type": kind,
+            "sheet": sheet_name,
+            "count": count,
+            "description": f"{sheet_name}: {count:,} {description}",
+            "suggestion": suggestion,
+            "sample": sample,
+        }]
+
+    def check_dates(self, prepared):
+        issues = []
+        for sheet_name, p in prepared.items():
+            issues += self._sql_issue("تاريخ غير صالح", sheet_name, p, f"{sql_day()} IS NULL",
+                                      "قيد بتاريخ مفقود أو غير قابل للقراءة", "تصحيح التاريخ بصيغة YYYY-MM-DD")
+            issues += self._sql_issue("تاريخ مستقبلي", sheet_name, p, f"{sql_day()} > ?",
+                                      "قيد بتاريخ لاحق لتاريخ اليوم", "التحقق من تاريخ القيد أو تأجيله",
+                                      (self.today.strftime("%Y-%m-%d"),))
+        return issues
+
+    def check_amounts(self, prepared):
+        amount = quote_identifier('المبلغ')
+        issues = []
+        for sheet_name, p in prepared.items():
+            issues += self._sql_issue("مبلغ غير رقمي", sheet_name, p, f"typeof({amount}) NOT IN ('integer', 'real')",
+                                      "قيد بمبلغ مفقود أو غير رقمي", "إدخال المبلغ كرقم")
+            issues += self._sql_issue("مبلغ سالب", sheet_name, p, f"typeof({amount}) IN ('integer', 'real') AND {amount} < 0",
+                                      "قيد بمبلغ سالب", "استخدام قيد عكسي بدل المبلغ السالب")
+        return issues
+
+    def check_duplicates(self, prepared):
+        """عدّ أفراد كل مجموعة بدوال النوافذ: (التاريخ، الطرف، المبلغ) للمكرر، و(التاريخ، الاسم الموحد، المبلغ المقرّب) لشبه المكرر"""
+        amount = quote_identifier('المبلغ')
+        issues = []
+        for sheet_name, p in prepared.items():
+            if not p["rows"]:
+                continue
+            # تُحسب النوافذ مرة واحدة وتُحفظ الصفوف المعلّمة فقط في جدول مؤقت
+            p["conn"].execute("DROP TABLE IF EXISTS temp.duplicate_rows")
+            p["conn"].execute(
+                f"CREATE TEMP TABLE duplicate_rows AS SELECT rid, exact_n > 1 AS exact FROM ("
+                f"SELECT t.rowid AS rid, "
+                f"COUNT(*) OVER (PARTITION BY {sql_day()}, t.{p['party']}, t.{amount}) AS exact_n, "
+                f"COUNT(*) OVER (PARTITION BY {sql_day()}, n.norm, ROUND(t.{amount})) AS near_n "
+                f"FROM {p['table']} AS t LEFT JOIN temp.party_norm AS n ON n.party = t.{p['party']}"
+                f") WHERE exact_n > 1 OR near_n > 1"
+            )
+            issues += self._sql_issue("قيد مكرر", sheet_name, p, "rowid IN (SELECT rid FROM temp.duplicate_rows WHERE exact)",
+                                      "قيد يتكرر بنفس التاريخ والطرف والمبلغ", "حذف التكرار أو توثيق سببه")
+            issues += self._sql_issue("قيد شبه مكرر", sheet_name, p, "rowid IN (SELECT rid FROM temp.duplicate_rows WHERE NOT exact)",
+                                      "قيد يشبه قيدًا آخر (نفس التاريخ والمبلغ تقريبًا واسم طرف متقارب)", "مراجعة القيود المتشابهة")
+            p["conn"].execute("DROP TABLE temp.duplicate_rows")
+        return issues
+
+    def check_parties(self, prepared, conn):
+        issues = []
+        for sheet_name, registry in PARTY_REGISTRIES.items():
+            p = prepared[sheet_name]
+            conn.execute("DROP TABLE IF EXISTS temp.registry_norm")
+            conn.execute(
+                f"CREATE TEMP TABLE registry_norm AS SELECT DISTINCT n.norm AS norm FROM {quote_identifier(registry)} AS r "
+                f"JOIN temp.party_norm AS n ON n.party = r.{quote_identifier('الاسم')}"
+            )
+            # الأطراف الفارغة تُعامل كغير مسجلة كما في AuditEngine
+            unknown = (
+                f"SELECT n.party FROM temp.party_norm AS n WHERE n.norm NOT IN (SELECT norm FROM temp.registry_norm)"
+            )
+            where = f"COALESCE({p['party']}, '') IN ({unknown}) OR COALESCE({p['party']}, '') = ''"
+            unique_missing = conn.execute(f"SELECT COUNT(DISTINCT {p['party']}) FROM {p['table']} WHERE {where}").fetchone()[0]
+            issues += self._sql_issue("طرف غير مسجل", sheet_name, p, where,
+                                      f"قيد لأطراف غير موجودة في {registry} ({unique_missing:,} طرف)",
+                                      f"إضافة الأطراف إلى ورقة {registry}")
+        return issues
+
+    def check_pending(self, prepared):
+        cutoff = (self.today - pd.Timedelta(days=self.stale_days)).strftime("%Y-%m-%d")
+        issues = []
+        for sheet_name, p in prepared.items():
+            issues += self._sql_issue("قيد معلق", sheet_name, p, f"{quote_identifier('الحالة')} = 'معلقة' AND {sql_day()} < ?",
+                                      f"قيد بحالة \"معلقة\" منذ أكثر من {self.stale_days} يومًا",
+                                      "متابعة التحصيل/السداد أو إغلاق القيد", (cutoff,))
+        return issues
+
+
+# -------------------------
+# المطابقة البنكية
+# -------------------------
+# ورقة الدفتر ← اتجاه الحركة المقابلة في الكشف: الإيداع يقابل المبيعات، والسحب يقابل المشتريات والمصروفات
+RECONCILE_SHEETS = {"المبيعات": 1, "المشتريات": -1, "المصروفات": -1}
+# الحالة التي ينتقل إليها القيد المفتوح بعد مطابقته بحركة بنكية
+SETTLED_STATUS = "مكتمل"
+# أقصى فرق بالأيام بين تاريخ الحركة في الكشف وتاريخ القيد
+RECONCILE_WINDOW_DAYS = int(os.environ.get("ACCOUNTING_RECONCILE_WINDOW_DAYS", "3"))
+# نسبة السماح في المبلغ للمطابقة التقريبية بالاسم (رسوم التحويل وفروق الصرف)
+RECONCILE_AMOUNT_TOLERANCE = 0.02
+# أقصى عدد كلمات لاسم الطرف الذي يُبحث عنه في وصف الحركة
+RECONCILE_NAME_WORDS = 4
+# أعمدة الكشف بعد القراءة
+STATEMENT_COLUMNS = ["التاريخ", "المبلغ", "الوصف", "المرجع"]
+# العمود الموحد ← أسماء الأعمدة المقبولة في ملفات CSV البنكية (بأحرف صغيرة)
+STATEMENT_HEADERS = {
+    "التاريخ": ["التاريخ", "تاريخ العملية", "تاريخ الحركة", "date", "transaction date", "posting date", "value date", "booking date"],
+    "المبلغ": ["المبلغ", "القيمة", "amount", "transaction amount", "value"],
+    "مدين": ["مدين", "سحب", "debit", "withdrawal", "withdrawals", "debit amount"],
+    "دائن": ["دائن", "إيداع", "ايداع", "credit", "deposit", "deposits", "credit amount"],
+    "الوصف": ["الوصف", "البيان", "التفاصيل", "description", "details", "narrative", "memo", "payee", "name"],
+    "المرجع": ["المرجع", "رقم المرجع", "reference", "ref", "fitid", "transaction id", "id"],
+}
+# صيغ التاريخ اليومية الشائعة في الكشوف (اليوم قبل الشهر)
+STATEMENT_DATE_FORMATS = ["%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y"]
+# حقول حركة OFX/QFX ← العمود المقابل
+OFX_FIELDS = {"DTPOSTED": "التاريخ", "TRNAMT": "المبلغ", "NAME": "الاسم", "MEMO": "الملاحظة", "FITID": "المرجع"}
+
+
+def read_bank_statement(source, name=""):
+    """قراءة كشف حساب بنكي (CSV أو OFX/QFX) إلى إطار بأعمدة STATEMENT_COLUMNS؛
+    المبلغ موجب للإيداع وسالب للسحب، والتاريخ datetime64"""
+    data = source.read() if hasattr(source, "read") else source
+    text = data.decode("utf-8-sig", errors="replace") if isinstance(data, bytes) else data
+    if name.lower().endswith((".ofx", ".qfx")) or re.search(r"OFXHEADER|<OFX>", text[:4096], re.IGNORECASE):
+        df = _read_ofx(text)
+    else:
+        df = _read_statement_csv(text)
+    return pd.DataFrame({
+        "التاريخ": _statement_dates(df["التاريخ"]),
+        "المبلغ": _statement_amounts(df["المبلغ"]).round(2),
+        "الوصف": df["الوصف"].fillna("").astype(str).str.strip(),
+        "المرجع": df["المرجع"].fillna("").astype(str).str.strip(),
+    })
+
+
+def _read_ofx(text):
+    # كل حركة كتلة STMTTRN؛ الحقول تُستخرج من كل الكتل معًا بتعابير متجهة (صيغة SGML بلا وسوم إغلاق أو XML)
+    blocks = pd.Series(re.split(r"<STMTTRN>", text, flags=re.IGNORECASE)[1:], dtype=object)
+    fields = {
+        column: blocks.str.extract(rf"<{tag}>\s*([^<\r\n]*)", flags=re.IGNORECASE, expand=False).str.strip()
+        for tag, column in OFX_FIELDS.items()
+    }
+    description = (fields["الاسم"].fillna("") + " " + fields["الملاحظة"].fillna("")).str.strip()
+    return pd.DataFrame({
+        # YYYYMMDD[HHMMSS[.XXX][TZ]]: اليوم يكفي للمطابقة
+        "التاريخ": pd.to_datetime(fields["التاريخ"].str[:8], format="%Y%m%d", errors='coerce'),
+        "المبلغ": fields["المبلغ"], "الوصف": description, "المرجع": fields["المرجع"],
+    })
+
+
+def _read_statement_csv(text):
+    df = pd.read_csv(io.StringIO(text), dtype=str, keep_default_na=False, skipinitialspace=True)
+    if len(df.columns) == 1 and ";" in df.columns[0]:
+        # كشوف بفاصل منقوطة (الشائع مع الفاصلة العشرية)
+        df = pd.read_csv(io.StringIO(text), dtype=str, keep_default_na=False, skipinitialspace=True, sep=";")
+    aliases = {alias: column for column, names in STATEMENT_HEADERS.items() for alias in names}
+    headers = [str(header) for header in df.columns]
+    renamed = {}
+    for header in df.columns:
+        column = aliases.get(str(header).strip().casefold())
+        if column and column not in renamed.values():
+            renamed[header] = column
+    df = df[list(renamed)].rename(columns=renamed)
+    if "المبلغ" not in df.columns and {"مدين", "دائن"} & set(df.columns):
+        credit = _statement_amounts(df["دائن"]).fillna(0) if "دائن" in df.columns else 0.0
+        debit = _statement_amounts(df["مدين"]).fillna(0).abs() if "مدين" in df.columns else 0.0
+        df["المبلغ"] = credit - debit
+    missing = {"التاريخ", "المبلغ"} - set(df.columns)
+    if missing:
+        raise ValueError(f"كشف الحساب بلا عمود {'، '.join(sorted(missing))} (أعمدة الملف: {'، '.join(headers)})")
+    for column in ("الوصف", "المرجع"):
+        if column not in df.columns:
+            df[column] = ""
+    return df
+
+
+def _statement_dates(values):
+    # ISO أولًا، ثم الصيغ اليومية الشائعة في الكشوف بصيغة ثابتة (سريعة)، ثم التحليل المرن لما تبقى فقط
+    dates = as_dates(values)
+    text = values.astype(str).str.strip()
+    for date_format in STATEMENT_DATE_FORMATS + ["mixed"]:
+        retry = dates.isna() & values.notna() & text.ne("")
+        if not retry.any():
+            break
+        dates[retry] = pd.to_datetime(text[retry], errors='coerce', format=date_format, dayfirst=True)
+    return dates.dt.normalize()
+
+
+def _statement_amounts(values):
+    # الأرقام البسيطة مباشرة؛ ما تبقى يُنظف من الأرقام العربية والفواصل وعلامات العملة، والسالب بين قوسين أو بعلامة لاحقة
+    number = pd.to_numeric(values, errors='coerce').astype(float)
+    retry = number.isna() & values.notna()
+    if retry.any():
+        text = values[retry].astype(str).str.strip().str.translate(str.maketrans("٠١٢٣٤٥٦٧٨٩٫", "0123456789."))
+        negative = (text.str.startswith("(") & text.str.endswith(")")) | text.str.endswith("-") | text.str.startswith("-")
+        cleaned = pd.to_numeric(text.str.replace(r"[^\d.]", "", regex=True), errors='coerce')
+        number[retry] = cleaned.where(~negative, -cleaned)
+    return number
+
+
+class ReconciliationEngine:
+    """مطابقة حركات كشف الحساب بقيود المبيعات والمشتريات والمصروفات دون حلقات متداخلة، في ثلاث مراحل متجهة:
+    1) دمج مرتب على (الاتجاه، المبلغ بالهللات): التكرار رقم k لمبلغ في الكشف يقابل التكرار k له في الدفتر حسب التاريخ؛
+    2) لما تبقى، جولات merge_asof لأقرب قيد بنفس المبلغ ضمن نافذة الأيام؛
+    3) المطابقة التقريبية: اسم الطرف (موحدًا) ورد في وصف الحركة، والتاريخ ضمن النافذة والمبلغ ضمن نسبة السماح.
+    كل حركة وكل قيد يُطابقان مرة واحدة على الأكثر"""
+
+    EXACT, NEAREST, FUZZY = "مبلغ مطابق", "مبلغ مطابق (أقرب تاريخ)", "تقريبية بالاسم"
+
+    def __init__(self, window_days=RECONCILE_WINDOW_DAYS, amount_tolerance=RECONCILE_AMOUNT_TOLERANCE,
+                 fuzzy=True, open_only=True, rates=None, max_rounds=8):
+        self.window_days = int(window_days)
+        self.amount_tolerance = float(amount_tolerance)
+        self.fuzzy = fuzzy
+        self.open_only = open_only
+        self.rates = rates or {BASE_CURRENCY: 1.0}
+        self.max_rounds = max_rounds
+
+    def run(self, statement, data):
+        """مطابقة الكشف بأوراق الدفتر وإرجاع المطابقات والحركات غير المطابقة مع زمن كل مرحلة"""
+        timings = {}
+        started = time.perf_counter()
+
+        t = time.perf_counter()
+        lines = self._lines(statement)
+        entries, sources = self._entries(data)
+        timings["التحضير"] = time.perf_counter() - t
+
+        stages = [(self.EXACT, self._pair_by_rank), (self.NEAREST, self._pair_nearest)]
+        if self.fuzzy:
+            stages.append((self.FUZZY, lambda lines, entries: self._pair_by_name(lines, entries, statement, sources)))
+        accepted = []
+        for method, stage in stages:
+            t = time.perf_counter()
+            if len(lines) and len(entries):
+                pairs = stage(lines, entries)[["line", "entry"]].assign(method=method)
+                accepted.append(pairs)
+                lines = lines[~lines["line"].isin(pairs["line"])]
+                entries = entries[~entries["entry"].isin(pairs["entry"])]
+            timings[method] = time.perf_counter() - t
+
+        pairs = pd.concat(accepted, ignore_index=True) if accepted else pd.DataFrame(columns=["line", "entry", "method"])
+        matches = self._describe(pairs, statement, sources)
+        matched = np.zeros(len(statement), dtype=bool)
+        matched[pairs["line"].to_numpy(dtype=np.int64)] = True
+        timings["الإجمالي"] = time.perf_counter() - started
+        return {
+            "matches": matches,
+            "unmatched": statement[~matched],
+            "lines": len(statement),
+            "entries": len(sources),
+            "entries_left": len(sources) - len(pairs),
+            "by_method": pairs["method"].value_counts().to_dict(),
+            "timings": timings,
+        }
+
+    def _lines(self, statement):
+        amounts = as_amounts(statement["المبلغ"])
+        days = as_dates(statement["التاريخ"]).to_numpy(dtype="datetime64[D]")
+        lines = pd.DataFrame({
+            "line": np.arange(len(statement), dtype=np.int64),
+            "sign": np.sign(amounts.fillna(0).to_numpy()).astype(np.int64),
+            "cents": np.abs(to_minor_units(amounts)),
+            "day": days.astype(np.int64),
+        })
+        # الحركات بلا مبلغ أو تاريخ لا تُطابق
+        return lines[(lines["sign"] != 0) & ~np.isnat(days)]
+
+    def _entries(self, data):
+        """القيود المرشحة من كل أوراق المطابقة كإطار أعداد صحيحة واحد، ومعه (الورقة، الصف، الطرف، التاريخ، المبلغ)
+        لكل قيد مرتبة برقمه (entry) للعرض والمطابقة بالاسم"""
+        frames, sources = [], []
+        offset = 0
+        for sheet_name, sign in RECONCILE_SHEETS.items():
+            df = data[sheet_name]
+            if df.empty:
+                continue
+            keep = df["الحالة"].eq(OPEN_STATUS).to_numpy() if self.open_only else np.ones(len(df), dtype=bool)
+            positions = np.flatnonzero(keep)
+            df = df.iloc[positions]
+            amounts = as_amounts(df["المبلغ"])
+            factors = conversion_factors(df["العملة"], self.rates) if "العملة" in df.columns else 1.0
+            days = as_dates(df["التاريخ"]).to_numpy(dtype="datetime64[D]")
+            party = as_labels(df[PARTY_COLUMNS[sheet_name]]).to_numpy()
+            entries = pd.DataFrame({
+                "entry": np.arange(offset, offset + len(df), dtype=np.int64),
+                "sign": sign,
+                # المطابقة بالعملة الأساسية؛ القيود بعملة بلا سعر تُستبعد
+                "cents": to_minor_units(amounts.to_numpy() * factors),
+                "day": days.astype(np.int64),
+                "valid": amounts.notna().to_numpy() & ~np.isnan(np.broadcast_to(factors, len(df))) & ~np.isnat(days),
+            })
+            sources.append(pd.DataFrame({"الورقة": sheet_name, "الصف": positions, "الطرف": party,
+                                         "تاريخ القيد": as_dates(df["التاريخ"]).to_numpy(), "مبلغ القيد": amounts.to_numpy()}))
+            frames.append(entries[entries.pop("valid").to_numpy()])
+            offset += len(df)
+        if not frames:
+            empty = pd.DataFrame({column: np.array([], dtype=np.int64) for column in ("entry", "sign", "cents", "day")})
+            return empty, pd.DataFrame({"الورقة": pd.Series(dtype=object), "الصف": pd.Series(dtype=np.int64),
+                                        "الطرف": pd.Series(dtype=object), "تاريخ القيد": pd.Series(dtype="datetime64[ns]"),
+                                        "مبلغ القيد": pd.Series(dtype=float)})
+        return pd.concat(frames, ignore_index=True), pd.concat(sources, ignore_index=True)
+
+    def _pair_by_rank(self, lines, entries):
+        pairs = self._ranked(lines, "line").merge(self._ranked(entries, "entry"), on=["signed", "rank"], suffixes=("", "_entry"))
+        return pairs[np.abs(pairs["day"].to_numpy() - pairs["day_entry"].to_numpy()) <= self.window_days]
+
+    @staticmethod
+    def _ranked(frame, id_column):
+        # ترتيب التكرار داخل كل مبلغ بإشارته حسب التاريخ؛ الفرز على مفتاح مركب واحد (المبلغ × مدى الأيام + اليوم)
+        # ما لم يتجاوز int64، وإلا lexsort على المفتاحين
+        signed = frame["sign"].to_numpy() * frame["cents"].to_numpy()
+        day = frame["day"].to_numpy()
+        span = int(day.max() - day.min()) + 1 if len(day) else 1
+        if len(day) and int(np.abs(signed).max()) < (2 ** 62) // span:
+            order = np.argsort(signed * span + (day - day.min()), kind="stable")
+        else:
+            order = np.lexsort((day, signed))
+        signed = signed[order]
+        starts = np.r_[True, signed[1:] != signed[:-1]]
+        positions = np.arange(len(order))
+        rank = positions - np.maximum.accumulate(np.where(starts, positions, 0))
+        return pd.DataFrame({"signed": signed, "rank": rank, "day": day[order], id_column: frame[id_column].to_numpy()[order]})
+
+    def _pair_nearest(self, lines, entries):
+        # كل جولة: أقرب قيد بنفس المبلغ لكل حركة، وعند التنازع على قيد تأخذه الحركة الأقرب تاريخًا
+        accepted = []
+        for _ in range(self.max_rounds):
+            if lines.empty or entries.empty:
+                break
+            right = entries[["day", "sign", "cents", "entry"]].assign(day_entry=entries["day"]).sort_values("day", kind="stable")
+            nearest = pd.merge_asof(
+                lines[["day", "sign", "cents", "line"]].sort_values("day", kind="stable"), right,
+                on="day", by=["sign", "cents"], direction="nearest", tolerance=self.window_days,
+            ).dropna(subset=["entry"])
+            if nearest.empty:
+                break
+            nearest = nearest.assign(entry=nearest["entry"].astype(np.int64), gap=(nearest["day"] - nearest["day_entry"]).abs())
+            best = nearest.sort_values("gap", kind="stable").drop_duplicates("entry")
+            accepted.append(best)
+            lines = lines[~lines["line"].isin(best["line"])]
+            entries = entries[~entries["entry"].isin(best["entry"])]
+        return pd.concat(accepted, ignore_index=True) if accepted else pd.DataFrame(columns=["line", "entry"])
+
+    def _pair_by_name(self, lines, entries, statement, sources):
+        names = normalize_party_names(sources["الطرف"].to_numpy()[entries["entry"].to_numpy()])
+        parties, party_names = pd.factorize(names)
+        keep = names.ne("").to_numpy()
+        entries, parties = entries[keep], parties[keep]
+        if entries.empty or "الوصف" not in statement.columns:
+            return pd.DataFrame(columns=["line", "entry"])
+        descriptions = statement["الوصف"].fillna("").astype(str).to_numpy()[lines["line"].to_numpy()]
+        grams = self._name_grams(lines["line"].to_numpy(), descriptions, pd.Index(party_names))
+        if grams.empty:
+            return pd.DataFrame(columns=["line", "entry"])
+        # ربط نطاقي على مفتاح صحيح واحد (الطرف، الاتجاه، شريحة الأيام): كل حركة تُقارن بقيود طرفها
+        # في الشرائح المجاورة فقط لا بكل قيوده
+        width = max(self.window_days, 1)
+        grams = grams.merge(lines[["line", "sign", "cents", "day"]], on="line")
+        left = pd.concat([
+            pd.DataFrame({"key": self._band_key(grams["party"], grams["sign"], grams["day"] // width + shift),
+                          "line": grams["line"], "cents": grams["cents"], "day": grams["day"]})
+            for shift in (-1, 0, 1)
+        ], ignore_index=True)
+        right = pd.DataFrame({"key": self._band_key(parties, entries["sign"], entries["day"] // width),
+                              "entry": entries["entry"], "cents_entry": entries["cents"], "day_entry": entries["day"]})
+        pairs = left.merge(right, on="key")
+        gap = np.abs(pairs["day"].to_numpy() - pairs["day_entry"].to_numpy())
+        difference = np.abs(pairs["cents"].to_numpy() - pairs["cents_entry"].to_numpy())
+        keep = (gap <= self.window_days) & (difference <= pairs["cents_entry"].to_numpy() * self.amount_tolerance)
+        pairs = pd.DataFrame({"line": pairs["line"].to_numpy()[keep], "entry": pairs["entry"].to_numpy()[keep],
+                              "difference": difference[keep], "gap": gap[keep]})
+        pairs = pairs.sort_values(["difference", "gap"], kind="stable").drop_duplicates(["line", "entry"])
+        # اختيار جشع واحد لواحد: في كل جولة أفضل قيد لكل حركة ثم أفضل حركة لكل قيد
+        accepted = []
+        for _ in range(self.max_rounds):
+            if pairs.empty:
+                break
+            best = pairs.drop_duplicates("line").drop_duplicates("entry")
+            accepted.append(best)
+            pairs = pairs[~pairs["line"].isin(best["line"]) & ~pairs["entry"].isin(best["entry"])]
+        return pd.concat(accepted, ignore_index=True) if accepted else pd.DataFrame(columns=["line", "entry"])
+
+    @staticmethod
+    def _band_key(parties, signs, buckets):
+        # (رمز الطرف، الاتجاه) في البتات العليا وشريحة الأيام (مزاحة لتبقى موجبة) في أدنى 32 بتًا
+        parties, signs, buckets = (np.asarray(v, dtype=np.int64) for v in (parties, signs, buckets))
+        return ((parties * 2 + (signs > 0)) << 32) + (buckets + 2 ** 31)
+
+    @staticmethod
+    def _name_grams(line_ids, descriptions, names):
+        """(الحركة، رمز الطرف في names) لكل عبارة من كلمة إلى RECONCILE_NAME_WORDS كلمات متتالية في الوصف تطابق اسم طرف موحدًا"""
+        text = normalize_party_names(pd.Series(descriptions, dtype=object).str.replace(r"[^\w\s]", " ", regex=True))
+        words = (
+            pd.DataFrame({"line": line_ids, "word": text.str.split().to_numpy()})
+            .explode("word").dropna().reset_index(drop=True)
+        )
+        gram, valid = words["word"], pd.Series(True, index=words.index)
+        found = []
+        for n in range(RECONCILE_NAME_WORDS):
+            if n:
+                # العبارة التالية: الكلمة رقم n بعد بداية العبارة، بشرط أن تكون من وصف الحركة نفسها
+                gram = gram + " " + words["word"].shift(-n).fillna("")
+                valid &= words["line"].shift(-n).eq(words["line"])
+            hit = valid & gram.isin(names)
+            found.append(pd.DataFrame({"line": words["line"][hit].to_numpy(dtype=np.int64), "party": names.get_indexer(gram[hit])}))
+        return pd.concat(found, ignore_index=True).drop_duplicates()
+
+    def _describe(self, pairs, statement, sources):
+        """جدول المطابقات للعرض: الحركة والقيد المقابل وطريقة المطابقة وفرق الأيام"""
+        lines = pairs["line"].to_numpy(dtype=np.int64)
+        entries = sources.iloc[pairs["entry"].to_numpy(dtype=np.int64)].reset_index(drop=True)
+        dates = as_dates(statement["التاريخ"]).iloc[lines].reset_index(drop=True)
+        matches = pd.DataFrame({
+            "سطر الكشف": lines,
+            "التاريخ": dates,
+            "المبلغ": as_amounts(statement["المبلغ"]).iloc[lines].to_numpy(),
+            "الوصف": statement["الوصف"].iloc[lines].to_numpy(),
+        })
+        matches = pd.concat([matches, entries], axis=1)
+        matches["الطريقة"] = pairs["method"].to_numpy()
+        matches["فرق الأيام"] = (dates - matches["تاريخ القيد"]).dt.days.abs()
+        return matches.sort_values("سطر الكشف", ignore_index=True)
+
+
+def settle_matches(data, matches, status=SETTLED_STATUS):
+    """نسخ من الأوراق المطابقة بعد نقل القيود المطابقة إلى حالة التسوية؛ تُسند للدفتر وتُحفظ كأي تعديل.
+    يُرفض الاعتماد إذا تغيّرت صفوف الورقة منذ المطابقة (المبلغ أو التاريخ أو الطرف في موضع القيد لم يعد نفسه)"""
+    frames = {}
+    for sheet_name, rows in matches.groupby("الورقة", sort=False):
+        df = data[sheet_name]
+        positions = rows["الصف"].to_numpy(dtype=np.int64)
+        if len(positions) and not _entries_unchanged(df, sheet_name, positions, rows):
+            raise ValueError(f"تغيّرت ورقة {sheet_name} منذ المطابقة؛ أعد المطابقة قبل الاعتماد")
+        df = df.copy()
+        column = df["الحالة"]
+        if isinstance(column.dtype, pd.CategoricalDtype) and status not in column.cat.categories:
+            df["الحالة"] = column.cat.add_categories([status])
+        df.iloc[positions, df.columns.get_loc("الحالة")] = status
+        frames[sheet_name] = df
+    return frames
+
+
+def _entries_unchanged(df, sheet_name, positions, rows):
+    # القيد في موضعه يطابق ما سُجل عند المطابقة: المبلغ والتاريخ (باليوم) والطرف
+    if positions.max() >= len(df):
+        return False
+    current = df.iloc[positions]
+    if not np.allclose(as_amounts(current["المبلغ"]).to_numpy(dtype=float), rows["مبلغ القيد"].to_numpy(dtype=float), equal_nan=True):
+        return False
+    days = as_dates(current["التاريخ"]).to_numpy(dtype="datetime64[D]")
+    expected = as_dates(rows["تاريخ القيد"]).to_numpy(dtype="datetime64[D]")
+    if not ((days == expected) | (np.isnat(days) & np.isnat(expected))).all():
+        return False
+    parties = as_labels(current[PARTY_COLUMNS[sheet_name]]).astype(str).to_numpy()
+    return bool((parties == as_labels(rows["الطرف"]).astype(str).to_numpy()).all())
+
+
+# -------------------------
+# التصدير المتدفق
+# -------------------------
+EXPORT_CHUNK_SIZE = 50_000
+# أقصى عدد صفوف في ورقة Excel (بعد صف العناوين)
+EXCEL_MAX_ROWS = 1_048_575
+
+
+def iter_frame_chunks(df, chunk_size=EXPORT_CHUNK_SIZE):
+    for start in range(0, len(df), chunk_size):
+        yield df.iloc[start:start + chunk_size]
+
+
+def export_excel(frames, path, chunk_size=EXPORT_CHUNK_SIZE):
+    """كتابة الأوراق إلى xlsx بوضع الذاكرة الثابتة في xlsxwriter، صفًا صفًا وعلى دفعات؛
+    الورقة التي تتجاوز حد Excel تُقسم إلى أوراق متتالية"""
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'nan_inf_to_errors': True})
+    try:
+        for sheet_name, df in frames.items():
+            part, row = 1, 0
+            worksheet = None
+            # نحدد نوع كل عمود مرة واحدة ونكتب الخلايا مباشرة بدل تخمين النوع لكل خلية
+            numeric = [pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype) for dtype in df.dtypes]
+            for chunk in iter_frame_chunks(df, chunk_size):
+                # القيم المفقودة تبقى خلايا فارغة
+                chunk = storage_frame(chunk)
+                values = chunk.astype(object).where(chunk.notna(), None).to_numpy()
+                for values_row in values:
+                    if worksheet is None or row > EXCEL_MAX_ROWS:
+                        worksheet = workbook.add_worksheet(sheet_name if part == 1 else f"{sheet_name} ({part})"[:31])
+                        worksheet.write_row(0, 0, list(df.columns))
+                        part, row = part + 1, 1
+                    for col, value in enumerate(values_row):
+                        if value is None or value == "":
+                            continue
+                        if numeric[col]:
+                            worksheet.write_number(row, col, value)
+                        else:
+                            worksheet.write_string(row, col, str(value))
+                    row += 1
+            if worksheet is None:
+                worksheet = workbook.add_worksheet(sheet_name)
+                worksheet.write_row(0, 0, list(df.columns))
+    finally:
+        workbook.close()
+
+
+def export_csv_zip(frames, path, chunk_size=EXPORT_CHUNK_SIZE):
+    """ملف zip فيه CSV لكل ورقة، يُكتب على دفعات مباشرة داخل الأرشيف"""
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for sheet_name, df in frames.items():
+            with archive.open(f"{sheet_name}.csv", "w") as raw:
+                with io.TextIOWrapper(raw, encoding='utf-8-sig', newline="") as out:
+                    if df.empty:
+                        df.to_csv(out, index=False)
+                    for i, chunk in enumerate(iter_frame_chunks(df, chunk_size)):
+                        storage_frame(chunk).to_csv(out, index=False, header=(i == 0))
+
+
+def _arrow_schema(df):
+    import pyarrow as pa
+
+    fields = []
+    for column, dtype in df.dtypes.items():
+        try:
+            arrow_type = pa.string() if dtype == object else pa.from_numpy_dtype(dtype)
+        except (TypeError, NotImplementedError, pa.ArrowNotImplementedError):
+            arrow_type = pa.string()
+        fields.append(pa.field(str(column), arrow_type))
+    return pa.schema(fields)
+
+
+def export_parquet_zip(frames, path, chunk_size=EXPORT_CHUNK_SIZE):
+    """ملف zip فيه Parquet لكل ورقة؛ كل دفعة تُكتب كمجموعة صفوف مستقلة"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED) as archive:
+        for sheet_name, df in frames.items():
+            schema = _arrow_schema(df)
+            string_columns = [f.name for f in schema if f.type == pa.string()]
+            fd, part_path = tempfile.mkstemp(suffix=".parquet")
+            os.close(fd)
+            try:
+                with pq.ParquetWriter(part_path, schema) as writer:
+                    for chunk in iter_frame_chunks(df, chunk_size):
+                        chunk = chunk.copy()
+                        for column in string_columns:
+                            chunk[column] = chunk[column].where(chunk[column].isna(), chunk[column].astype(str))
+                        writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                archive.write(part_path, f"{sheet_name}.parquet")
+            finally:
+                os.remove(part_path)
+
+
+# صيغة التصدير ← (دالة الكتابة، اسم الملف، نوع المحتوى)
+EXPORT_FORMATS = {
+    "Excel": (export_excel, "accounting_data_export.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "CSV (zip)": (export_csv_zip, "accounting_data_export_csv.zip", "application/zip"),
+    "Parquet (zip)": (export_parquet_zip, "accounting_data_export_parquet.zip", "application/zip"),
+}
+
+
+# -------------------------
+# التعرف الضوئي على الحروف (OCR)
+# -------------------------
+OCR_WORKERS = int(os.environ.get("ACCOUNTING_OCR_WORKERS", "2"))
+OCR_CACHE_SIZE = int(os.environ.get("ACCOUNTING_OCR_CACHE_SIZE", "256"))
+OCR_LANGUAGES = os.environ.get("ACCOUNTING_OCR_LANGUAGES", "ara+eng")
+# أقصى عرض للصورة قبل التعرف؛ الصور الأكبر تُصغّر مع الحفاظ على النسبة
+OCR_MAX_WIDTH = 2000
+
+
+def process_pool(workers):
+    """مجموعة عمليات بسياق forkserver (أو spawn حيث لا يتوفر): العملية الأم فيها خيوط (Streamlit وأعمال الخلفية)،
+    وfork ينسخ أقفالها وهي محجوزة فقد تتجمد العمليات الأبناء. الأبناء لا يلزمهم إلا accounting_core،
+    فيُحمّل مرة واحدة في خادم forkserver"""
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    if context.get_start_method() == "forkserver":
+        context.set_forkserver_preload([__name__])
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+
+def ocr_image_bytes(data, languages=OCR_LANGUAGES, max_width=OCR_MAX_WIDTH):
+    """تشغيل OCR على محتوى صورة (يعمل داخل عملية عاملة): تدرج رمادي، تصغير، ثم تحويل ثنائي قبل التعرف"""
+    import pytesseract
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    image = image.convert("L")
+    if image.width > max_width:
+        image = image.resize((max_width, round(image.height * max_width / image.width)), Image.LANCZOS)
+    try:
+        import cv2
+
+        # عتبة Otsu لفصل النص عن الخلفية
+        _, binary = cv2.threshold(np.asarray(image), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        image = Image.fromarray(binary)
+    except ImportError:
+        image = image.point(lambda v: 255 if v > 160 else 0)
+    try:
+        return pytesseract.image_to_string(image, lang=languages)
+    except OSError as e:
+        # أخطاء pytesseract لا تُسلسل عبر حدود العمليات؛ نعيدها كأنواع قياسية
+        raise OSError(str(e)) from None
+    except Exception as e:
+        raise RuntimeError(str(e)) from None
+
+
+class OcrService:
+    """تشغيل OCR في مجموعة عمليات حتى لا يتوقف خيط الواجهة، مع ذاكرة LRU للنتائج حسب بصمة محتوى الصورة"""
+
+    def __init__(self, workers=OCR_WORKERS, cache_size=OCR_CACHE_SIZE):
+        self.workers = workers
+        self.cache_size = cache_size
+        self._executor = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def content_hash(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def _pool(self):
+        if self._executor is None or getattr(self._executor, "_broken", False):
+            # forkserver لا fork (خيوط الواجهة قد تكون حاجزة أقفالًا لحظة النسخ)؛ العمليات العاملة لا تستورد
+            # إلا accounting_core لا الواجهة
+            self._executor = process_pool(self.workers)
+        return self._executor
+
+    def submit(self, data):
+        """إرجاع Future بنص الصورة؛ الصورة نفسها (أو قيد المعالجة) تُعاد من الذاكرة فورًا"""
+        key = self.content_hash(data)
+        with self._lock:
+            future = self._cache.get(key)
+            if future is not None:
+                self._cache.move_to_end(key)
+                return future
+            future = self._pool().submit(ocr_image_bytes, data)
+            self._cache[key] = future
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        future.add_done_callback(lambda f, key=key: self._forget_failure(key, f))
+        return future
+
+    def _forget_failure(self, key, future):
+        # لا نحتفظ بالفشل حتى تُعاد المحاولة عند الرفع التالي
+        if future.exception() is not None:
+            with self._lock:
+                if self._cache.get(key) is future:
+                    del self._cache[key]
+
+    def cached(self, data):
+        """النص المخزن للصورة إن كان جاهزًا"""
+        with self._lock:
+            future = self._cache.get(self.content_hash(data))
+        if future is not None and future.done() and future.exception() is None:
+            return future.result()
+        return None
+
+
+# مجموعة عمليات وذاكرة نتائج واحدة لكل العملية
+ocr_service = OcrService()
+
+
+# -------------------------
+# القياس والتتبع
+# -------------------------
+METRICS_PATH = os.environ.get("ACCOUNTING_METRICS_PATH", "accounting_metrics.prom")
+METRICS_WINDOW = int(os.environ.get("ACCOUNTING_METRICS_WINDOW", "1000"))
+# التقاط cProfile لكل تفاعل منذ البدء (يمكن تفعيله لاحقًا من صفحة التشخيص)
+PROFILE_INTERACTIONS = os.environ.get("ACCOUNTING_PROFILE", "") == "1"
+
+
+def current_rss_bytes():
+    """الذاكرة المقيمة الحالية للعملية (لينكس)، أو الذروة حيث لا يتوفر /proc"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        import sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class MetricsRegistry:
+    """عينات الزمن والذاكرة وعدد الصفوف لكل عملية (آخر window عينة)، مع مجاميع تراكمية لتنسيق Prometheus.
+    العمليات المتداخلة تُسجل كل منها باسمها، والتقاط cProfile يكون للعملية الخارجية فقط"""
+
+    def __init__(self, window=METRICS_WINDOW, profiling=PROFILE_INTERACTIONS, profiles_kept=10):
+        self.window = window
+        self.profiling = profiling
+        self._samples = {}
+        self._totals = {}
+        self._profiles = []
+        self._profiles_kept = profiles_kept
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def span(self, name):
+        """قياس كتلة: with metrics.span("save_data"): ..."""
+        stack = self._stack()
+        entry = {"name": name, "rows": None}
+        profiler = None
+        if self.profiling and not stack:
+            import cProfile
+            profiler = cProfile.Profile()
+        stack.append(entry)
+        rss_before = current_rss_bytes()
+        started = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield entry
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            elapsed = time.perf_counter() - started
+            rss_after = current_rss_bytes()
+            stack.pop()
+            self.record(name, elapsed, rss_after, rss_after - rss_before, entry["rows"])
+            if profiler is not None:
+                self._keep_profile(name, elapsed, profiler)
+
+    def instrument(self, name=None):
+        """مزخرف يقيس كل استدعاء للدالة باسم العملية (افتراضيًا اسم الدالة)"""
+        def decorator(func):
+            operation = name or func.__name__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(operation):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def note_rows(self, rows):
+        """عدد الصفوف التي عالجتها العملية الجارية (الأعمق)"""
+        stack = self._stack()
+        if stack:
+            stack[-1]["rows"] = int(rows)
+
+    def record(self, name, seconds, rss_bytes, rss_delta, rows=None):
+        with self._lock:
+            samples = self._samples.setdefault(name, [])
+            samples.append((seconds, rss_bytes, rss_delta, rows))
+            if len(samples) > self.window:
+                del samples[:len(samples) - self.window]
+            totals = self._totals.setdefault(name, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += rows or 0
+
+    def _keep_profile(self, name, seconds, profiler):
+        import pstats
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(30)
+        with self._lock:
+            self._profiles.append({"operation": name, "seconds": seconds, "time": datetime.now(), "stats": out.getvalue()})
+            del self._profiles[:-self._profiles_kept]
+
+    def profiles(self):
+        with self._lock:
+            return list(reversed(self._profiles))
+
+    @staticmethod
+    def _quantile(sorted_values, q):
+        # طريقة أقرب رتبة
+        if not sorted_values:
+            return 0.0
+        return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+    def summary(self):
+        """صف لكل عملية: العدد، p50، p95، الأقصى، آخر عدد صفوف، الذاكرة"""
+        with self._lock:
+            items = {name: list(samples) for name, samples in self._samples.items()}
+            totals = {name: list(t) for name, t in self._totals.items()}
+        rows = []
+        for name, samples in sorted(items.items()):
+            seconds = sorted(s[0] for s in samples)
+            last_rows = next((s[3] for s in reversed(samples) if s[3] is not None), None)
+            rows.append({
+                "operation": name,
+                "count": totals[name][0],
+                "p50_ms": self._quantile(seconds, 0.50) * 1000,
+                "p95_ms": self._quantile(seconds, 0.95) * 1000,
+                "max_ms": seconds[-1] * 1000,
+                "rows": last_rows,
+                "rss_mb": samples[-1][1] / 2**20,
+                "max_rss_delta_mb": max(s[2] for s in samples) / 2**20,
+            })
+        return rows
+
+    def prometheus_text(self):
+        """التنسيق النصي لـ Prometheus (ملخص زمني لكل عملية مع الكميات والمجاميع)"""
+        with self._lock:
+            totals = {name: list(t) for name, t in self._totals.items()}
+        summary = {row["operation"]: row for row in self.summary()}
+        lines = [
+            "# HELP accounting_operation_seconds Latency of accounting operations.",
+            "# TYPE accounting_operation_seconds summary",
+        ]
+        for name, row in summary.items():
+            label = name.replace("\\", "\\\\").replace('"', '\\"')
+            lines.append(f'accounting_operation_seconds{{operation="{label}",quantile="0.5"}} {row["p50_ms"] / 1000:.6f}')
+            lines.append(f'accounting_operation_seconds{{operation="{label}",quantile="0.95"}} {row["p95_ms"] / 1000:.6f}')
+            lines.append(f'accounting_operation_seconds_sum{{operation="{label}"}} {totals[name][1]:.6f}')
+            lines.append(f'accounting_operation_seconds_count{{operation="{label}"}} {totals[name][0]}')
+        lines += [
+            "# HELP accounting_operation_rows_total Rows processed by accounting operations.",
+            "# TYPE accounting_operation_rows_total counter",
+        ]
+        for name in summary:
+            label = name.replace("\\", "\\\\").replace('"', '\\"')
+            lines.append(f'accounting_operation_rows_total{{operation="{label}"}} {totals[name][2]}')
+        lines += [
+            "# HELP accounting_process_resident_memory_bytes Resident memory of the process.",
+            "# TYPE accounting_process_resident_memory_bytes gauge",
+            f"accounting_process_resident_memory_bytes {current_rss_bytes()}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path=METRICS_PATH):
+        """كتابة ذرية لملف textfile يجمعه node_exporter"""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".prom.tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp, path)
+        return path
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._totals.clear()
+            self._profiles.clear()
+
+
+# سجل قياسات واحد لكل العملية تشترك فيه كل الجلسات
+metrics = MetricsRegistry()
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""
+قياس أداء المسارات الساخنة في نظام المحاسبة دون خادم Streamlit.
+
+أمثلة:
+    python bench_accounting.py --sizes 1k,10k,100k
+    python bench_accounting.py --sizes 1m --mode sqlite --baseline bench_baseline.json
+    python bench_accounting.py --sizes 1k,10k --save-baseline bench_baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# -------------------------
+# مولد دفتر تجريبي حتمي
+# -------------------------
+PARTY_PREFIXES = ["شركة", "مؤسسة", "مصنع", "متجر", "مكتب", "مجموعة"]
+PARTY_NAMES = [
+    "النور", "الأمل", "التقنية", "الرياض", "الخليج", "الفجر", "السلام", "البناء",
+    "الواحة", "المستقبل", "الإبداع", "الصفوة", "الريادة", "الجزيرة", "الشروق", "الأفق",
+]
+EXPENSE_TYPES = ["إيجار", "رواتب", "كهرباء", "مياه", "اتصالات", "صيانة", "نقل", "ضيافة"]
+STATUSES = ["معلقة", "مكتمل"]
+# نسبة صفوف كل ورقة من الحجم المطلوب
+CURRENCIES, CURRENCY_SHARES = ["SAR", "USD", "EUR"], [0.9, 0.07, 0.03]
+SHEET_SHARES = {"المبيعات": 0.5, "المشتريات": 0.3, "المصروفات": 0.2}
+
+
+def parse_size(text):
+    """"1k" ← 1000، "10m" ← 10000000"""
+    text = text.strip().lower()
+    factor = {"k": 1_000, "m": 1_000_000}.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * factor)
+
+
+def party_names(count):
+    """أسماء أطراف عربية فريدة بترتيب ثابت"""
+    names = [f"{prefix} {name}" for name in PARTY_NAMES for prefix in PARTY_PREFIXES]
+    suffix = 2
+    while len(names) < count:
+        names += [f"{prefix} {name} {suffix}" for name in PARTY_NAMES for prefix in PARTY_PREFIXES]
+        suffix += 1
+    return names[:count]
+
+
+def generate_ledger(rows, seed=0, start="2022-01-01", days=1095):
+    """أوراق الدفتر الخمس بأعمدة SHEET_COLUMNS؛ نفس (rows, seed) تعطي نفس البيانات دائمًا"""
+    rng = np.random.default_rng(seed)
+    customers = np.array(party_names(max(10, min(5_000, rows // 200))), dtype=object)
+    suppliers = np.array(party_names(max(10, min(2_000, rows // 500)))[::-1], dtype=object)
+    base = np.datetime64(start, "D")
+
+    def transactions(n, parties):
+        dates = (base + rng.integers(0, days, n).astype("timedelta64[D]")).astype(str)
+        return {
+            "التاريخ": dates,
+            "party": parties[rng.integers(0, len(parties), n)],
+            "المبلغ": np.round(rng.lognormal(6, 1.2, n), 2),
+            "الوصف": np.array(["فاتورة", "دفعة", "خدمة", "توريد"], dtype=object)[rng.integers(0, 4, n)],
+            "الحالة": np.array(STATUSES, dtype=object)[(rng.random(n) < 0.7).astype(int)],
+            "العملة": np.array(CURRENCIES, dtype=object)[rng.choice(len(CURRENCIES), n, p=CURRENCY_SHARES)],
+        }
+
+    frames = {}
+    for sheet_name, party_column, parties in [
+        ("المبيعات", "العميل", customers),
+        ("المشتريات", "المورد", suppliers),
+        ("المصروفات", "النوع", np.array(EXPENSE_TYPES, dtype=object)),
+    ]:
+        columns = transactions(int(rows * SHEET_SHARES[sheet_name]), parties)
+        columns[party_column] = columns.pop("party")
+        frames[sheet_name] = pd.DataFrame(columns)[["التاريخ", party_column, "المبلغ", "الوصف", "الحالة", "العملة"]]
+    # بعض الأطراف غير مسجلة عمدًا حتى يجد التدقيق ما يبلغ عنه
+    for sheet_name, registered in [("العملاء", customers[: int(len(customers) * 0.9)]), ("الموردين", suppliers)]:
+        frames[sheet_name] = pd.DataFrame({
+            "الاسم": registered,
+            "البريد": [f"party{i}@example.com" for i in range(len(registered))],
+            "الهاتف": [f"05{i:08d}" for i in range(len(registered))],
+            "الرصيد": np.zeros(len(registered)),
+        })
+    return frames
+
+
+def generate_statement(frames, share=0.5, seed=0):
+    """كشف حساب بنكي لنسبة share من القيود المفتوحة بالعملة الأساسية، بتواريخ مزاحة حتى يومين،
+    وعُشره بخصم رسوم تحويل حتى لا يُطابق إلا بالاسم"""
+    rng = np.random.default_rng(seed)
+    parts = []
+    for sheet_name, party_column, sign in [("المبيعات", "العميل", 1), ("المشتريات", "المورد", -1), ("المصروفات", "النوع", -1)]:
+        df = frames[sheet_name]
+        df = df[(df["الحالة"] == "معلقة") & (df["العملة"] == "SAR")]
+        df = df.iloc[rng.permutation(len(df))[: int(len(df) * share)]]
+        fee = np.where(rng.random(len(df)) < 0.1, 0.5, 0.0)
+        parts.append(pd.DataFrame({
+            "التاريخ": pd.to_datetime(df["التاريخ"]) + pd.to_timedelta(rng.integers(-2, 3, len(df)), "D"),
+            "المبلغ": sign * (df["المبلغ"].to_numpy() - fee),
+            "الوصف": "تحويل " + df[party_column].astype(str).to_numpy(),
+            "المرجع": "",
+        }))
+    return pd.concat(parts, ignore_index=True)
+
+
+# -------------------------
+# قياس الذاكرة
+# -------------------------
+def reset_peak_rss():
+    """تصفير ذروة الذاكرة المقيمة على لينكس (VmHWM)؛ بدونه تبقى الذروة منذ بدء العملية"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss بالكيلوبايت على لينكس وبالبايت على macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def measure(func, repeat=1):
+    """(متوسط الزمن بالثواني، ذروة الذاكرة بالميغابايت) لتشغيل func"""
+    reset_peak_rss()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return {"seconds": (time.perf_counter() - started) / repeat, "peak_rss_mb": round(peak_rss_mb(), 1)}
+
+
+# -------------------------
+# تشغيل القياسات
+# -------------------------
+def load_app_module(mode):
+    """استيراد التطبيق بنمط التخزين المطلوب وإسكات تحذيرات التشغيل دون خادم"""
+    os.environ["ACCOUNTING_STORAGE_MODE"] = mode
+    import logging
+    import warnings
+    # Streamlit يعيد ضبط مستوى سجلاته عند قراءة إعداداته، فنكتم التحذيرات على مستوى logging كله
+    logging.disable(logging.WARNING)
+    warnings.filterwarnings("ignore")
+    import accounting_ai
+    return accounting_ai
+
+
+def write_ledger(core, frames):
+    """كتابة الدفتر التجريبي إلى القرص بصيغة نمط التخزين الحالي"""
+    for sheet_name, df in frames.items():
+        if core.STORAGE_MODE == "sqlite":
+            core.sqlite_ledger.replace(sheet_name, df)
+        elif core.STORAGE_MODE == "journal":
+            core.ledger_journal.replace(sheet_name, df)
+        else:
+            df.to_csv(f"{sheet_name}.csv", index=False, encoding='utf-8-sig')
+
+
+def fresh_session(app_module, core):
+    """جلسة جديدة ومخزن مشترك فارغ حتى يُقاس التحميل من القرص"""
+    st = app_module.st
+    for key in list(st.session_state.keys()):
+        del st.session_state[key]
+    core.ledger_cache.invalidate()
+
+
+def bench_size(app_module, rows, seed=0, inserts=200, export_format="CSV (zip)"):
+    import accounting_core as core
+
+    frames = generate_ledger(rows, seed)
+    # أسطر اليومية المزدوجة للمعاملات المولّدة (ثلاثة أسطر تقريبًا لكل معاملة)
+    frames[core.JOURNAL_SHEET] = core.journal_for_frames(frames)
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="accounting_bench_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        if core.STORAGE_MODE == "sqlite":
+            # قاعدة جديدة في مجلد القياس بدل الاتصالات المفتوحة على مجلد سابق
+            core.sqlite_ledger.open(os.path.abspath(core.SQLITE_PATH))
+        write_ledger(core, frames)
+        statement = generate_statement(frames, seed=seed)
+        # ملف دفتر تاريخي من "نظام آخر" بعناوين إنجليزية لقياس الاستيراد على دفعات
+        frames["المبيعات"].rename(columns={"التاريخ": "Date", "العميل": "Customer", "المبلغ": "Amount", "الوصف": "Memo",
+                                           "الحالة": "Status", "العملة": "Currency"}).to_csv("history.csv", index=False)
+        del frames
+        fresh_session(app_module, core)
+
+        holder = {}
+        results["load_data"] = measure(lambda: holder.setdefault("app", app_module.AccountingAIApp()))
+        app = holder["app"]
+
+        record = {"التاريخ": "2024-06-01", "العميل": "شركة النور", "المبلغ": 150.0, "الوصف": "قياس", "الحالة": "معلقة"}
+        results["insert"] = measure(lambda: app.add_record("المبيعات", dict(record)), repeat=inserts)
+        results["save_data"] = measure(app.save_data)
+        if core.STORAGE_MODE == "csv":
+            # زمن كتابة الأوراق المعلقة التي أجّلها الإدراج
+            results["flush_writes"] = measure(core.sheet_writer.flush)
+        # نص متكرر لا يختلف إلا بالمبلغ: يُجاب من ذاكرة التحليل بعد أول مرة
+        results["parse_text"] = measure(lambda: app.parse_with_chatgpt(f"بيع لشركة النور بمبلغ {time.perf_counter_ns() % 10000} ريال"), repeat=inserts)
+        results["generate_report"] = measure(lambda: app.generate_report("المبيعات"))
+        results["aging_report"] = measure(app.show_aging_report)
+        results["financial_statements"] = measure(app.show_financial_statements)
+        results["create_chart"] = measure(lambda: app.create_chart("المبيعات"))
+        results["create_comparison_chart"] = measure(app.create_comparison_chart)
+        # نقطة لكل قيد مقلّصة إلى ميزانية النقاط، ثم الرسم نفسه من ذاكرة الرسوم
+        results["chart_transactions"] = measure(lambda: app.create_chart("المبيعات", core.TRANSACTION_GRANULARITY))
+        results["chart_cached"] = measure(lambda: app.create_chart("المبيعات", core.TRANSACTION_GRANULARITY))
+        results["export_data"] = measure(lambda: app.export_data(export_format))
+        results["run_audit"] = measure(app.run_audit)
+        # البناء الأول لخطوط الأساس، ثم تدقيق بعد دفعة إدراجات لا يمر إلا بها
+        results["anomaly_audit"] = measure(lambda: app.run_audit("anomalies"))
+        for _ in range(inserts):
+            app.add_record("المبيعات", dict(record))
+        results["anomaly_reaudit"] = measure(lambda: app.run_audit("anomalies"))
+        results["reconcile"] = measure(lambda: core.ReconciliationEngine().run(statement, core.Ledger(core.ledger_cache)))
+        results["ledger_import"] = measure(lambda: core.import_ledger_file(
+            "history.csv", "المبيعات", write=app.write_frames))
+        # الكتابات المؤجلة تُنجز قبل حذف المجلد
+        core.sheet_writer.flush()
+        if core.STORAGE_MODE == "journal":
+            # لا نترك الطي الخلفي يعمل بعد حذف المجلد (ولا بعد العودة إلى مجلد العمل فيكتب لقطته المؤقتة فيه)
+            core.ledger_journal.flush()
+            for sheet_name in core.SHEET_COLUMNS:
+                core.ledger_journal.compact(sheet_name)
+    finally:
+        os.chdir(cwd)
+        for root, dirs, files in os.walk(workdir, topdown=False):
+            for name in files:
+                os.remove(os.path.join(root, name))
+            for name in dirs:
+                os.rmdir(os.path.join(root, name))
+        os.rmdir(workdir)
+    return results
+
+
+# أوامر بدء التشغيل البارد: كل منها في مفسر جديد
+STARTUP_COMMANDS = {
+    "import_core": ["-c", "import accounting_core"],
+    "cli_help": ["accounting_cli.py", "--help"],
+    "import_app": ["-c", "import accounting_ai"],
+}
+# يطبع الابن ذروة ذاكرته قبل الخروج (VmHWM؛ ru_maxrss في الابن يرث ذروة الأب على لينكس)
+_RSS_PROBE = (
+    "import atexit, resource\n"
+    "def _peak():\n"
+    "    try:\n"
+    "        return next(int(l.split()[1]) for l in open('/proc/self/status') if l.startswith('VmHWM:'))\n"
+    "    except (OSError, StopIteration):\n"
+    "        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n"
+    "atexit.register(lambda: print('RSS', _peak()))"
+)
+
+
+def bench_startup(repeat=3):
+    """زمن البدء البارد (أفضل محاولة) وذروة ذاكرة المفسر لاستيراد النواة وواجهة الأوامر والتطبيق"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for name, command in STARTUP_COMMANDS.items():
+        if command[0] == "-c":
+            argv = [sys.executable, "-c", f"{_RSS_PROBE}\n{command[1]}"]
+        else:
+            script = os.path.join(here, command[0])
+            argv = [sys.executable, "-c", f"{_RSS_PROBE}\nimport runpy, sys; sys.argv = {[script] + command[1:]!r}\n"
+                    f"try:\n    runpy.run_path({script!r}, run_name='__main__')\nexcept SystemExit:\n    pass"]
+        best, rss = None, 0.0
+        for _ in range(repeat):
+            started = time.perf_counter()
+            done = subprocess.run(argv, cwd=here, capture_output=True, text=True, env=dict(os.environ, PYTHONDONTWRITEBYTECODE="1"))
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+            for line in done.stdout.splitlines():
+                if line.startswith("RSS "):
+                    rss = max(rss, int(line.split()[1]) / (1024 * 1024 if sys.platform == "darwin" else 1024))
+        results[name] = {"seconds": best, "peak_rss_mb": round(rss, 1)}
+    return results
+
+
+def compare(results, baseline, tolerance, min_seconds=0.005):
+    """الخطوات التي تجاوز زمنها خط الأساس بأكثر من النسبة المسموحة (مع تجاهل فروق أقل من min_seconds)"""
+    regressions = []
+    for size, steps in results["results"].items():
+        for step, current in steps.items():
+            previous = baseline.get("results", {}).get(size, {}).get(step)
+            if previous and current["seconds"] > max(previous["seconds"] * (1 + tolerance), previous["seconds"] + min_seconds):
+                regressions.append((size, step, previous["seconds"], current["seconds"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="قياس أداء نظام المحاسبة دون واجهة")
+    parser.add_argument("--sizes", default="1k,10k,100k", help="أحجام الدفتر مفصولة بفواصل (1k حتى 10m)")
+    parser.add_argument("--mode", default=os.environ.get("ACCOUNTING_STORAGE_MODE", "csv"), choices=["journal", "csv", "sqlite"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--inserts", type=int, default=200, help="عدد القيود المضافة في قياس الإدراج")
+    parser.add_argument("--export-format", default="CSV (zip)")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="ملف JSON سابق للمقارنة")
+    parser.add_argument("--save-baseline", help="حفظ النتائج كخط أساس جديد")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="نسبة التباطؤ المسموحة قبل اعتبارها تراجعًا")
+    parser.add_argument("--min-seconds", type=float, default=0.005, help="أصغر فرق زمني يُعتبر تراجعًا")
+    args = parser.parse_args(argv)
+
+    print("== بدء التشغيل البارد", flush=True)
+    startup = bench_startup()
+    for step, value in startup.items():
+        print(f"  {step:<24} {value['seconds']:>10.4f} ث  {value['peak_rss_mb']:>9.1f} MB", flush=True)
+
+    app_module = load_app_module(args.mode)
+    results = {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pandas": pd.__version__,
+            "mode": args.mode,
+            "seed": args.seed,
+            "inserts": args.inserts,
+            "export_format": args.export_format,
+        },
+        "results": {"startup": startup},
+    }
+    for size in args.sizes.split(","):
+        rows = parse_size(size)
+        print(f"== {size} ({rows:,} صف)", flush=True)
+        steps = bench_size(app_module, rows, args.seed, args.inserts, args.export_format)
+        results["results"][size.strip()] = steps
+        for step, value in steps.items():
+            print(f"  {step:<24} {value['seconds']:>10.4f} ث  {value['peak_rss_mb']:>9.1f} MB", flush=True)
+
+    for path in filter(None, [args.output, args.save_baseline]):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_seconds)
+        for size, step, before, after in regressions:
+            print(f"تراجع: {size} {step} من {before:.4f} إلى {after:.4f} ث")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import accounting_core as core
+
+PARTY = core.PARTY_COLUMNS["المبيعات"]
+
+
+def history(days=90, seed=0):
+    """قيد يومي لكل طرف بمبالغ موزعة بانتظام على لوغاريتمها (بلا ذيول، فلا شذوذ طبيعي)"""
+    rng = np.random.default_rng(seed)
+    parties = ["شركة النور", "مؤسسة الأفق", "متجر الريان"]
+    dates = np.repeat(pd.date_range("2024-01-01", periods=days, freq="D"), len(parties))
+    return pd.DataFrame({
+        "التاريخ": dates,
+        PARTY: np.tile(parties, days),
+        "المبلغ": np.round(10 ** rng.uniform(2.0, 2.5, len(dates)), 2),
+        "الحالة": core.OPEN_STATUS,
+        "العملة": "SAR",
+    })
+
+
+def incremental(df, first=60, batch=25):
+    index = core.AnomalyIndex(df.iloc[:first], PARTY)
+    for start in range(first, len(df) - 5, batch):
+        index.add_frame(df.iloc[start:min(start + batch, len(df) - 5)])
+    for record in df.iloc[-5:].to_dict("records"):
+        index.add_record(record)
+    return index
+
+
+def baselines(index):
+    n = len(index._keys)
+    return {key: (index._hist[code].tolist(), index._digits[code].tolist(), index._days[code])
+            for code, key in enumerate(index._keys[:n])}
+
+
+def test_incremental_matches_rebuild():
+    df = history()
+    grown, rebuilt = incremental(df), core.AnomalyIndex(df, PARTY)
+    assert grown.rows == rebuilt.rows == len(df)
+    assert baselines(grown) == baselines(rebuilt)
+    pd.testing.assert_frame_equal(grown.benford(), rebuilt.benford())
+    pd.testing.assert_frame_equal(grown.spikes(), rebuilt.spikes())
+    assert grown.outliers().empty and rebuilt.outliers().empty
+
+    # القيد الشاذ يُقيّم بالدرجة نفسها سواء أُضيف لاحقًا أو بُني الفهرس دفعة واحدة
+    outlier = {"التاريخ": pd.Timestamp("2024-03-31"), PARTY: "مؤسسة الأفق", "المبلغ": 250000.0,
+               "الحالة": core.OPEN_STATUS, "العملة": "SAR"}
+    grown.add_record(outlier)
+    rebuilt = core.AnomalyIndex(pd.concat([df, pd.DataFrame([outlier])], ignore_index=True), PARTY)
+    pd.testing.assert_frame_equal(grown.outliers(), rebuilt.outliers())
+    assert grown.outliers()["id"].tolist() == [len(df)]
+
+
+def test_planted_outlier_is_flagged():
+    df = history()
+    df.loc[100, "المبلغ"] = 95000.0
+    outliers = core.AnomalyIndex(df, PARTY).outliers()
+    assert outliers["id"].tolist() == [100]
+    row = outliers.iloc[0]
+    assert row[PARTY] == df.loc[100, PARTY] and row["المبلغ"] == 95000.0
+    assert row["z"] > core.ANOMALY_Z_THRESHOLD
+    assert 100 <= row["الوسيط"] <= 10 ** 2.5
+
+
+def test_day_spike_is_flagged():
+    df = history()
+    spike = pd.DataFrame({"التاريخ": pd.Timestamp("2024-03-15"), PARTY: "متجر الريان", "المبلغ": 150.0,
+                          "الحالة": core.OPEN_STATUS, "العملة": "SAR"}, index=range(11))
+    index = core.AnomalyIndex(df, PARTY)
+    assert index.spikes().empty
+    index.add_frame(spike)
+    spikes = index.spikes()
+    assert len(spikes) == 1
+    row = spikes.iloc[0]
+    assert (row[PARTY], row["التاريخ"], row["العدد"]) == ("متجر الريان", pd.Timestamp("2024-03-15"), 12)
+    assert row["المعدل اليومي السابق"] == pytest.approx(1.0)
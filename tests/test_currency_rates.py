@@ -0,0 +1,108 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import accounting_core as core
+
+
+class RatesStub(ThreadingHTTPServer):
+    """مزود أسعار محلي: يعد الطلبات، ويمكن إيقاف الرد حتى يُفتح gate أو إرجاع خطأ"""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), RatesHandler)
+        self.requests = []
+        self.status = 200
+        self.rates = {"SAR": 1.0, "USD": 0.25, "EUR": 0.2}
+        self.gate = threading.Event()
+        self.gate.set()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/latest/{{base}}"
+
+
+class RatesHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.gate.wait(5)
+        body = json.dumps({"result": "success", "rates": self.server.rates}).encode("utf-8")
+        self.send_response(self.server.status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def wait_refreshed(rates, timeout=5):
+    deadline = time.monotonic() + timeout
+    while rates.status()["refreshing"]:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def stub():
+    server = RatesStub()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.gate.set()
+    server.shutdown()
+    server.server_close()
+
+
+def test_fresh_fetch(stub):
+    rates = core.CurrencyRates(url=stub.url, base="SAR", ttl=60, timeout=5)
+    to_base = rates.refresh().result(5)
+    assert stub.requests == ["/latest/SAR"]
+    assert to_base["USD"] == pytest.approx(4.0) and to_base["EUR"] == pytest.approx(5.0)
+    assert not rates.expired() and rates.status()["error"] is None
+    # ضمن مدة الصلاحية لا طلبات جديدة
+    assert rates.rates()["USD"] == pytest.approx(4.0)
+    assert len(stub.requests) == 1
+
+
+def test_stale_rates_served_while_one_refresh_in_flight(stub):
+    rates = core.CurrencyRates(url=stub.url, base="SAR", ttl=60, timeout=5)
+    rates.set_rates({"USD": 3.75}, fetched_at=time.time() - 120)
+    stub.gate.clear()
+
+    started = time.perf_counter()
+    for _ in range(5):
+        assert rates.rates()["USD"] == 3.75
+    assert time.perf_counter() - started < 1
+    assert rates.status()["refreshing"]
+
+    stub.gate.set()
+    wait_refreshed(rates)
+    assert len(stub.requests) == 1
+    assert rates.rates()["USD"] == pytest.approx(4.0)
+
+
+def test_backoff_after_error(stub):
+    stub.status = 500
+    rates = core.CurrencyRates(url=stub.url, base="SAR", ttl=60, timeout=5, retry=0.3)
+    rates.set_rates({"USD": 3.75}, fetched_at=time.time() - 120)
+    with pytest.raises(Exception):
+        rates.refresh().result(5)
+    assert rates.status()["error"] and rates.backing_off()
+
+    # خلال مهلة إعادة المحاولة تُعاد الأسعار القديمة دون طلب جديد
+    for _ in range(5):
+        assert rates.rates()["USD"] == 3.75
+    assert len(stub.requests) == 1
+
+    stub.status = 200
+    time.sleep(0.35)
+    assert not rates.backing_off()
+    assert rates.rates()["USD"] == 3.75
+    wait_refreshed(rates)
+    assert len(stub.requests) == 2
+    assert rates.rates()["USD"] == pytest.approx(4.0) and rates.status()["error"] is None
@@ -0,0 +1,101 @@
+import pandas as pd
+import pytest
+
+import accounting_core as core
+
+
+def frame(sheet_name, rows):
+    party = core.PARTY_COLUMNS[sheet_name]
+    df = pd.DataFrame([{"التاريخ": date, party: who, "المبلغ": amount, "الوصف": "", "الحالة": core.OPEN_STATUS, "العملة": "SAR"}
+                       for date, who, amount in rows], columns=core.SHEET_COLUMNS[sheet_name])
+    return core.typed_frame(df)
+
+
+@pytest.fixture
+def data():
+    return {
+        "المبيعات": frame("المبيعات", [("2024-01-10", "شركة النور", 1000.0), ("2024-02-05", "مؤسسة الأفق", 500.0)]),
+        "المشتريات": frame("المشتريات", [("2024-01-12", "مورد", 400.0)]),
+        "المصروفات": frame("المصروفات", [("2024-02-07", "كهرباء", 100.0)]),
+    }
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(core, "STORAGE_MODE", "csv")
+    core.ledger_cache.invalidate()
+    yield tmp_path
+    core.sheet_writer.flush()
+    core.ledger_cache.invalidate()
+
+
+def statements(lines):
+    return core.FinancialStatements(core.JournalIndex(lines).frame())
+
+
+def test_trial_balance_balances_after_mixed_postings(data):
+    trial = statements(core.journal_for_frames(data)).trial_balance()
+    assert trial["مدين"].sum() == pytest.approx(trial["دائن"].sum())
+    assert trial["رصيد ختامي"].sum() == pytest.approx(0.0)
+    closing = trial.set_index("الحساب")["رصيد ختامي"]
+    assert closing["حساب المدينين"] == pytest.approx(1725.0)
+    assert closing["إيرادات المبيعات"] == pytest.approx(-1500.0)
+    assert closing["حساب الدائنين"] == pytest.approx(-460.0)
+    assert closing["البنك"] == pytest.approx(-100.0)
+
+    income = statements(core.journal_for_frames(data)).income_statement().set_index("البند")["المبلغ"]
+    assert income["إجمالي الإيرادات"] == pytest.approx(1500.0)
+    assert income["إجمالي المصروفات"] == pytest.approx(500.0)
+    assert income["صافي الربح"] == pytest.approx(1000.0)
+
+
+def test_vat_return_is_output_minus_input(data):
+    vat = statements(core.journal_for_frames(data)).vat_return()
+    output, inputs, net = vat.to_dict("records")
+    assert (output["المبلغ الخاضع"], output["الضريبة"]) == pytest.approx((1500.0, 225.0))
+    assert (inputs["المبلغ الخاضع"], inputs["الضريبة"]) == pytest.approx((400.0, 60.0))
+    assert (net["المبلغ الخاضع"], net["الضريبة"]) == pytest.approx((1100.0, 165.0))
+
+    january = statements(core.journal_for_frames(data)).vat_return("2024-01-01", "2024-01-31")
+    assert january["الضريبة"].tolist() == pytest.approx([150.0, 60.0, 90.0])
+
+
+def test_closed_period_rejects_postings_and_keeps_totals(workdir, data):
+    for sheet_name, df in data.items():
+        core.append_rows(sheet_name, df)
+    core.append_rows(core.JOURNAL_SHEET, core.journal_for_frames(data))
+    before = core.FinancialStatements(core.journal_daily()).trial_balance()
+
+    assert core.close_period("2024-01-31") == 6
+    assert core.closed_through() == pd.Timestamp("2024-01-31")
+    with pytest.raises(ValueError):
+        core.check_open_period(pd.Series(["2024-01-15"]))
+    with pytest.raises(ValueError):
+        core.check_open_period(pd.Series(["2024-02-10", "2024-01-31"]))
+    core.check_open_period(pd.Series(["2024-02-01"]))
+    with pytest.raises(ValueError):
+        core.close_period("2024-01-15")
+
+    # الفترة المقفلة تدخل القوائم من لقطتها، والأسطر المفتوحة فقط تبقى في ورقة القيود
+    core.ledger_cache.invalidate()
+    assert (core.read_sheet(core.JOURNAL_SHEET)["التاريخ"] > pd.Timestamp("2024-01-31")).all()
+    after = core.FinancialStatements(core.journal_daily()).trial_balance()
+    pd.testing.assert_frame_equal(after, before)
+    # إعادة البناء لا تعيد ترحيل ما قبل الإقفال
+    assert (core.rebuild_journal(data)["التاريخ"] > pd.Timestamp("2024-01-31")).all()
+
+
+def test_rebuild_matches_incremental_posting(data):
+    incremental = core.JournalIndex(None)
+    for sheet_name, df in data.items():
+        for i in range(len(df)):
+            incremental.add_frame(core.journal_lines(sheet_name, df.iloc[[i]]))
+    rebuilt = core.JournalIndex(core.rebuild_journal(data))
+
+    def ordered(totals):
+        return totals.sort_values(["التاريخ", "الحساب", "العملة"], ignore_index=True)
+
+    pd.testing.assert_frame_equal(ordered(incremental.frame()), ordered(rebuilt.frame()))
+    pd.testing.assert_frame_equal(statements(core.rebuild_journal(data)).trial_balance(),
+                                  core.FinancialStatements(incremental.frame()).trial_balance())
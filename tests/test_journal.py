@@ -0,0 +1,127 @@
+import os
+import threading
+
+import pandas as pd
+import pytest
+
+import accounting_core as core
+
+SHEET = "المبيعات"
+
+
+def sale(i):
+    return {"التاريخ": "2024-01-%02d" % (i % 28 + 1), "العميل": f"عميل {i}", "المبلغ": 100.0 + i,
+            "الوصف": "", "الحالة": "مفتوحة", "العملة": "SAR"}
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return core.LedgerJournal(directory=str(tmp_path), compact_threshold=10 ** 9)
+
+
+def test_replay_and_compact(journal):
+    for i in range(5):
+        journal.append(SHEET, sale(i))
+    assert len(journal.read(SHEET)) == 5
+    journal.compact(SHEET)
+    assert not os.path.exists(journal.journal_path(SHEET))
+    assert not os.path.exists(journal.rotated_path(SHEET))
+    journal.append(SHEET, sale(5))
+    assert journal.read(SHEET)["المبلغ"].tolist() == [100.0 + i for i in range(6)]
+
+
+def test_crash_between_snapshot_swap_and_rotated_removal(journal, monkeypatch):
+    for i in range(3):
+        journal.append(SHEET, sale(i))
+    journal.compact(SHEET)
+    for i in range(3, 6):
+        journal.append(SHEET, sale(i))
+
+    rotated = journal.rotated_path(SHEET)
+    real_remove = os.remove
+
+    def crash(path):
+        if path == rotated:
+            raise SystemExit("انقطاع")
+        real_remove(path)
+
+    monkeypatch.setattr(core.os, "remove", crash)
+    with pytest.raises(SystemExit):
+        journal.compact(SHEET)
+    monkeypatch.setattr(core.os, "remove", real_remove)
+    # اللقطة الجديدة تحوي السجل المطوي وهو باقٍ على القرص مع علامته
+    assert os.path.exists(rotated) and os.path.exists(journal.marker_path(SHEET))
+
+    journal.append(SHEET, sale(6))
+    expected = [100.0 + i for i in range(7)]
+    assert journal.read(SHEET)["المبلغ"].tolist() == expected
+    journal.compact(SHEET)
+    assert not os.path.exists(rotated) and not os.path.exists(journal.marker_path(SHEET))
+    assert journal.read(SHEET)["المبلغ"].tolist() == expected
+
+
+def test_stale_marker_does_not_hide_unfolded_journal(journal, monkeypatch):
+    for i in range(3):
+        journal.append(SHEET, sale(i))
+    journal.compact(SHEET)
+    for i in range(3, 5):
+        journal.append(SHEET, sale(i))
+
+    real_replace = os.replace
+    snapshot = journal.snapshot_path(SHEET)
+
+    def crash(src, dst):
+        if dst == snapshot:
+            raise SystemExit("انقطاع")
+        real_replace(src, dst)
+
+    # انقطاع بعد كتابة العلامة وقبل تبديل اللقطة: السجل المطوي لم يدخل اللقطة بعد
+    monkeypatch.setattr(core.os, "replace", crash)
+    with pytest.raises(SystemExit):
+        journal.compact(SHEET)
+    monkeypatch.setattr(core.os, "replace", real_replace)
+
+    expected = [100.0 + i for i in range(5)]
+    assert journal.read(SHEET)["المبلغ"].tolist() == expected
+    journal.compact(SHEET)
+    assert journal.read(SHEET)["المبلغ"].tolist() == expected
+
+
+def test_flush_waits_for_background_compaction(journal, monkeypatch):
+    for i in range(4):
+        journal.append(SHEET, sale(i))
+    started, release = threading.Event(), threading.Event()
+    real_fold = journal._fold
+
+    def slow_fold(*args):
+        started.set()
+        release.wait(5)
+        return real_fold(*args)
+
+    monkeypatch.setattr(journal, "_fold", slow_fold)
+    journal.compact_async(SHEET)
+    assert started.wait(5)
+    assert not journal.flush(timeout=0.05)
+    release.set()
+    assert journal.flush(timeout=5)
+    assert not os.path.exists(journal.rotated_path(SHEET))
+    assert len(journal.read(SHEET)) == 4
+
+
+def test_legacy_snapshot_keeps_currency_of_new_records(journal):
+    # لقطة من قبل عمود العملة (خمسة أعمدة)
+    legacy = pd.DataFrame([{"التاريخ": "2023-12-31", "العميل": "عميل قديم", "المبلغ": 50.0, "الوصف": "", "الحالة": "مكتمل"}])
+    legacy.to_csv(journal.snapshot_path(SHEET), index=False, encoding="utf-8-sig")
+    journal.append(SHEET, dict(sale(1), العملة="USD"))
+
+    df = journal.read(SHEET)
+    assert list(df.columns) == core.SHEET_COLUMNS[SHEET]
+    assert pd.isna(df["العملة"].iloc[0]) and df["العملة"].iloc[1] == "USD"
+
+    journal.compact(SHEET)
+    compacted = pd.read_csv(journal.snapshot_path(SHEET), encoding="utf-8-sig")
+    assert list(compacted.columns) == core.SHEET_COLUMNS[SHEET]
+    assert compacted["العملة"].tolist()[1] == "USD"
+    buffer = core.SheetBuffer(core.SHEET_COLUMNS[SHEET], legacy)
+    buffer.append(dict(sale(2), العملة="USD"))
+    assert buffer.frame()["العملة"].tolist()[1] == "USD"
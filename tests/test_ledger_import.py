@@ -0,0 +1,76 @@
+import pandas as pd
+import pytest
+
+import accounting_core as core
+
+SHEET = "المبيعات"
+
+
+def history(rows):
+    return pd.DataFrame({
+        "Invoice Date": pd.date_range("2023-01-01", periods=rows, freq="h").strftime("%d/%m/%Y"),
+        "Customer": "شركة النور",
+        "Amount": [f"{100 + i}.50" for i in range(rows)],
+        "Currency": "SAR",
+    })
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    core.ledger_cache.invalidate()
+    yield tmp_path
+    core.ledger_cache.invalidate()
+
+
+def collect():
+    written = {}
+
+    def write(frames):
+        for sheet_name, frame in frames.items():
+            written.setdefault(sheet_name, []).append(frame)
+
+    return written, write
+
+
+def test_file_smaller_than_a_chunk_is_validated_in_process(workdir, monkeypatch):
+    df = history(30)
+    df.loc[3, "Amount"] = "abc"
+    df.to_csv("hist.csv", index=False)
+
+    def no_pool(workers):
+        raise AssertionError("لا تلزم مجموعة عمليات لملف أصغر من دفعة")
+
+    monkeypatch.setattr(core, "process_pool", no_pool)
+    written, write = collect()
+    stats = core.import_ledger_file("hist.csv", SHEET, write=write, chunk_size=100, workers=4)
+    assert (stats["rows"], stats["imported"], stats["rejected"], stats["chunks"]) == (30, 29, 1, 1)
+    assert len(written[SHEET][0]) == 29 and core.JOURNAL_SHEET in written
+    rejected = pd.read_csv(stats["rejects_path"])
+    assert rejected[core.REJECT_LINE_COLUMN].tolist() == [5]
+
+
+def test_pool_keeps_file_order(workdir):
+    history(250).to_csv("hist.csv", index=False)
+    written, write = collect()
+    stats = core.import_ledger_file("hist.csv", SHEET, write=write, chunk_size=40, workers=2)
+    assert (stats["imported"], stats["chunks"]) == (250, 7)
+    amounts = pd.concat(written[SHEET], ignore_index=True)["المبلغ"].tolist()
+    assert amounts == [100.5 + i for i in range(250)]
+
+
+def test_default_writer_posts_rows_with_their_journal_lines(workdir, monkeypatch):
+    journal = core.LedgerJournal(directory=str(workdir), compact_threshold=10 ** 9)
+    monkeypatch.setattr(core, "STORAGE_MODE", "journal")
+    monkeypatch.setattr(core, "ledger_journal", journal)
+    calls = []
+    append_frames = journal.append_frames
+    monkeypatch.setattr(journal, "append_frames", lambda frames: calls.append(sorted(frames)) or append_frames(frames))
+    history(90).to_csv("hist.csv", index=False)
+    stats = core.import_ledger_file("hist.csv", SHEET, chunk_size=40, workers=1)
+    assert stats["imported"] == 90
+    assert calls == [sorted([SHEET, core.JOURNAL_SHEET])] * 3
+    assert len(journal.read(SHEET)) == 90
+    lines = journal.read(core.JOURNAL_SHEET)
+    assert len(lines) == len(core.journal_lines(SHEET, journal.read(SHEET)))
+    assert lines["مدين"].sum() == pytest.approx(lines["دائن"].sum())
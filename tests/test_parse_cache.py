@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+import accounting_core as core
+
+
+def test_key_normalisation():
+    assert core.normalize_parse_text("  بيع لعميل\tبمبلغ 1500.50  ريال ") == "بيع لعميل بمبلغ # ريال"
+    assert core.normalize_parse_text("فاتورة ٣٤٥ بتاريخ 2024-05-01") == "فاتورة # بتاريخ #-#-#"
+    assert core.normalize_parse_text("شراء 10") == core.normalize_parse_text("شراء   99.9")
+
+
+def test_hit_rebinds_amount_and_vat():
+    cache = core.ParseCache(size=8)
+    first = cache.parse("transaction", "بيع بمبلغ 1000 ريال", core.parse_transaction_text)
+    assert (first.amount, first.vat_amount) == (1000.0, 150.0)
+
+    def no_parse(text):
+        raise AssertionError("النص المطابق بعد التطبيع يُؤخذ من الذاكرة")
+
+    second = cache.parse("transaction", "بيع  بمبلغ 2500 ريال", no_parse)
+    assert (second.amount, second.vat_amount) == (2500.0, 375.0)
+    assert second.description == "بيع  بمبلغ 2500 ريال"
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+    # نوع آخر بالنص نفسه لا يشارك المدخل
+    assert cache.parse("invoice", "بيع بمبلغ 1000 ريال", core.parse_invoice_text).transaction_type == "شراء"
+
+
+def test_dates_shift_and_digit_fields_are_not_copied():
+    template = core.Transaction(
+        transaction_type="شراء", amount=1000.0, date="2024-01-10", vat_amount=150.0, party="مورد",
+        invoice_number="INV-20240110-001", due_date="2024-02-09",
+        items=({"description": "طابعة", "quantity": 2, "unit_price": 500.0, "total": 1000.0},),
+    )
+    rebound = core.rebind_transaction(template, "فاتورة 1000", "2024-01-10", "فاتورة 1200", today="2024-02-10")
+    assert (rebound.amount, rebound.vat_amount) == (1200.0, 180.0)
+    assert (rebound.date, rebound.due_date) == ("2024-02-10", "2024-03-11")
+    assert rebound.invoice_number == "INV-20240210-001"
+    assert rebound.items == () and rebound.party == "مورد"
+
+    # رقم فاتورة من نص المصدر نفسه لا يُنقل إلى الفاتورة الجديدة، والتاريخ غير المختوم بيوم التحليل يبقى
+    template = core.Transaction(transaction_type="شراء", amount=1000.0, date="2023-12-31", invoice_number="F-7781")
+    rebound = core.rebind_transaction(template, "فاتورة F-7781 بمبلغ 1000", "2024-01-10", "فاتورة F-7790 بمبلغ 900",
+                                      today="2024-02-10")
+    assert rebound.invoice_number == "" and rebound.date == "2023-12-31"
+
+
+def test_persistence_round_trip_is_debounced(tmp_path):
+    path = tmp_path / "parse_cache.json"
+    cache = core.ParseCache(size=8, path=str(path), save_delay=60)
+    cache.parse("transaction", "بيع بمبلغ 1000 ريال", core.parse_transaction_text)
+    cache.parse("invoice", "فاتورة 3250", core.parse_invoice_text)
+    # الحفظ مؤجل: لا كتابة مع كل تحليل جديد
+    assert not path.exists()
+    assert cache.flush(timeout=5)
+    assert [entry["key"] for entry in json.loads(path.read_text(encoding="utf-8"))] == [
+        "transaction:بيع بمبلغ # ريال", "invoice:فاتورة #"]
+
+    def no_parse(text):
+        raise AssertionError("المدخل محفوظ من التشغيل السابق")
+
+    restored = core.ParseCache(size=8, path=str(path))
+    assert len(restored) == 2
+    invoice = restored.parse("invoice", "فاتورة 4000", no_parse)
+    assert invoice.amount == 4000.0 and invoice.party == "شركة المعدات المتحدة"
+    assert isinstance(restored._items["invoice:فاتورة #"][0].items, tuple)
+    assert restored.parse("transaction", "بيع بمبلغ 70 ريال", no_parse).vat_amount == pytest.approx(10.5)
@@ -0,0 +1,88 @@
+import os
+
+import pandas as pd
+import pytest
+
+import accounting_core as core
+
+SHEET = "المبيعات"
+
+
+def posting():
+    sale = pd.DataFrame([{"التاريخ": "2024-01-05", "العميل": "عميل", "المبلغ": 100.0,
+                          "الوصف": "", "الحالة": "مفتوحة", "العملة": "SAR"}])
+    return {SHEET: sale, core.JOURNAL_SHEET: core.journal_lines(SHEET, sale)}
+
+
+def test_journal_rolls_back_the_sheet_row_when_its_lines_fail(tmp_path, monkeypatch):
+    journal = core.LedgerJournal(directory=str(tmp_path), compact_threshold=10 ** 9)
+    journal.append_frames(posting())
+    sizes = {sheet: os.path.getsize(journal.journal_path(sheet)) for sheet in (SHEET, core.JOURNAL_SHEET)}
+
+    append = core.LedgerJournal._append_payload
+    calls = []
+
+    def fail_second(path, payload):
+        calls.append(path)
+        if len(calls) == 2:
+            # كتابة جزئية ثم فشل، كما لو امتلأ القرص في منتصف السطر
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(payload[:10])
+            raise OSError("no space left")
+        append(path, payload)
+
+    monkeypatch.setattr(core.LedgerJournal, "_append_payload", staticmethod(fail_second))
+    with pytest.raises(OSError):
+        journal.append_frames(posting())
+
+    assert {sheet: os.path.getsize(journal.journal_path(sheet)) for sheet in sizes} == sizes
+    assert len(journal.read(SHEET)) == 1
+    assert len(journal.read(core.JOURNAL_SHEET)) == len(posting()[core.JOURNAL_SHEET])
+
+
+def test_journal_removes_files_it_created_on_failure(tmp_path, monkeypatch):
+    journal = core.LedgerJournal(directory=str(tmp_path), compact_threshold=10 ** 9)
+    append = core.LedgerJournal._append_payload
+
+    def fail_journal(path, payload):
+        if path == journal.journal_path(core.JOURNAL_SHEET):
+            raise OSError("no space left")
+        append(path, payload)
+
+    monkeypatch.setattr(core.LedgerJournal, "_append_payload", staticmethod(fail_journal))
+    with pytest.raises(OSError):
+        journal.append_frames(posting())
+    assert not os.path.exists(journal.journal_path(SHEET))
+
+
+def test_sqlite_writes_row_and_lines_in_one_transaction(tmp_path):
+    ledger = core.SqliteLedger(str(tmp_path / "ledger.db"))
+    ledger.ensure_schema(migrate=False)
+    ledger.append_frames(posting())
+
+    frames = posting()
+    frames["ورقة غير معروفة"] = frames[SHEET]
+    with pytest.raises(KeyError):
+        ledger.append_frames(frames)
+
+    assert len(ledger.read(SHEET)) == 1
+    assert len(ledger.read(core.JOURNAL_SHEET)) == len(posting()[core.JOURNAL_SHEET])
+    ledger.pool.close()
+
+
+def test_cache_is_untouched_when_the_write_fails(tmp_path):
+    store = core.LedgerJournal(directory=str(tmp_path), compact_threshold=10 ** 9)
+    store.append_frames(posting())
+    cache = core.LedgerCache(store.read, lambda sheet: [store.snapshot_path(sheet), store.journal_path(sheet)])
+    before = {sheet: len(cache.get(sheet).frame()) for sheet in (SHEET, core.JOURNAL_SHEET)}
+
+    def fail():
+        raise OSError("no space left")
+
+    with pytest.raises(OSError):
+        cache.extend_many(posting(), write=fail)
+    assert {sheet: len(cache.get(sheet).frame()) for sheet in before} == before
+
+    frames = posting()
+    cache.extend_many(frames, write=lambda: store.append_frames(frames))
+    assert {sheet: len(cache.get(sheet).frame()) for sheet in before} == {sheet: before[sheet] * 2 for sheet in before}
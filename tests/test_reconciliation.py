@@ -0,0 +1,120 @@
+import pandas as pd
+import pytest
+
+import accounting_core as core
+
+OPEN = core.OPEN_STATUS
+
+
+def ledger(sales=(), purchases=(), expenses=()):
+    def sheet(name, rows):
+        party = core.PARTY_COLUMNS[name]
+        frame = pd.DataFrame([{"التاريخ": date, party: who, "المبلغ": amount, "الوصف": "", "الحالة": OPEN, "العملة": "SAR"}
+                              for date, who, amount in rows], columns=core.SHEET_COLUMNS[name])
+        return core.typed_frame(frame)
+
+    return {"المبيعات": sheet("المبيعات", sales), "المشتريات": sheet("المشتريات", purchases),
+            "المصروفات": sheet("المصروفات", expenses)}
+
+
+def statement(rows):
+    return pd.DataFrame({
+        "التاريخ": pd.to_datetime([date for date, _, _ in rows]),
+        "المبلغ": [amount for _, amount, _ in rows],
+        "الوصف": [text for _, _, text in rows],
+        "المرجع": "",
+    })
+
+
+def run(bank, data, **options):
+    return core.ReconciliationEngine(window_days=3, **options).run(bank, data)
+
+
+def test_duplicate_amounts_pair_in_date_order():
+    data = ledger(sales=[("2024-01-04", "أ", 500.0), ("2024-01-21", "ب", 500.0)])
+    bank = statement([("2024-01-05", 500.0, "إيداع"), ("2024-01-20", 500.0, "إيداع"), ("2024-02-15", 500.0, "إيداع")])
+    result = run(bank, data)
+    matches = result["matches"]
+    assert matches["سطر الكشف"].tolist() == [0, 1]
+    assert matches["الصف"].tolist() == [0, 1]
+    assert matches["فرق الأيام"].tolist() == [1, 1]
+    assert result["unmatched"].index.tolist() == [2] and result["entries_left"] == 0
+
+
+def test_dates_outside_the_window_are_not_matched():
+    data = ledger(sales=[("2024-01-20", "أ", 700.0)], purchases=[("2024-01-10", "مورد", 300.0)])
+    bank = statement([("2024-01-10", 700.0, "إيداع"), ("2024-01-14", -300.0, "سحب")])
+    result = run(bank, data)
+    assert result["matches"].empty
+    assert len(result["unmatched"]) == 2 and result["entries_left"] == 2
+
+
+def test_fuzzy_name_match_within_tolerance():
+    data = ledger(sales=[("2024-03-10", "شركة النور", 1000.0), ("2024-03-10", "مؤسسة الأفق", 1000.0)])
+    bank = statement([("2024-03-11", 985.0, "تحويل من شركة النور للتجارة"),
+                      ("2024-03-11", 950.0, "تحويل من مؤسسة الأفق")])
+    result = run(bank, data)
+    matches = result["matches"]
+    assert len(matches) == 1
+    match = matches.iloc[0]
+    assert match["الطريقة"] == core.ReconciliationEngine.FUZZY
+    assert match["الطرف"] == "شركة النور" and match["سطر الكشف"] == 0
+    # خارج نسبة السماح (5% > 2%) لا تُطابق
+    assert result["unmatched"]["المبلغ"].tolist() == [950.0]
+    assert run(bank, data, fuzzy=False)["matches"].empty
+
+
+def test_debit_credit_csv_statement():
+    text = (
+        "Date,Description,Debit,Credit\n"
+        "05/02/2024,Customer payment,,\"1,200.00\"\n"
+        "06/02/2024,Supplier transfer,450.00,\n"
+        "07/02/2024,Bank fee,15.00,\n"
+    )
+    bank = core.read_bank_statement(text.encode("utf-8"), "statement.csv")
+    assert bank["المبلغ"].tolist() == [1200.0, -450.0, -15.0]
+    assert bank["التاريخ"].dt.strftime("%Y-%m-%d").tolist() == ["2024-02-05", "2024-02-06", "2024-02-07"]
+
+    data = ledger(sales=[("2024-02-04", "عميل", 1200.0)], purchases=[("2024-02-06", "مورد", 450.0)],
+                  expenses=[("2024-02-07", "رسوم", 15.0)])
+    matches = run(bank, data)["matches"]
+    assert matches["الورقة"].tolist() == ["المبيعات", "المشتريات", "المصروفات"]
+
+
+def test_ofx_statement():
+    text = """OFXHEADER:100
+DATA:OFXSGML
+
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>
+<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20240310120000[+3:AST]<TRNAMT>2500.00<FITID>T1<NAME>شركة النور<MEMO>فاتورة 17
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20240312<TRNAMT>-800.50<FITID>T2<NAME>مورد القرطاسية
+</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+"""
+    bank = core.read_bank_statement(text.encode("utf-8"), "march.ofx")
+    assert bank["المبلغ"].tolist() == [2500.0, -800.5]
+    assert bank["المرجع"].tolist() == ["T1", "T2"]
+    assert bank["الوصف"].tolist() == ["شركة النور فاتورة 17", "مورد القرطاسية"]
+    assert bank["التاريخ"].dt.strftime("%Y-%m-%d").tolist() == ["2024-03-10", "2024-03-12"]
+
+    data = ledger(sales=[("2024-03-09", "شركة النور", 2500.0)], purchases=[("2024-03-12", "مورد القرطاسية", 800.5)])
+    result = run(bank, data)
+    assert len(result["matches"]) == 2 and result["unmatched"].empty
+
+
+def test_settle_matches_rejects_changed_rows():
+    data = ledger(sales=[("2024-01-04", "أ", 500.0), ("2024-01-21", "ب", 500.0)])
+    bank = statement([("2024-01-05", 500.0, "إيداع")])
+    matches = run(bank, data)["matches"]
+
+    settled = core.settle_matches(data, matches)["المبيعات"]
+    assert settled["الحالة"].tolist() == [core.SETTLED_STATUS, OPEN]
+
+    # نفس المبلغ في الموضع نفسه لكن لقيد آخر (تاريخ أو طرف مختلف)
+    for column, value in (("التاريخ", pd.Timestamp("2024-01-21")), ("العميل", "ب")):
+        changed = {name: df.copy() for name, df in data.items()}
+        sales = changed["المبيعات"]
+        if isinstance(sales[column].dtype, pd.CategoricalDtype):
+            sales[column] = sales[column].astype(object)
+        sales.loc[0, column] = value
+        with pytest.raises(ValueError):
+            core.settle_matches(changed, matches)
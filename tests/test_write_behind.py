@@ -0,0 +1,91 @@
+import os
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+import accounting_core as core
+
+
+class Recorder:
+    """دالة كتابة للاختبار: تسجل الأوراق المكتوبة، ويمكن أن تفشل أو تنتظر gate"""
+
+    def __init__(self, fail=()):
+        self.calls = []
+        self.fail = set(fail)
+        self.started = threading.Event()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def __call__(self, sheet_name):
+        self.calls.append(sheet_name)
+        self.started.set()
+        self.gate.wait(5)
+        if sheet_name in self.fail:
+            self.fail.discard(sheet_name)
+            raise OSError("القرص ممتلئ")
+        return 1
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_edits_within_the_delay_are_coalesced():
+    write = Recorder()
+    writer = core.WriteBehind(write, delay=0.2)
+    for _ in range(5):
+        writer.schedule("المبيعات")
+    writer.schedule("المصروفات")
+    assert set(writer.pending()) == {"المبيعات", "المصروفات"}
+    wait_until(lambda: not writer.pending())
+    assert write.calls == ["المبيعات", "المصروفات"]
+    assert (writer.writes, writer.coalesced) == (2, 4)
+
+
+def test_failed_write_is_retried_by_flush():
+    write = Recorder(fail={"المبيعات"})
+    writer = core.WriteBehind(write, delay=0)
+    writer.schedule("المبيعات")
+    wait_until(lambda: "المبيعات" in writer.errors and not writer.pending())
+    assert writer.writes == 0
+
+    assert writer.flush(timeout=5)
+    assert write.calls == ["المبيعات", "المبيعات"]
+    assert writer.errors == {} and writer.writes == 1
+
+
+def test_flush_waits_for_the_write_in_flight():
+    write = Recorder()
+    write.gate.clear()
+    writer = core.WriteBehind(write, delay=0)
+    writer.schedule("المبيعات")
+    assert write.started.wait(5)
+    writer.schedule("المشتريات")
+    assert not writer.flush(timeout=0.05)
+
+    results = []
+    flusher = threading.Thread(target=lambda: results.append(writer.flush(timeout=5)))
+    flusher.start()
+    write.gate.set()
+    flusher.join(5)
+    assert results == [True] and not writer.pending()
+    assert sorted(write.calls) == sorted(["المبيعات", "المشتريات"])
+
+
+def test_atomic_write_keeps_previous_file_on_failure(tmp_path, monkeypatch):
+    path = str(tmp_path / "المبيعات.csv")
+    core.write_csv(pd.DataFrame({"المبلغ": [1.0, 2.0]}), path)
+
+    def broken(df):
+        raise OSError("انقطاع أثناء الكتابة")
+
+    monkeypatch.setattr(core, "storage_frame", broken)
+    with pytest.raises(OSError):
+        core.write_csv(pd.DataFrame({"المبلغ": [3.0]}), path)
+    assert pd.read_csv(path, encoding="utf-8-sig")["المبلغ"].tolist() == [1.0, 2.0]
+    assert os.listdir(tmp_path) == ["المبيعات.csv"]